@@ -3,25 +3,39 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response, HTMLResponse, JSONResponse
 import pandas as pd
 import numpy as np
+import asyncio
+import atexit
+import bisect
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import functools
 import io
 import logging
 import math
 import json
 import os
-import smtplib
-from email.message import EmailMessage
 import time
+import warnings
 from fastapi.responses import StreamingResponse, FileResponse
 import io, zipfile
 from fastapi.staticfiles import StaticFiles
 import sys
-from starlette.middleware.base import BaseHTTPMiddleware
+import hashlib
+import heapq
+import itertools
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import types
+import uuid
+import zlib
+from collections import Counter, OrderedDict
 from starlette.responses import Response as StarletteResponse
-from datetime import datetime
-
-# Global variable to store the last processed DataFrame
-last_processed_df = None
-last_processed_sheets = None  # Store all sheets as a dict
+from datetime import date, datetime, timezone
 
 try:
     import orjson
@@ -29,7 +43,95 @@ try:
 except ImportError:
     HAS_ORJSON = False
 
-app = FastAPI()
+try:
+    import pyarrow as pa
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where the audit log is only locked per process
+    fcntl = None
+
+
+def json_default(obj):
+    """orjson fallback for the pandas/numpy values it does not serialize itself."""
+    if obj is pd.NA or obj is pd.NaT:
+        return None
+    if isinstance(obj, date):  # datetime and pd.Timestamp too
+        return obj.isoformat()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered by orjson, which writes NaN/inf as null and numpy values natively.
+
+    Without orjson it falls back to the stdlib encoder after a clean_nans pass, with the
+    same json_default and compact separators, so both produce the same JSON.
+    """
+
+    def render(self, content):
+        if HAS_ORJSON:
+            return orjson.dumps(content, default=json_default,
+                                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        return json.dumps(clean_nans(content), default=json_default, ensure_ascii=False,
+                          allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+# --- Startup ---
+# Workers are scaled up and down often, so importing this module stays light: smtplib,
+# openpyxl, pyarrow.parquet and sklearn are imported where they are first used. With
+# LEDGERLIFT_PREWARM=1 (the default) the lifespan hook starts the validation pool and has
+# every pool worker import openpyxl and sklearn (well over a second on its own) in the
+# background, so the first upload after a cold start does not pay for them. The imports
+# run inside the workers rather than in a thread here: a process pool forked while this
+# process is halfway through an import could leave the child stuck on the import lock.
+# pandas, numpy, fastapi and pyarrow stay at module level. Every upload, edit and export
+# needs them, and pool workers forked from this process start with them already loaded.
+PREWARM = os.environ.get('LEDGERLIFT_PREWARM', '1') == '1'
+
+
+def prewarm_imports():
+    import openpyxl  # noqa: F401
+    isolation_forest_class()
+    return os.getpid()
+
+
+async def prewarm_validation_pool():
+    logger = logging.getLogger("startup")
+    start = time.perf_counter()
+    try:
+        pids = await asyncio.gather(*(in_validation_pool(prewarm_imports)
+                                      for _ in range(VALIDATION_WORKERS)))
+    except Exception:
+        logger.exception("Validation pool prewarm failed")
+        return
+    logger.info(f"Validation pool warm in {time.perf_counter() - start:.2f}s "
+                f"({len(set(pids))} process(es))")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    prewarm = asyncio.create_task(prewarm_validation_pool()) if PREWARM else None
+    yield
+    if prewarm is not None:
+        prewarm.cancel()
+    audit_log.close()
+    feedback_log.close()
+    mail_queue.close()
+    if _validation_pool is not None:
+        discard_validation_pool(_validation_pool)
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 static_dir = os.path.join(os.path.dirname(__file__), '.')
 if not ("pytest" in sys.modules or "PYTEST_CURRENT_TEST" in os.environ):
@@ -51,28 +153,239 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        response.headers['Content-Security-Policy'] = (
-            "default-src 'self' https://fonts.googleapis.com https://fonts.gstatic.com https://cdn.tailwindcss.com https://unpkg.com https://cdn.jsdelivr.net https://www.googletagmanager.com https://www.google-analytics.com; "
-            "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com https://cdn.tailwindcss.com https://cdn.jsdelivr.net; "
-            "script-src 'self' 'unsafe-inline' https://cdn.tailwindcss.com https://unpkg.com https://cdn.jsdelivr.net https://www.googletagmanager.com https://www.google-analytics.com; "
-            "font-src 'self' https://fonts.gstatic.com; "
-            "img-src 'self' data: https://fastapi.tiangolo.com; "
-            "connect-src *;"
-        )
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-        response.headers['Permissions-Policy'] = 'geolocation=()'
-        return response
+# --- Middleware ---
+# Plain ASGI middleware rather than BaseHTTPMiddleware: each one only wraps `send` to edit
+# the response start message, so requests skip BaseHTTPMiddleware's extra task and
+# memory stream per layer, and StreamingResponse chunks go straight through. Header
+# bytes are built once at import.
+#
+# CompressionMiddleware compresses JSON, CSV and other text responses for clients that
+# accept it. It uses brotli when the brotli package is installed and the client prefers
+# it, otherwise gzip. Bodies under LEDGERLIFT_COMPRESS_MIN_BYTES are sent as they are.
+# Streamed bodies (the CSV export) are compressed chunk by chunk as they are produced.
+# ZIP, Parquet and XLSX downloads are already compressed and pass through untouched.
+COMPRESS_MIN_BYTES = int(os.environ.get('LEDGERLIFT_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('LEDGERLIFT_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('LEDGERLIFT_BROTLI_QUALITY', 4))
+COMPRESSIBLE_TYPES = {'application/json', 'text/csv', 'text/plain', 'text/html', 'text/css',
+                      'application/javascript', 'text/javascript', 'image/svg+xml'}
+
+CONTENT_SECURITY_POLICY = (
+    "default-src 'self' https://fonts.googleapis.com https://fonts.gstatic.com "
+    "https://cdn.tailwindcss.com https://unpkg.com https://cdn.jsdelivr.net "
+    "https://www.googletagmanager.com https://www.google-analytics.com; "
+    "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com https://cdn.tailwindcss.com "
+    "https://cdn.jsdelivr.net; "
+    "script-src 'self' 'unsafe-inline' https://cdn.tailwindcss.com https://unpkg.com "
+    "https://cdn.jsdelivr.net https://www.googletagmanager.com https://www.google-analytics.com; "
+    "font-src 'self' https://fonts.gstatic.com; "
+    "img-src 'self' data: https://fastapi.tiangolo.com; "
+    "connect-src *;"
+)
+SECURITY_HEADERS = [
+    (b'content-security-policy', CONTENT_SECURITY_POLICY.encode('latin-1')),
+    (b'x-content-type-options', b'nosniff'),
+    (b'referrer-policy', b'strict-origin-when-cross-origin'),
+    (b'permissions-policy', b'geolocation=()'),
+]
+SECURITY_HEADER_NAMES = {name for name, _ in SECURITY_HEADERS}
+
+
+def header_value(headers, name):
+    """The first value of header name (lowercase bytes) in an ASGI header list, as str, or None."""
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+class GzipEncoder:
+    encoding = 'gzip'
+
+    def __init__(self):
+        # wbits 31: a gzip container
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    encoding = 'br'
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+# Preferred first when the client weighs encodings equally
+ENCODERS = ([BrotliEncoder] if HAS_BROTLI else []) + [GzipEncoder]
+
+
+def negotiate_encoder(accept_encoding):
+    """The encoder class for an Accept-Encoding header, or None for identity."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            q = float_or_nan(params[2:])
+            q = 0.0 if q != q else q
+        weights[coding.strip().lower()] = q
+    ranked = [(weights.get(encoder.encoding, weights.get('*', 0.0)), -rank, encoder)
+              for rank, encoder in enumerate(ENCODERS)]
+    q, _, encoder = max(ranked, key=lambda entry: entry[:2])
+    return encoder if q > 0 else None
+
+
+class CompressionMiddleware:
+    """Compresses text responses with the encoder the client's Accept-Encoding prefers."""
+
+    def __init__(self, app, minimum_size=COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoder_class = None
+        if scope['type'] == 'http' and scope['method'] != 'HEAD':
+            encoder_class = negotiate_encoder(header_value(scope['headers'], b'accept-encoding'))
+        if encoder_class is None:
+            await self.app(scope, receive, send)
+            return
+        start = None
+        encoder = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, encoder, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message['type'] == 'http.response.start':
+                start = message  # held until the first body chunk shows whether to compress
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if encoder is None:
+                headers = start.get('headers', [])
+                content_type = header_value(headers, b'content-type') or ''
+                content_type = content_type.partition(';')[0].strip().lower()
+                if (content_type not in COMPRESSIBLE_TYPES
+                        or header_value(headers, b'content-encoding') is not None
+                        or start['status'] < 200 or start['status'] in (204, 304)
+                        or (not more_body and len(body) < self.minimum_size)):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                encoder = encoder_class()
+                vary = header_value(headers, b'vary')
+                headers = [(key, value) for key, value in headers
+                           if key.lower() not in (b'content-length', b'vary')]
+                headers.append((b'content-encoding', encoder.encoding.encode('latin-1')))
+                vary = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+                headers.append((b'vary', vary.encode('latin-1')))
+                compressed = encoder.compress(body) + (b'' if more_body else encoder.finish())
+                if not more_body:
+                    headers.append((b'content-length', str(len(compressed)).encode('latin-1')))
+                await send({**start, 'headers': headers})
+                await send({'type': 'http.response.body', 'body': compressed,
+                            'more_body': more_body})
+                return
+            compressed = encoder.compress(body) + (b'' if more_body else encoder.finish())
+            if compressed or not more_body:
+                await send({'type': 'http.response.body', 'body': compressed,
+                            'more_body': more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+app.add_middleware(CompressionMiddleware)
+
+
+class SecurityHeadersMiddleware:
+    """Adds SECURITY_HEADERS to every HTTP response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                headers = [header for header in message.get('headers', ())
+                           if header[0].lower() not in SECURITY_HEADER_NAMES]
+                message = {**message, 'headers': headers + SECURITY_HEADERS}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
 app.add_middleware(SecurityHeadersMiddleware)
 
-class RequestLoggerMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        print(f"Request: {request.method} {request.url.path}")
-        response = await call_next(request)
-        return response
+class RequestLoggerMiddleware:
+    """Logs each request, gives it an id (X-Request-ID) and records its time in request_seconds."""
+
+    def __init__(self, app):
+        self.app = app
+        self.logger = logging.getLogger("request")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        method, path = scope['method'], scope['path']
+        self.logger.info("Request: %s %s", method, path)
+        # Audit records made while handling the request carry its id
+        request_id = header_value(scope['headers'], b'x-request-id') or uuid.uuid4().hex
+        id_header = (b'x-request-id', request_id.encode('latin-1'))
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message = {**message, 'headers': [*message.get('headers', ()), id_header]}
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        profiler = RequestProfiler() if PROFILE_SLOW_SECONDS > 0 else None
+        if profiler is not None and not profiler.start():
+            profiler = None
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            seconds = time.perf_counter() - start
+            request_id_var.reset(token)
+            if profiler is not None:
+                profiler.stop()
+            # Routes by their pattern, so /jobs/{job_id} is one series
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            request_seconds.observe(seconds, method, route, status)
+        if profiler is not None and seconds >= PROFILE_SLOW_SECONDS:
+            saved = await asyncio.to_thread(profiler.save, profile_name(method, path, request_id))
+            logging.getLogger("profile").warning(
+                f"{method} {path} took {seconds:.2f}s; profile saved to {saved}")
+
+
 app.add_middleware(RequestLoggerMiddleware)
 
 USE_VITE_DEV_SERVER = os.environ.get('USE_VITE_DEV_SERVER', '0') == '1'
@@ -87,17 +400,24 @@ def clean_nans(obj):
         if math.isnan(obj) or math.isinf(obj):
             return None
         return obj
-    elif isinstance(obj, (np.floating, np.integer)):
+    elif isinstance(obj, np.floating):
         if np.isnan(obj) or np.isinf(obj):
             return None
         return float(obj)
+    elif isinstance(obj, np.integer):
+        return int(obj)
     elif isinstance(obj, dict):
         return {k: clean_nans(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
+    elif isinstance(obj, (list, tuple)):
         return [clean_nans(x) for x in obj]
     else:
         return obj
 
+
+def frame_records(df):
+    """df.to_dict(orient='records') with NaN, NaT and pd.NA cells as None, masked in one pass."""
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
 # Add helper functions near the top
 
 def check_double_entry(df):
@@ -120,104 +440,3780 @@ def check_missing_values(df):
                 break
     return errors
 
-def check_duplicates(df):
-    errors = []
-    dups = df[df.duplicated()]
-    for idx in dups.index:
-        errors.append({"row": idx+1, "issue": "Duplicate row"})
-    return errors
+def check_duplicates(df):
+    errors = []
+    dups = df[df.duplicated()]
+    for idx in dups.index:
+        errors.append({"row": idx+1, "issue": "Duplicate row"})
+    return errors
+
+def check_invalid_dates(df, date_col='Date'):
+    errors = []
+    if date_col in df.columns:
+        for idx, val in df[date_col].items():
+            try:
+                pd.to_datetime(val)
+            except Exception:
+                errors.append({"row": idx+1, "issue": "Invalid date"})
+    return errors
+
+# --- Enhanced error detection for AI bookkeeping ---
+
+EXCEL_ERROR_CODES = {'#REF!', '#VALUE!', '#DIV/0!', '#NAME?', '#N/A', '#NUM!', '#NULL!'}
+REQUIRED_IS_CATEGORIES = {'Revenue', 'Expenses'}
+REQUIRED_BS_CATEGORIES = {'Assets', 'Liabilities', 'Equity'}
+
+def check_trial_balance_balance(df):
+    errors = []
+    if 'Debit' in df.columns and 'Credit' in df.columns:
+        total_debit = pd.to_numeric(df['Debit'], errors='coerce').sum()
+        total_credit = pd.to_numeric(df['Credit'], errors='coerce').sum()
+        if abs(total_debit - total_credit) > 1e-2:
+            errors.append({"row": None, "issue": f"Trial balance out of balance: Debits={total_debit}, Credits={total_credit}"})
+    return errors
+
+def check_required_categories(df, required, col='Category'):
+    errors = []
+    if col in df.columns:
+        present = set(str(x).strip() for x in df[col].dropna())
+        for req in required:
+            if req not in present:
+                errors.append({"row": None, "issue": f"Missing required category: {req}"})
+    return errors
+
+def check_excel_errors(df):
+    errors = []
+    for col in df.columns:
+        if df[col].dtype == object:
+            for idx, val in df[col].items():
+                if isinstance(val, str) and val.strip().upper() in EXCEL_ERROR_CODES:
+                    errors.append({"row": idx+1, "issue": f"Excel error code in {col}: {val}"})
+                    if len(errors) >= 25:  # Reduced limit for performance
+                        break
+    return errors
+
+
+# --- Validation plans ---
+# /upload?mode=audit|assist&rules=a,b,... chooses what is checked. RULES maps each rule id
+# (the ids the UI's rule toggles send) to the issue types it reports; no rules parameter
+# means every rule but OPT_IN_RULES, an empty one none. Assist mode keeps only
+# ASSIST_ISSUE_TYPES. A plan is compiled once per (mode, rules) and asked by every check
+# before it builds a mask, so a disabled rule is never computed rather than filtered out
+# afterwards.
+RULES = {
+    'double-entry': ('unbalanced_entry', 'trial_out_of_balance'),
+    'missing-values': ('missing_account_number', 'missing_account_name', 'missing_account_type',
+                       'missing_account', 'missing_value'),
+    'duplicates': ('duplicate_row',),
+    'invalid-dates': ('invalid_date',),
+    'account-codes': ('unknown_account', 'abnormal_balance'),
+    'gaap-ifrs': ('negative_depreciation', 'revenue_debit', 'equity_debit', 'prepaid_in_pl'),
+    'anomaly': ('anomaly',),
+    'cross-sheet': ('net_income_mismatch', 'balance_sheet_mismatch'),
+    'formula-audit': ('formula_present', 'hardcoded_formula', 'empty_reference',
+                      'circular_reference'),
+    'trial-journal': ('trial_journal_mismatch',),
+}
+# Only run when asked for by name. Journal lines carry their debit and credit on one row,
+# so most journals net every account to zero and trial-journal would flag each non-zero
+# trial-balance line; it suits workbooks whose journal posts one side per line.
+OPT_IN_RULES = {'trial-journal'}
+DEFAULT_RULES = tuple(rule for rule in RULES if rule not in OPT_IN_RULES)
+ASSIST_ISSUE_TYPES = {'trial_out_of_balance', 'missing_account', 'missing_account_number',
+                      'missing_account_name', 'missing_account_type'}
+VALIDATION_MODES = ('audit', 'assist')
+
+
+class ValidationPlan:
+    """The issue types one mode and rule selection reports. Picklable, so pool jobs get it as is."""
+
+    def __init__(self, mode='audit', rules=None):
+        self.mode = mode
+        self.rules = rules  # sorted rule ids, or None for DEFAULT_RULES
+        issue_types = {issue_type for rule in (DEFAULT_RULES if rules is None else rules)
+                       for issue_type in RULES[rule]}
+        if mode == 'assist':
+            issue_types &= ASSIST_ISSUE_TYPES
+        self.issue_types = frozenset(issue_types)
+
+    def key(self):
+        return (self.mode, self.rules)
+
+    def enabled(self, *issue_types):
+        return not self.issue_types.isdisjoint(issue_types)
+
+
+AUDIT_PLAN = ValidationPlan()
+
+
+def parse_rules(text):
+    """The rules query parameter as a sorted tuple of ids; None if it was not given."""
+    if text is None:
+        return None
+    return tuple(sorted(set(filter(None, (rule.strip() for rule in text.split(','))))))
+
+
+@functools.lru_cache(maxsize=128)
+def validation_plan(mode='audit', rules=None):
+    """The compiled plan for a mode and parse_rules() output.
+
+    Raises ValueError for unknown names.
+    """
+    if mode not in VALIDATION_MODES:
+        raise ValueError(f"Unknown mode '{mode}'. Use one of: {', '.join(VALIDATION_MODES)}.")
+    unknown = sorted(set(rules or ()) - set(RULES))
+    if unknown:
+        raise ValueError(f"Unknown rule(s): {', '.join(unknown)}. Known rules: {', '.join(RULES)}.")
+    return ValidationPlan(mode, rules)
+
+# --- Vectorized validation engine ---
+# Every check runs as a whole-column operation (one to_datetime / to_numeric pass per
+# column plus boolean masks). Errors are emitted row by row, in the order the old
+# df.iterrows() loops produced them, so the error list is unchanged.
+
+
+KNOWN_HEADER_ACCOUNTS = {'assets', 'liabilities', 'equity', 'revenue', 'expenses', 'contra revenue',
+                         'contra asset', 'total', 'net income', 'gross profit', 'operating income'}
+BLANK_ACCOUNT_NUMBERS = {'', 'nan', 'none'}
+
+
+def sheet_kind(name):
+    lname = name.lower()
+    if 'chart' in lname:
+        return 'chart'
+    if 'journal' in lname:
+        return 'journal'
+    if 'trial' in lname:
+        return 'trial'
+    if 'income' in lname or 'balance' in lname:
+        return 'statement'
+    return None
+
+
+def str_column(df, col):
+    """str() of every cell in col, or '' for every row if the column is missing."""
+    if col not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    return df[col].map(str).astype(object)
+
+
+def heading_mask(df):
+    """Rows whose account name is a section heading or a total rather than an account."""
+    acc_name = str_column(df, 'Account').str.strip().str.lower()
+    return acc_name.isin(KNOWN_HEADER_ACCOUNTS) | acc_name.str.startswith('total')
+
+
+def header_row_mask(df):
+    # Heuristic: no account number, or account name is a known header
+    acc_num = str_column(df, 'Account Number').str.strip()
+    return heading_mask(df) | acc_num.isin(BLANK_ACCOUNT_NUMBERS)
+
+
+def amount_column(df, col):
+    """Coerce a Debit/Credit column to floats in one pass.
+
+    Returns (values, blank): None, pd.NA and '' count as 0 and are marked blank,
+    NaN stays NaN, and text that float() cannot parse becomes NaN.
+    """
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index), pd.Series(True, index=df.index)
+    raw = df[col]
+    if pd.api.types.is_numeric_dtype(raw):
+        return raw.astype(float), pd.Series(False, index=df.index)
+    if pd.api.types.is_datetime64_any_dtype(raw):
+        return pd.Series(np.nan, index=df.index), pd.Series(False, index=df.index)
+    values = pd.to_numeric(raw, errors='coerce').astype(float)
+    missing = raw.isna()
+    blank = (raw == '').fillna(False).astype(bool)
+    if missing.any():
+        # None and pd.NA are blanks; a NaN cell is not
+        blank[missing] = raw[missing].map(str).isin(['None', '<NA>']).to_numpy()
+    notna = ~missing
+    # float() accepts a few spellings pandas does not; each distinct leftover is retried once
+    retry = (values.isna() & notna & ~blank).to_numpy()
+    if retry.any():
+        codes, uniques = pd.factorize(raw[retry])
+        values[retry] = np.array([float_or_nan(value) for value in uniques], dtype=float)[codes]
+    return values.mask(blank, 0.0), blank
+
+
+def float_or_nan(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+
+def invalid_date_mask(series):
+    """True where pd.to_datetime(value) raises for that single value."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            candidates = pd.to_datetime(series, errors='coerce').isna() & series.notna()
+        except (ValueError, TypeError, OverflowError):
+            candidates = series.notna()
+        if candidates.any():
+            # Columns with mixed date formats: parse the leftovers element-wise in one call
+            try:
+                subset = series[candidates]
+                parsed = pd.to_datetime(subset, format='mixed', errors='coerce')
+                candidates[candidates] = parsed.isna().to_numpy()
+            except (ValueError, TypeError, OverflowError):
+                pass
+    invalid = np.zeros(len(series), dtype=bool)
+    for pos in np.flatnonzero(candidates.to_numpy()):
+        try:
+            pd.to_datetime(series.iat[pos])
+        except Exception:
+            invalid[pos] = True
+    return invalid
+
+
+def formula_mask(series):
+    """True where the cell is a string starting with '='."""
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return np.zeros(len(series), dtype=bool)
+    try:
+        mask = series.str.startswith('=', na=False)
+    except AttributeError:
+        mask = series.map(lambda v: isinstance(v, str) and v.startswith('='))
+    return mask.to_numpy(dtype=bool)
+
+
+def formula_cells(df):
+    """{column position: row positions} of the formula cells; one string scan per text column."""
+    cells = {}
+    for j in range(len(df.columns)):
+        rows = np.flatnonzero(formula_mask(df.iloc[:, j]))
+        if len(rows):
+            cells[j] = rows
+    return cells
+
+
+def emit_row_errors(df, checks):
+    """checks: ordered list of (mask, issue) where issue(pos) builds the message.
+
+    Errors come out sorted by row, then by check order, like a per-row loop.
+    """
+    labels = df.index.tolist()
+    found = []
+    for order, (mask, issue) in enumerate(checks):
+        for pos in np.flatnonzero(np.asarray(mask, dtype=bool)).tolist():
+            found.append((pos, order, issue))
+    found.sort(key=lambda item: (item[0], item[1]))
+    return [{"row": labels[pos] + 1, "issue": issue(pos)} for pos, _, issue in found]
+
+
+# --- Chart of accounts index ---
+# The workbook's Chart of Accounts sheet indexed once: account number -> name, type and
+# normal balance, and every number and name as a lookup key. Journal and trial-balance
+# rows resolve their account ('Account Number', else 'Account' as a number or a name) with
+# one vectorized map against it. Under the account-codes rule, accounts that do not resolve
+# are flagged, as are trial-balance accounts whose balance is on the opposite side of their
+# normal balance; the GAAP revenue/equity rules use the chart's type where a row resolves.
+ACCOUNT_TYPES = {
+    'asset': 'asset', 'assets': 'asset', 'contra asset': 'contra asset',
+    'liability': 'liability', 'liabilities': 'liability',
+    'equity': 'equity', "owner's equity": 'equity',
+    'revenue': 'revenue', 'revenues': 'revenue', 'income': 'revenue', 'sales': 'revenue',
+    'contra revenue': 'contra revenue',
+    'expense': 'expense', 'expenses': 'expense', 'cost of goods sold': 'expense',
+}
+NORMAL_BALANCES = {'asset': 'debit', 'expense': 'debit', 'contra revenue': 'debit',
+                   'liability': 'credit', 'equity': 'credit', 'revenue': 'credit',
+                   'contra asset': 'credit'}
+ACCOUNT_INDEX_TYPES = ('unknown_account', 'abnormal_balance', 'revenue_debit', 'equity_debit',
+                       'trial_journal_mismatch')
+
+
+def account_keys(series):
+    """Lookup keys for account numbers or names: stripped, lower-case, with '1000.0' read as '1000'.
+
+    Computed once per distinct value; account columns repeat a few values many times.
+    """
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    keys = pd.Series([str(u) for u in uniques], dtype=object).str.strip().str.lower()
+    keys = keys.str.replace(r'^(\d+)\.0+$', r'\1', regex=True)
+    return pd.Series(keys.to_numpy()[codes], index=series.index, dtype=object)
+
+
+def account_row_keys(df):
+    """(keys, shown) per row: the account's lookup key ('Account Number', else 'Account')
+    and the cell it came from."""
+    if 'Account Number' in df.columns:
+        keys = account_keys(df['Account Number'])
+        shown = df['Account Number'].to_numpy(dtype=object)
+    else:
+        keys = pd.Series('', index=df.index, dtype=object)
+        shown = np.full(len(df), '', dtype=object)
+    if 'Account' in df.columns:
+        blank = keys.isin(BLANK_ACCOUNT_NUMBERS)
+        shown = np.where(blank.to_numpy(), df['Account'].to_numpy(dtype=object), shown)
+        keys = keys.where(~blank, account_keys(df['Account']))
+    return keys, shown
+
+
+class AccountIndex:
+    """A Chart of Accounts sheet indexed by account number."""
+
+    def __init__(self, chart):
+        names = str_column(chart, 'Account Name').str.strip()
+        numbers = account_keys(str_column(chart, 'Account Number'))
+        # An account without a number (already flagged on the chart) is still known by its name
+        numbers = numbers.where(~numbers.isin(BLANK_ACCOUNT_NUMBERS), account_keys(names))
+        types = str_column(chart, 'Type').str.strip().str.lower()
+        types = types.map(lambda t: ACCOUNT_TYPES.get(t, t))
+        types = types.where(~types.isin(BLANK_ACCOUNT_NUMBERS))
+        normal = types.map(NORMAL_BALANCES)
+        if 'Normal Balance' in chart.columns:
+            given = str_column(chart, 'Normal Balance').str.strip().str.lower()
+            normal = given.where(given.isin(('debit', 'credit')), normal)
+        accounts = pd.DataFrame({
+            'name': names.to_numpy(),
+            'type': types.to_numpy(),
+            'normal_balance': normal.to_numpy(),
+        }, index=pd.Index(numbers.to_numpy(), name='number'))
+        accounts = accounts[~accounts.index.isin(BLANK_ACCOUNT_NUMBERS)]
+        self.accounts = accounts[~accounts.index.duplicated()]
+        # A number resolves to itself, a name to the first account that has it
+        by_number = pd.Series(self.accounts.index, index=self.accounts.index)
+        by_name = pd.Series(self.accounts.index,
+                            index=account_keys(self.accounts['name']).to_numpy())
+        lookup = pd.concat([by_number, by_name[~by_name.index.isin(BLANK_ACCOUNT_NUMBERS)]])
+        self.lookup = lookup[~lookup.index.duplicated()]
+
+    def resolve(self, df):
+        """(numbers, named, shown) per row: the chart account number (NaN if unknown), whether
+        the row names an account at all, and the cell it names it by."""
+        keys, shown = account_row_keys(df)
+        return keys.map(self.lookup), ~keys.isin(BLANK_ACCOUNT_NUMBERS), shown
+
+    def column(self, numbers, field):
+        """field ('name', 'type' or 'normal_balance') of each resolved account number."""
+        return numbers.map(self.accounts[field])
+
+
+def build_account_index(sheets):
+    """The AccountIndex of the first chart sheet with an 'Account Number' column, or None."""
+    for name, df in sheets.items():
+        if sheet_kind(name) == 'chart' and 'Account Number' in df.columns:
+            return AccountIndex(df)
+    return None
+
+
+def unknown_account_check(df, accounts, numbers, named, shown):
+    mask = ~heading_mask(df).to_numpy() & named.to_numpy() & numbers.isna().to_numpy()
+    return mask, lambda pos: f"Account {str(shown[pos]).strip()} not found in Chart of Accounts"
+
+
+# (column, issue, issue type) of the chart's required columns
+CHART_REQUIRED_COLUMNS = (
+    ('Account Number', 'Missing Account Number', 'missing_account_number'),
+    ('Account Name', 'Missing Account Name', 'missing_account_name'),
+    ('Type', 'Missing Account Type', 'missing_account_type'),
+)
+
+
+def validate_chart_sheet(df, plan=AUDIT_PLAN):
+    # Chart of Accounts: check for missing account numbers/names/types, duplicates
+    errors = []
+    labels = df.index.tolist()
+    for col, issue, issue_type in CHART_REQUIRED_COLUMNS:
+        if col in df.columns and plan.enabled(issue_type):
+            errors.extend({"row": labels[pos] + 1, "issue": issue}
+                          for pos in np.flatnonzero(df[col].isnull().to_numpy()).tolist())
+    if plan.enabled('duplicate_row'):
+        errors.extend({"row": labels[pos] + 1, "issue": "Duplicate row"}
+                      for pos in np.flatnonzero(df.duplicated().to_numpy()).tolist())
+    return errors
+
+
+def chart_row_errors(df, plan=AUDIT_PLAN):
+    """The row-local part of validate_chart_sheet (everything but duplicates), ordered by row."""
+    checks = [(df[col].isnull().to_numpy(), lambda pos, issue=issue: issue)
+              for col, issue, issue_type in CHART_REQUIRED_COLUMNS
+              if col in df.columns and plan.enabled(issue_type)]
+    return emit_row_errors(df, checks)
+
+
+def validate_journal_sheet(df, name, plan=AUDIT_PLAN, accounts=None):
+    # Journal Entries: check for missing/invalid dates, unbalanced debits/credits, missing
+    # accounts, GAAP/IFRS rules
+    body = ~header_row_mask(df).to_numpy()
+    checks = []
+    if accounts is not None and plan.enabled('unknown_account', 'revenue_debit', 'equity_debit'):
+        numbers, named, shown = accounts.resolve(df)
+    if plan.enabled('invalid_date') and 'Date' in df.columns:
+        invalid_dates = np.zeros(len(df), dtype=bool)
+        invalid_dates[body] = invalid_date_mask(df['Date'][body])
+        checks.append((invalid_dates, lambda pos: "Invalid or missing Date"))
+    if plan.enabled('unbalanced_entry', 'negative_depreciation', 'revenue_debit', 'equity_debit'):
+        debit, debit_blank = amount_column(df, 'Debit')
+        debit_arr = debit.to_numpy()
+    if plan.enabled('unbalanced_entry'):
+        credit, credit_blank = amount_column(df, 'Credit')
+        debit_values = debit.tolist()
+        credit_values = credit.tolist()
+
+        def amount_text(values, blank, pos):
+            return '0' if blank.iat[pos] else str(values[pos])
+
+        checks.append((body & ((debit - credit).abs() > 0.01).to_numpy(),
+                       lambda pos: f"Debit ({amount_text(debit_values, debit_blank, pos)}) ≠ "
+                                   f"Credit ({amount_text(credit_values, credit_blank, pos)})"))
+    if plan.enabled('missing_account', 'negative_depreciation', 'prepaid_in_pl'):
+        acc_name = str_column(df, 'Account').str.lower()
+    if plan.enabled('missing_account') and 'Account' in df.columns:
+        account = df['Account']
+        missing_account = ((account.isna() & (acc_name == 'none'))
+                           | (str_column(df, 'Account').str.strip() == ''))
+        checks.append((body & missing_account.to_numpy(), lambda pos: "Missing Account"))
+    if accounts is not None and plan.enabled('unknown_account'):
+        checks.append(unknown_account_check(df, accounts, numbers, named, shown))
+    # GAAP/IFRS rules
+    if plan.enabled('negative_depreciation'):
+        checks.append((body & (acc_name == 'depreciation expense').to_numpy() & (debit_arr < 0),
+                       lambda pos: "Depreciation expense should not be negative (GAAP)"))
+    if plan.enabled('revenue_debit', 'equity_debit'):
+        acc_type = str_column(df, 'Type').str.lower()
+        if accounts is not None:
+            acc_type = accounts.column(numbers, 'type').fillna(acc_type)
+    if plan.enabled('revenue_debit'):
+        checks.append((body & (acc_type == 'revenue').to_numpy() & (debit_arr > 0),
+                       lambda pos: "Revenue account has debit value (GAAP)"))
+    if plan.enabled('equity_debit'):
+        checks.append((body & (acc_type == 'equity').to_numpy() & (debit_arr > 0),
+                       lambda pos: "Equity account should not have debit balance (GAAP)"))
+    if plan.enabled('prepaid_in_pl') and 'income' in name.lower():
+        checks.append((body & (acc_name == 'prepaid expenses').to_numpy(),
+                       lambda pos: "Prepaid expenses should not appear in P&L (GAAP)"))
+    return emit_row_errors(df, checks)
+
+
+def trial_suspicious_mask(df):
+    # Suggest top 3 suspicious entries (nulls, high values)
+    debit, _ = amount_column(df, 'Debit')
+    credit, _ = amount_column(df, 'Credit')
+    return df['Debit'].isnull() | df['Credit'].isnull() | ((debit - credit).abs() > 1000)
+
+
+def trial_balance_error(total_debit, total_credit, suspicious):
+    """The out-of-balance error for a trial balance, or None. suspicious: 1-based rows in order."""
+    diff = total_debit - total_credit
+    if abs(diff) <= 1e-2:
+        return None
+    if suspicious:
+        suggestion = f"Consider checking rows: {', '.join(map(str, suspicious[:3]))}"
+    else:
+        suggestion = "Review all entries."
+    return {"row": None, "issue": f"Trial balance out of balance: Debits={total_debit}, "
+                                  f"Credits={total_credit}. Difference={diff}. {suggestion}"}
+
+
+def trial_row_errors(df, plan=AUDIT_PLAN, accounts=None):
+    checks = []
+    if 'Account' in df.columns and plan.enabled('missing_account'):
+        checks.append((df['Account'].isnull().to_numpy(), lambda pos: "Missing Account"))
+    if accounts is not None and plan.enabled('unknown_account', 'abnormal_balance'):
+        numbers, named, shown = accounts.resolve(df)
+        if plan.enabled('unknown_account'):
+            checks.append(unknown_account_check(df, accounts, numbers, named, shown))
+        if plan.enabled('abnormal_balance') and 'Debit' in df.columns and 'Credit' in df.columns:
+            net = (amount_column(df, 'Debit')[0] - amount_column(df, 'Credit')[0]).to_numpy()
+            side = np.select([net > 0.01, net < -0.01], ['debit', 'credit'], '')
+            normal = accounts.column(numbers, 'normal_balance').fillna('').to_numpy()
+            checks.append(((side != '') & (normal != '') & (side != normal),
+                           lambda pos: f"Account {str(shown[pos]).strip()} has a {side[pos]} "
+                                       f"balance; its normal balance is {normal[pos]}"))
+    return emit_row_errors(df, checks)
+
+
+def validate_trial_sheet(df, plan=AUDIT_PLAN, accounts=None):
+    # Trial Balance: check for out-of-balance, missing accounts, auto-balance suggestion
+    errors = []
+    if 'Debit' in df.columns and 'Credit' in df.columns and plan.enabled('trial_out_of_balance'):
+        total_debit = pd.to_numeric(df['Debit'], errors='coerce').sum()
+        total_credit = pd.to_numeric(df['Credit'], errors='coerce').sum()
+        if abs(total_debit - total_credit) > 1e-2:
+            labels = df.index.tolist()
+            flagged = np.flatnonzero(trial_suspicious_mask(df).to_numpy())[:3]
+            suspicious = [labels[pos] + 1 for pos in flagged.tolist()]
+            errors.append(trial_balance_error(total_debit, total_credit, suspicious))
+    return errors + trial_row_errors(df, plan, accounts)
+
+
+def validate_statement_sheet(df, plan=AUDIT_PLAN, cells=None):
+    # Income Statement/Balance Sheet: check for missing/invalid formulas, missing values, skip
+    # headers
+    # cells: formula_cells(df), if the caller already has it
+    if len(df.columns) == 0 or len(df) == 0 or not plan.enabled('missing_value', 'formula_present'):
+        return []
+    body = ~header_row_mask(df).to_numpy()
+    formulas = np.zeros((len(df), len(df.columns)), dtype=bool)
+    missing = df.isna().to_numpy() if plan.enabled('missing_value') else formulas.copy()
+    if plan.enabled('formula_present'):
+        for j, rows in (formula_cells(df) if cells is None else cells).items():
+            formulas[rows, j] = True
+    flagged = (missing | formulas) & body[:, None]
+    labels = df.index.tolist()
+    columns = list(df.columns)
+    errors = []
+    for pos, j in zip(*(axis.tolist() for axis in np.nonzero(flagged))):
+        col = columns[j]
+        if missing[pos, j]:
+            errors.append({"row": labels[pos] + 1, "issue": f"Missing value in {col}"})
+        else:
+            # Formula audit
+            errors.append({"row": labels[pos] + 1,
+                           "issue": f"Excel formula present in {col}: {df.iat[pos, j]} "
+                                    "(Check for circular refs or hardcoded totals)"})
+    return errors
+
+
+def validate_sheet(name, df, plan=AUDIT_PLAN, accounts=None):
+    """Run the per-sheet checks that match the sheet's name and return its error list."""
+    kind = sheet_kind(name)
+    if kind == 'chart':
+        return validate_chart_sheet(df, plan)
+    if kind == 'journal':
+        return validate_journal_sheet(df, name, plan, accounts)
+    if kind == 'trial':
+        return validate_trial_sheet(df, plan, accounts)
+    if kind == 'statement':
+        return validate_statement_sheet(df, plan)
+    return []
+
+
+def audits_formulas(name, plan):
+    """Whether formula_audit_errors() runs on this sheet under plan."""
+    return (('income' in name.lower() or 'balance' in name.lower())
+            and plan.enabled('hardcoded_formula', 'empty_reference', 'circular_reference'))
+
+# --- Cross-sheet key lines, formula audit and error explanations ---
+# Each sheet's key lines (one isin over its Account column) and per-account net amounts
+# (AccountRollup, a groupby per chunk) are gathered while the sheet is validated; the
+# cross-sheet stage then compares those small summaries instead of rescanning rows.
+
+
+# key -> (sheet-name marker, account names); the last matching row with a numeric Amount wins
+KEY_LINES = {
+    'net_income': ('income', {'net income', 'net profit'}),
+    'retained_earnings': ('balance', {'retained earnings'}),
+    'total_assets': ('balance', {'total assets'}),
+    'total_liab_equity': ('balance', {'total liabilities and equity'}),
+}
+ANOMALY_ISSUE = "ML anomaly detected: unusual debit/credit pattern"
+ANOMALY_WHY = ("This entry is statistically unusual for its account, measured against a trained "
+               "model or, without one, the rest of this upload")
+
+
+def key_line_labels(name, df):
+    """Row labels of each cross-sheet key line found in this sheet, in row order."""
+    lname = name.lower()
+    keys = [key for key, (marker, _) in KEY_LINES.items() if marker in lname]
+    if not keys:
+        return {}
+    acc = str_column(df, 'Account').str.strip().str.lower()
+    key_of = {account: key for key in keys for account in KEY_LINES[key][1]}
+    matched = acc.isin(key_of).to_numpy()
+    labels = {key: [] for key in keys}
+    for label, account in zip(df.index[matched].tolist(), acc[matched].tolist()):
+        labels[key_of[account]].append(label)
+    return labels
+
+
+def key_line_value(df, labels):
+    """The Amount of the last of labels that float() accepts; None if there is none."""
+    if not labels:
+        return None
+    if 'Amount' not in df.columns:
+        return 0.0
+    for value in reversed(df.loc[labels, 'Amount'].tolist()):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def key_line_values(sheets, labels_by_sheet):
+    """Key-line amounts across sheets; a later sheet overrides an earlier one."""
+    values = {}
+    for name, labels in labels_by_sheet.items():
+        for key, key_labels in labels.items():
+            value = key_line_value(sheets[name], key_labels)
+            if value is not None:
+                values[key] = value
+    return values
+
+
+def reconcile_key_lines(values):
+    errors = []
+    net_income = values.get('net_income')
+    retained_earnings_change = values.get('retained_earnings')
+    total_assets = values.get('total_assets')
+    total_liab_equity = values.get('total_liab_equity')
+    # Add reconciliation errors if mismatches found
+    if net_income is not None and retained_earnings_change is not None:
+        if abs(net_income - retained_earnings_change) > 1e-2:
+            errors.append({
+                "row": None,
+                "issue": f"Net income from Income Statement ({net_income}) does not match change in Retained Earnings on Balance Sheet ({retained_earnings_change})."
+            })
+    if total_assets is not None and total_liab_equity is not None:
+        if abs(total_assets - total_liab_equity) > 1e-2:
+            errors.append({
+                "row": None,
+                "issue": f"Total Assets ({total_assets}) does not equal Total Liabilities and Equity ({total_liab_equity}) on Balance Sheet."
+            })
+    return errors
+
+
+class AccountRollup:
+    """Net debit minus credit per account over journal or trial-balance rows, summed by chunk."""
+
+    def __init__(self):
+        self.net = pd.Series(dtype=float)
+        self.shown = {}  # key -> the first cell that named the account
+
+    def add(self, df, accounts=None):
+        if 'Debit' not in df.columns or 'Credit' not in df.columns:
+            return
+        keys, shown = account_row_keys(df)
+        if accounts is not None:
+            # Numbers and names of one chart account roll up together
+            numbers = keys.map(accounts.lookup)
+            keys = numbers.where(numbers.notna(), keys)
+        rows = (~heading_mask(df) & ~keys.isin(BLANK_ACCOUNT_NUMBERS)).to_numpy()
+        if not rows.any():
+            return
+        net = (amount_column(df, 'Debit')[0] - amount_column(df, 'Credit')[0]).to_numpy()[rows]
+        keys = keys.to_numpy()[rows]
+        self.net = self.net.add(pd.Series(net).groupby(keys, sort=False).sum(), fill_value=0.0)
+        first = pd.Series(shown[rows]).groupby(keys, sort=False).first()
+        for key, cell in first.items():
+            self.shown.setdefault(key, str(cell).strip())
+
+    def merge(self, other):
+        if other is not None:
+            self.net = self.net.add(other.net, fill_value=0.0)
+            for key, cell in other.shown.items():
+                self.shown.setdefault(key, cell)
+        return self
+
+
+def sheet_rollups(sheets, accounts=None):
+    """(journal, trial) AccountRollups over every journal and trial-balance sheet."""
+    rollups = {'journal': AccountRollup(), 'trial': AccountRollup()}
+    for name, df in sheets.items():
+        kind = sheet_kind(name)
+        if kind in rollups:
+            rollups[kind].add(df, accounts)
+    return rollups['journal'], rollups['trial']
+
+
+def reconcile_rollups(journal, trial):
+    """One error per account whose trial-balance net differs from its journal entries' net.
+
+    Only compared when the workbook has both: a journal sheet and a trial-balance sheet with
+    amounts.
+    """
+    if journal.net.empty or trial.net.empty:
+        return []
+    keys = trial.net.index.append(journal.net.index.difference(trial.net.index, sort=False))
+    journal_net = journal.net.reindex(keys, fill_value=0.0)
+    trial_net = trial.net.reindex(keys, fill_value=0.0)
+    differs = ((journal_net - trial_net).abs() > 1e-2).to_numpy()
+    return [{
+        "row": None,
+        "issue": f"Trial balance for {trial.shown.get(key, journal.shown.get(key, key))} "
+                 f"({round(t, 2)}) does not match its journal entries ({round(j, 2)})"
+    } for key, t, j in zip(keys[differs].tolist(), trial_net[differs].tolist(),
+                           journal_net[differs].tolist())]
+
+
+def formula_audit_errors(df, cells=None):
+    """Suspicious formulas, ordered by row, then column. Only the formula cells are looked at.
+
+    cells: formula_cells(df), if the caller already has it.
+    """
+    labels = df.index.tolist()
+    columns = list(df.columns)
+    found = []
+    for j, rows in (formula_cells(df) if cells is None else cells).items():
+        col = columns[j]
+        for pos, val in zip(rows.tolist(), df.iloc[rows, j].tolist()):
+            idx = labels[pos]
+            # Hardcoded total (e.g., =10000)
+            if val[1:].replace('.', '', 1).isdigit():
+                found.append((pos, j, 0, f"Formula in {col} is hardcoded value: {val}"))
+            # Reference to empty cell (basic check)
+            if '""' in val or 'BLANK' in val.upper():
+                found.append((pos, j, 1, f"Formula in {col} references empty cell: {val}"))
+            # Circular reference (very basic: formula references its own row)
+            if f'{str(col)[0]}{idx+2}' in val:
+                found.append((pos, j, 2, f"Possible circular reference in {col}: {val}"))
+    found.sort(key=lambda item: item[:3])
+    return [{"row": labels[pos] + 1, "issue": issue} for pos, _, _, issue in found]
+
+
+def annotate_errors(sheet_errs):
+    """Add the 'why' explanation and the auto-repair hint to each error in place."""
+    for err in sheet_errs:
+        if 'why' not in err:
+            if 'out of balance' in err['issue'].lower():
+                err['why'] = 'Debits and credits should always match in double-entry accounting.'
+            elif 'missing value' in err['issue'].lower():
+                err['why'] = 'All required fields must be filled for accurate reporting.'
+            elif 'account-type rule violation' in err['issue'].lower():
+                err['why'] = 'This violates standard accounting rules for this account type.'
+            elif 'anomaly' in err['issue'].lower():
+                err['why'] = 'This value is statistically unusual compared to other entries.'
+            elif 'not found in Chart of Accounts' in err['issue']:
+                err['why'] = 'All accounts in entries must exist in the Chart of Accounts.'
+            elif 'does not match its journal entries' in err['issue']:
+                err['why'] = ('Each trial-balance line should equal the net of the journal entries '
+                              'posted to that account.')
+            elif 'its normal balance is' in err['issue']:
+                err['why'] = ('A balance on the opposite side of the account\'s normal balance is '
+                              'often a misposting or a misclassified account.')
+            elif 'date' in err['issue'].lower():
+                err['why'] = 'Dates should be within the expected fiscal period.'
+            else:
+                err['why'] = 'Flagged by rule-based or statistical logic.'
+        # For each fixable error, add a 'can_fix' flag and a 'fix_action' description
+        if 'missing value' in err['issue'].lower():
+            err['can_fix'] = True
+            err['fix_action'] = 'Fill with 0'
+        elif 'out of balance' in err['issue'].lower():
+            err['can_fix'] = True
+            err['fix_action'] = 'Auto-balance this row'
+        elif 'account-type rule violation' in err['issue'].lower():
+            err['can_fix'] = False
+            err['fix_action'] = 'Manual review required'
+        elif 'not found in Chart of Accounts' in err['issue']:
+            err['can_fix'] = False
+            err['fix_action'] = 'Add account to Chart of Accounts'
+        elif 'date' in err['issue'].lower():
+            err['can_fix'] = False
+            err['fix_action'] = 'Edit date to valid fiscal period'
+    return sheet_errs
+
+# --- Error store ---
+# A workbook's errors are kept in an ErrorTable: one entry per error holding the sheet,
+# the 1-based row and the issue type as small ints, plus the values that fill the type's
+# message template. /errors pages through the table with a cursor and filters by sheet,
+# issue type and row range; messages and explanations are only rebuilt for the page sent.
+
+
+# (type, message template, fixed 'why'); '{}' marks a value that varies per error
+ISSUE_TYPES = [
+    ('other', '{}', None),
+    ('missing_account_number', 'Missing Account Number', None),
+    ('missing_account_name', 'Missing Account Name', None),
+    ('missing_account_type', 'Missing Account Type', None),
+    ('duplicate_row', 'Duplicate row', None),
+    ('invalid_date', 'Invalid or missing Date', None),
+    ('unbalanced_entry', 'Debit ({}) ≠ Credit ({})', None),
+    ('missing_account', 'Missing Account', None),
+    ('negative_depreciation', 'Depreciation expense should not be negative (GAAP)', None),
+    ('revenue_debit', 'Revenue account has debit value (GAAP)', None),
+    ('equity_debit', 'Equity account should not have debit balance (GAAP)', None),
+    ('prepaid_in_pl', 'Prepaid expenses should not appear in P&L (GAAP)', None),
+    ('trial_out_of_balance',
+     'Trial balance out of balance: Debits={}, Credits={}. Difference={}. {}', None),
+    ('missing_value', 'Missing value in {}', None),
+    ('formula_present',
+     'Excel formula present in {}: {} (Check for circular refs or hardcoded totals)', None),
+    ('hardcoded_formula', 'Formula in {} is hardcoded value: {}', None),
+    ('empty_reference', 'Formula in {} references empty cell: {}', None),
+    ('circular_reference', 'Possible circular reference in {}: {}', None),
+    ('net_income_mismatch', 'Net income from Income Statement ({}) does not match change in '
+                            'Retained Earnings on Balance Sheet ({}).', None),
+    ('balance_sheet_mismatch', 'Total Assets ({}) does not equal Total Liabilities and Equity '
+                               '({}) on Balance Sheet.', None),
+    ('anomaly', ANOMALY_ISSUE, ANOMALY_WHY),
+    ('unknown_account', 'Account {} not found in Chart of Accounts', None),
+    ('abnormal_balance', 'Account {} has a {} balance; its normal balance is {}', None),
+    ('trial_journal_mismatch',
+     'Trial balance for {} ({}) does not match its journal entries ({})', None),
+]
+ISSUE_TYPE_CODES = {name: code for code, (name, _, _) in enumerate(ISSUE_TYPES)}
+LITERAL_ISSUES = {template: code for code, (_, template, _) in enumerate(ISSUE_TYPES)
+                  if '{}' not in template}
+ISSUE_PATTERNS = [
+    (code, re.compile('(.*?)'.join(re.escape(part) for part in template.split('{}')) + r'\Z', re.S))
+    for code, (_, template, _) in enumerate(ISSUE_TYPES) if code and '{}' in template
+]
+NO_ROW = -1  # row of sheet-level errors (row None)
+
+
+@functools.lru_cache(maxsize=65536)
+def classify_issue(issue):
+    """(issue type code, template args) for an error message; unknown messages are 'other'."""
+    code = LITERAL_ISSUES.get(issue)
+    if code is not None:
+        return code, ()
+    for code, pattern in ISSUE_PATTERNS:
+        match = pattern.match(issue)
+        # A value that itself contains template text could split differently; only keep
+        # exact round trips
+        if match and ISSUE_TYPES[code][1].format(*match.groups()) == issue:
+            return code, match.groups()
+    return 0, (issue,)
+
+
+def error_counts(errors):
+    """{sheet: {issue type: count}} for an /upload-style {sheet: [errors]} payload."""
+    counts = {}
+    for name, errs in errors.items():
+        by_type = Counter(ISSUE_TYPES[classify_issue(err['issue'])[0]][0] for err in errs)
+        if by_type:
+            counts[name] = dict(by_type)
+    return counts
+
+
+class ErrorTable:
+    """A workbook's errors as parallel columns; replaced rows are tombstoned, compacted lazily."""
+
+    def __init__(self, errors=None):
+        self.sheet_names = []  # sheet code -> name
+        self.sheet = np.empty(0, dtype=np.int16)
+        self.row = np.empty(0, dtype=np.int64)
+        self.code = np.empty(0, dtype=np.int16)
+        # Insertion order; stable across compaction, so cursors stay valid
+        self.seq = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.args = []
+        self._next_seq = 0
+        self._order = None  # live positions sorted by (sheet, row, seq)
+        for name, errs in (errors or {}).items():
+            self.extend(name, errs)
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def sheet_code(self, name):
+        if name not in self.sheet_names:
+            self.sheet_names.append(name)
+        return self.sheet_names.index(name)
+
+    def extend(self, name, errors):
+        sheet = self.sheet_code(name)
+        if not errors:
+            return
+        classified = [classify_issue(err['issue']) for err in errors]
+        n = len(errors)
+        self.sheet = np.concatenate([self.sheet, np.full(n, sheet, dtype=np.int16)])
+        rows = [NO_ROW if err['row'] is None else err['row'] for err in errors]
+        self.row = np.concatenate([self.row, np.array(rows, dtype=np.int64)])
+        codes = [code for code, _ in classified]
+        self.code = np.concatenate([self.code, np.array(codes, dtype=np.int16)])
+        seq = np.arange(self._next_seq, self._next_seq + n, dtype=np.int64)
+        self.seq = np.concatenate([self.seq, seq])
+        self.alive = np.concatenate([self.alive, np.ones(n, dtype=bool)])
+        self.args.extend(args for _, args in classified)
+        self._next_seq += n
+        self._order = None
+
+    def errors(self, positions, with_sheet=False):
+        """The errors at positions as annotated /upload-style dicts."""
+        errs = []
+        for pos in np.asarray(positions).tolist():
+            name, template, why = ISSUE_TYPES[self.code[pos]]
+            row = int(self.row[pos])
+            err = {"row": None if row == NO_ROW else row, "issue": template.format(*self.args[pos])}
+            if with_sheet:
+                err = {"sheet": self.sheet_names[self.sheet[pos]], "type": name, **err}
+            if why:
+                err['why'] = why
+            errs.append(err)
+        return annotate_errors(errs)
+
+    def by_row(self, name, rows):
+        """{row: [errors]} for the given rows (None for sheet-level errors) of one sheet."""
+        if name not in self.sheet_names:
+            return {}
+        keys = np.array([NO_ROW if row is None else row for row in rows], dtype=np.int64)
+        mask = self.alive & (self.sheet == self.sheet_names.index(name)) & np.isin(self.row, keys)
+        return group_errors_by_row(self.errors(np.flatnonzero(mask)))
+
+    def replace_rows(self, name, updates):
+        """Swap the errors of each row in updates ({row: [errors]}) for the new list."""
+        if not updates:
+            return
+        sheet = self.sheet_code(name)
+        keys = np.array([NO_ROW if row is None else row for row in updates], dtype=np.int64)
+        self.alive[(self.sheet == sheet) & np.isin(self.row, keys)] = False
+        self.extend(name, [err for errs in updates.values() for err in errs])
+        self._order = None
+        if len(self.alive) > 1024 and self.alive.sum() * 2 < len(self.alive):
+            self.compact()
+
+    def compact(self):
+        keep = self.alive
+        self.sheet, self.row = self.sheet[keep], self.row[keep]
+        self.code, self.seq = self.code[keep], self.seq[keep]
+        self.args = [args for args, live in zip(self.args, keep.tolist()) if live]
+        self.alive = np.ones(len(self.sheet), dtype=bool)
+        self._order = None
+
+    def order(self):
+        if self._order is None:
+            live = np.flatnonzero(self.alive)
+            self._order = live[np.lexsort((self.seq[live], self.row[live], self.sheet[live]))]
+        return self._order
+
+    def select(self, sheets=None, types=None, row_min=None, row_max=None):
+        """Boolean mask of live errors matching every given filter.
+
+        Row bounds exclude sheet-level errors.
+        """
+        mask = self.alive.copy()
+        if sheets is not None:
+            mask &= np.isin(self.sheet, [self.sheet_names.index(name) for name in sheets
+                                         if name in self.sheet_names])
+        if types is not None:
+            mask &= np.isin(self.code, [ISSUE_TYPE_CODES[name] for name in types
+                                        if name in ISSUE_TYPE_CODES])
+        if row_min is not None:
+            mask &= self.row >= row_min
+        if row_max is not None:
+            mask &= (self.row <= row_max) & (self.row != NO_ROW)
+        return mask
+
+    def page(self, mask, cursor=None, limit=100):
+        """(positions, next cursor) of up to limit selected errors in (sheet, row) order after
+        cursor."""
+        selected = self.order()
+        selected = selected[mask[selected]]
+        if cursor is not None:
+            sheet, row, seq = cursor
+            s, r, q = self.sheet[selected], self.row[selected], self.seq[selected]
+            after = (s > sheet) | ((s == sheet) & ((r > row) | ((r == row) & (q > seq))))
+            selected = selected[after]
+        positions = selected[:limit]
+        if len(selected) <= limit:
+            return positions, None
+        last = positions[-1]
+        return positions, f'{self.sheet[last]}.{self.row[last]}.{self.seq[last]}'
+
+    def counts(self, mask):
+        """{sheet: {issue type: count}} over the selected errors."""
+        n_types = len(ISSUE_TYPES)
+        combined = self.sheet[mask].astype(np.int64) * n_types + self.code[mask]
+        bins = np.bincount(combined, minlength=len(self.sheet_names) * n_types).reshape(-1, n_types)
+        return {
+            self.sheet_names[sheet]: {ISSUE_TYPES[code][0]: int(bins[sheet, code])
+                                      for code in np.flatnonzero(bins[sheet]).tolist()}
+            for sheet in np.flatnonzero(bins.sum(axis=1)).tolist()
+        }
+
+
+ERRORS_PAGE_SIZE = int(os.environ.get('LEDGERLIFT_ERRORS_PAGE_SIZE', 100))
+ERRORS_MAX_PAGE_SIZE = 1000
+UPLOAD_SUMMARY_ERRORS = int(os.environ.get('LEDGERLIFT_UPLOAD_SUMMARY_ERRORS', 20))
+
+
+def parse_error_cursor(cursor):
+    try:
+        sheet, row, seq = (int(part) for part in cursor.split('.'))
+    except (AttributeError, ValueError):
+        return None
+    return sheet, row, seq
+
+# --- Incremental revalidation ---
+# /edit-cell and /bulk-fix record which rows they touched (with the old cell values) on the
+# workbook. /revalidate re-runs the row-level checks for just those rows and updates the
+# trial-balance suspicious rows, duplicate groups and cross-sheet key lines by delta, so an
+# interactive edit costs O(changed rows) instead of O(workbook); only the trial balance's
+# two column sums are taken again.
+
+
+def row_level_errors(name, df, plan=AUDIT_PLAN, accounts=None):
+    """Errors that depend only on each row's own cells (and the chart's accounts), by row."""
+    kind = sheet_kind(name)
+    if kind == 'chart':
+        errors = chart_row_errors(df, plan)
+    elif kind == 'journal':
+        errors = validate_journal_sheet(df, name, plan, accounts)
+    elif kind == 'trial':
+        errors = trial_row_errors(df, plan, accounts)
+    elif kind == 'statement':
+        cells = formula_cells(df)
+        errors = validate_statement_sheet(df, plan, cells)
+    else:
+        errors = []
+    if audits_formulas(name, plan):
+        errors = errors + formula_audit_errors(df, cells if kind == 'statement' else None)
+    return errors
+
+
+def group_errors_by_row(errors):
+    grouped = {}
+    for err in errors:
+        grouped.setdefault(err['row'], []).append(err)
+    return grouped
+
+
+def row_key(values):
+    return tuple(None if pd.isna(v) else v for v in values)
+
+
+class DuplicateIndex:
+    """Rows grouped by their values; every row after the first of a group is a duplicate."""
+
+    def __init__(self, df):
+        self.keys = {}  # label -> key
+        self.groups = {}  # key -> labels in row order
+        for label, values in zip(df.index.tolist(), df.itertuples(index=False, name=None)):
+            key = row_key(values)
+            self.keys[label] = key
+            self.groups.setdefault(key, []).append(label)
+
+    def is_duplicate(self, label):
+        return self.groups[self.keys[label]][0] != label
+
+    def update(self, df, labels, removed):
+        """Re-key the touched rows; returns the live labels whose duplicate status may have
+        changed."""
+        affected = set()
+        for label in set(labels) | set(removed):
+            key = self.keys.pop(label, None)
+            if key is not None:
+                group = self.groups[key]
+                group.remove(label)
+                affected.update(group)
+                if not group:
+                    del self.groups[key]
+        affected.difference_update(removed)
+        for label in labels:
+            key = row_key(df.loc[label].tolist())
+            self.keys[label] = key
+            group = self.groups.setdefault(key, [])
+            group.append(label)
+            if len(group) > 1:
+                group.sort(key=df.index.get_loc)
+            affected.update(group)
+        return affected
+
+
+class TrialTotals:
+    """Suspicious rows for one trial balance sheet. The Debit/Credit totals are summed again
+    on each check, so they carry the same dtype and rounding as a full validation."""
+
+    def __init__(self, df):
+        self.suspicious = set(df.index[trial_suspicious_mask(df).to_numpy()].tolist())
+
+    def update(self, df, labels, removed):
+        self.suspicious.difference_update(set(labels) | set(removed))
+        if labels:
+            subset = df.loc[labels]
+            self.suspicious.update(subset.index[trial_suspicious_mask(subset).to_numpy()].tolist())
+
+    def error(self, df):
+        top = heapq.nsmallest(3, self.suspicious, key=df.index.get_loc)
+        debit = pd.to_numeric(df['Debit'], errors='coerce').sum()
+        credit = pd.to_numeric(df['Credit'], errors='coerce').sum()
+        return trial_balance_error(debit, credit, [label + 1 for label in top])
+
+
+class ValidationState:
+    """Aggregates kept alongside a workbook's errors so edits can be applied by delta."""
+
+    def __init__(self, sheets):
+        self.key_lines = {}
+        self.duplicates = {}
+        self.trial_totals = {}
+        self.rollups = {}  # journal/trial sheet -> AccountRollup, filled when first reconciled
+        for name, df in sheets.items():
+            labels = key_line_labels(name, df)
+            if labels:
+                self.key_lines[name] = labels
+            kind = sheet_kind(name)
+            if kind == 'chart':
+                self.duplicates[name] = DuplicateIndex(df)
+            elif kind == 'trial' and 'Debit' in df.columns and 'Credit' in df.columns:
+                self.trial_totals[name] = TrialTotals(df)
+
+
+def record_cell_change(workbook, sheet, label, column, old_value):
+    cells = workbook.pending_cells.setdefault(sheet, {}).setdefault(label, {})
+    # Keep the value from before the first edit since the last validation
+    cells.setdefault(column, old_value)
+
+
+def record_removed_rows(workbook, sheet, removed):
+    """removed: {row label: row values} for rows about to be dropped."""
+    pending = workbook.pending_removed.setdefault(sheet, {})
+    for label, values in removed.items():
+        pending.setdefault(label, values)
+
+
+def diff_errors(stale, fresh):
+    """(added, removed) between two error lists, matching on (row, issue)."""
+    stale_keys = Counter((e['row'], e['issue']) for e in stale)
+    fresh_keys = Counter((e['row'], e['issue']) for e in fresh)
+    added = []
+    for err in fresh:
+        key = (err['row'], err['issue'])
+        if stale_keys[key] > 0:
+            stale_keys[key] -= 1
+        else:
+            added.append(err)
+    removed = []
+    for err in stale:
+        key = (err['row'], err['issue'])
+        if fresh_keys[key] > 0:
+            fresh_keys[key] -= 1
+        else:
+            removed.append(err)
+    return added, removed
+
+
+def replace_row_errors(current, updates, row, fresh, keep=lambda err: False):
+    """Queue fresh errors for one row (or row None) in updates.
+
+    Returns (added, removed) against current.
+    """
+    existing = current.get(row, [])
+    kept = [err for err in existing if keep(err)]
+    stale = [err for err in existing if not keep(err)]
+    updates[row] = fresh + kept
+    return diff_errors(stale, fresh)
+
+
+def cached_rollups(workbook, accounts, edited):
+    """sheet_rollups() that rolls up again only the edited sheets and reuses the others'."""
+    state = workbook.validation
+    rollups = {'journal': AccountRollup(), 'trial': AccountRollup()}
+    for name, df in workbook.sheets.items():
+        kind = sheet_kind(name)
+        if kind not in rollups:
+            continue
+        if name in edited or name not in state.rollups:
+            state.rollups[name] = AccountRollup()
+            state.rollups[name].add(df, accounts)
+        rollups[kind].merge(state.rollups[name])
+    return rollups['journal'], rollups['trial']
+
+
+def revalidate_workbook(workbook):
+    """Apply the pending edits to the workbook's errors; returns ({sheet: diff}, rows checked)."""
+    state = workbook.validation
+    plan = workbook.plan
+    changes = {}
+    rows_checked = 0
+    key_lines_dirty = False
+    pending = set(workbook.pending_cells) | set(workbook.pending_removed)
+    accounts = None
+    recheck = set()  # sheets re-checked in full: their accounts resolve against an edited chart
+    if plan.enabled(*ACCOUNT_INDEX_TYPES):
+        chart_edited = any(sheet_kind(name) == 'chart' for name in pending)
+        accounts = workbook.account_index(rebuild=chart_edited)
+        if chart_edited:
+            recheck = {name for name in workbook.sheets if sheet_kind(name) in ('journal', 'trial')}
+
+    def add_change(sheet, added, removed):
+        if added or removed:
+            change = changes.setdefault(sheet, {"added": [], "removed": []})
+            change["added"].extend(annotate_errors(added))
+            change["removed"].extend(removed)
+
+    for name in pending | recheck:
+        df = workbook.sheets.get(name)
+        if df is None:
+            continue
+        old_cells = workbook.pending_cells.get(name, {})
+        removed = workbook.pending_removed.get(name, {})
+        live = [label for label in set(old_cells) | set(removed) if label in df.index]
+        live.sort(key=df.index.get_loc)
+        rows = set(df.index) if name in recheck else set(live)
+        if name in state.duplicates:
+            rows |= state.duplicates[name].update(df, live, removed)
+        rows = sorted(rows, key=df.index.get_loc)
+        rows_checked += len(rows)
+        gone = [label for label in removed if label not in df.index]
+        current = workbook.errors.by_row(name, [label + 1 for label in rows + gone] + [None])
+        updates = {}
+        fresh = group_errors_by_row(row_level_errors(name, df.loc[rows], plan, accounts))
+        for label in rows:
+            row_fresh = fresh.get(label + 1, [])
+            if (name in state.duplicates and plan.enabled('duplicate_row')
+                    and state.duplicates[name].is_duplicate(label)):
+                row_fresh.append({"row": label + 1, "issue": "Duplicate row"})
+            # Anomaly flags come from a whole-batch model fit and are not recomputed here
+            add_change(name, *replace_row_errors(current, updates, label + 1, row_fresh,
+                                                 keep=lambda err: err['issue'] == ANOMALY_ISSUE))
+        for label in gone:
+            add_change(name, *replace_row_errors(current, updates, label + 1, []))
+        if name in state.trial_totals:
+            totals = state.trial_totals[name]
+            totals.update(df, live, removed)
+            error = totals.error(df) if plan.enabled('trial_out_of_balance') else None
+            add_change(name, *replace_row_errors(
+                current, updates, None, [error] if error else [],
+                keep=lambda err: 'out of balance' not in err['issue']))
+        workbook.errors.replace_rows(name, updates)
+        if name in state.key_lines:
+            key_lines = state.key_lines[name]
+            touched = set(live) | set(removed)
+            acc = str_column(df.loc[live], 'Account').str.strip().str.lower()
+            for key, labels in key_lines.items():
+                matches = set(df.loc[live].index[acc.isin(KEY_LINES[key][1]).to_numpy()].tolist())
+                kept = [label for label in labels if label not in touched]
+                if matches:
+                    kept = sorted(kept + list(matches), key=df.index.get_loc)
+                key_lines[key] = kept
+            key_lines_dirty = True
+    key_lines_dirty = (key_lines_dirty
+                       and plan.enabled('net_income_mismatch', 'balance_sheet_mismatch'))
+    rollups_dirty = (plan.enabled('trial_journal_mismatch')
+                     and any(sheet_kind(name) in ('journal', 'trial', 'chart') for name in pending))
+    if key_lines_dirty or rollups_dirty:
+        # Cross-Sheet errors are replaced as a whole, so both reconciliations are redone
+        fresh = []
+        if plan.enabled('net_income_mismatch', 'balance_sheet_mismatch'):
+            fresh = reconcile_key_lines(key_line_values(workbook.sheets, state.key_lines))
+        if plan.enabled('trial_journal_mismatch'):
+            fresh += reconcile_rollups(*cached_rollups(workbook, accounts, pending | recheck))
+        updates = {}
+        current = workbook.errors.by_row('Cross-Sheet', [None])
+        add_change('Cross-Sheet', *replace_row_errors(current, updates, None, fresh))
+        workbook.errors.replace_rows('Cross-Sheet', updates)
+    workbook.pending_cells = {}
+    workbook.pending_removed = {}
+    return changes, rows_checked
+
+# --- Bulk fixes ---
+# Every fix is a mask over the stored sheet: rows to drop, cells to fill, rows to balance.
+# The masks are computed in the order the fixes apply (duplicates go first and balancing
+# sees filled amounts), so /bulk-fix-preview reports exactly what /bulk-fix would change
+# without building the fixed frame. /bulk-fix then assigns through the masks on the
+# stored frame; dropping rows is the only copy, and under copy-on-write that copy
+# shares column buffers until a fill or balance writes to the column.
+
+
+def float_assignable(series):
+    """series in a dtype that takes float values without an upcast error."""
+    if pd.api.types.is_float_dtype(series) or pd.api.types.is_object_dtype(series):
+        return series
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(float)
+    return series.astype(object)
+
+
+# pandas 3 copies a column that a shallow copy shares before writing into it. pandas 2
+# writes in place unless the deployment turned mode.copy_on_write on, so there the
+# in-place writers give the sheet its own copy of the column first.
+COPY_ON_WRITE = int(pd.__version__.split('.')[0]) >= 3
+
+
+def own_column(df, column):
+    """Make df's column safe to write in place for an export_snapshot() taken earlier."""
+    if not COPY_ON_WRITE and pd.options.mode.copy_on_write is not True:
+        df[column] = df[column].copy()
+
+
+class BulkFixPlan:
+    """The rows and cells a comma-separated set of bulk fixes would change on one sheet."""
+
+    def __init__(self, df, fixes):
+        self.fixes = fixes
+        n = len(df)
+        self.drop = np.zeros(n, dtype=bool)
+        if 'remove-duplicates' in fixes:
+            self.drop = df.duplicated().to_numpy()
+        keep = ~self.drop
+        self.fill = {}  # column -> rows holding a missing value
+        if 'fill-missing' in fixes:
+            for col in df.columns:
+                mask = df[col].isnull().to_numpy() & keep
+                if mask.any():
+                    self.fill[col] = mask
+        self.raise_debit = np.zeros(n, dtype=bool)
+        self.raise_credit = np.zeros(n, dtype=bool)
+        self.balanced_to = None
+        if 'auto-balance' in fixes and 'Debit' in df.columns and 'Credit' in df.columns:
+            # Blank amounts count as 0; after fill-missing so do NaNs
+            debit, _ = amount_column(df, 'Debit')
+            credit, _ = amount_column(df, 'Credit')
+            if 'Debit' in self.fill:
+                debit = debit.mask(self.fill['Debit'], 0.0)
+            if 'Credit' in self.fill:
+                credit = credit.mask(self.fill['Credit'], 0.0)
+            diff = (debit - credit).to_numpy()
+            # Differences of at most a cent are rounding: the smaller side takes the larger amount
+            small = keep & (np.abs(diff) <= 1e-2) & (diff != 0)
+            self.raise_credit = small & (diff > 0)
+            self.raise_debit = small & (diff < 0)
+            self.balanced_to = np.fmax(debit.to_numpy(), credit.to_numpy())
+
+    def removed(self):
+        return int(self.drop.sum())
+
+    def filled(self):
+        return int(sum(mask.sum() for mask in self.fill.values()))
+
+    def balanced(self):
+        return int(self.raise_debit.sum() + self.raise_credit.sum())
+
+    def summary(self, preview=False):
+        lines = []
+        if 'remove-duplicates' in self.fixes:
+            lines.append(f"Would remove {self.removed()} duplicate rows." if preview
+                         else f"Removed {self.removed()} duplicate rows.")
+        if 'fill-missing' in self.fixes:
+            lines.append(f"Would fill {self.filled()} missing values with 0." if preview
+                         else f"Filled {self.filled()} missing values with 0.")
+        if self.balanced_to is not None:
+            lines.append(f"Would auto-balance {self.balanced()} small rounding errors (≤ 1 cent)."
+                         if preview else "Auto-balanced small rounding errors (≤ 1 cent).")
+        return lines
+
+    def cell_writes(self, df):
+        """[(column, row labels, old values, new values)], one group per column and fix, in write
+        order."""
+        writes = []
+        for col, mask in self.fill.items():
+            writes.append((col, df.index[mask].tolist(), df[col].to_numpy()[mask],
+                           np.zeros(mask.sum(), dtype=int)))
+        for col, mask in (('Debit', self.raise_debit), ('Credit', self.raise_credit)):
+            if mask.any():
+                # A cell that was filled first is written again; the fill group already holds
+                # its old value
+                old = df[col].to_numpy()[mask]
+                if col in self.fill:
+                    old = np.where(self.fill[col][mask], 0, old)
+                writes.append((col, df.index[mask].tolist(), old, self.balanced_to[mask]))
+        return writes
+
+    def removed_rows(self, df):
+        """{row label: row values} of the rows apply() drops."""
+        dropped = df[self.drop]
+        return dict(zip(dropped.index.tolist(), dropped.to_dict(orient='records')))
+
+    def apply(self, df):
+        """The fixed sheet. Writes go to df itself unless rows are dropped."""
+        keep = ~self.drop
+        if self.drop.any():
+            df = df.take(np.flatnonzero(keep))
+        for col in self.fill:
+            df[col] = df[col].fillna(0)
+        for col, mask in (('Debit', self.raise_debit[keep]), ('Credit', self.raise_credit[keep])):
+            if mask.any():
+                df[col] = float_assignable(df[col])
+                own_column(df, col)
+                df.loc[mask, col] = self.balanced_to[keep][mask]
+        return df
+
+
+# --- Change journal ---
+# /edit-cell and /bulk-fix record what they changed as deltas: the positions and values
+# of dropped rows, and per column the row labels with the old and new cell values. Undo
+# and redo replay deltas on the stored frames, so a version costs memory in proportion
+# to its change. At most LEDGERLIFT_MAX_VERSIONS changes are kept per workbook.
+MAX_VERSIONS = int(os.environ.get('LEDGERLIFT_MAX_VERSIONS', 100))
+
+
+def write_cells(df, column, labels, values):
+    # Deltas hold object arrays; numeric columns get the narrowest dtype so int/float stay
+    # typed, while string columns only take NaN from an object array
+    values = pd.Series(values, dtype=object)
+    if pd.api.types.is_numeric_dtype(df[column]):
+        values = values.infer_objects()
+    values = values.to_numpy()
+    own_column(df, column)
+    try:
+        df.loc[labels, column] = values
+    except (TypeError, ValueError):
+        # pandas 3 refuses values a typed column cannot hold: numbers widen an int column to
+        # float, as pandas 2 did with a warning, and anything else falls back to object
+        numeric = pd.api.types.is_integer_dtype(df[column]) and values.dtype.kind in 'iuf'
+        df[column] = df[column].astype(float if numeric else object)
+        df.loc[labels, column] = values
+
+
+def cast_column(df, column, dtype):
+    try:
+        df[column] = df[column].astype(dtype)
+    except (TypeError, ValueError):
+        pass  # e.g. a restored NaN cannot go back into an int column
+
+
+class SheetDelta:
+    """One sheet's part of a change: dropped rows, cell writes in order and column dtype changes."""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.removed_positions = None  # positions of the dropped rows before the change
+        self.removed_rows = None  # those rows, as a DataFrame
+        self.cells = []  # (column, row labels, old values, new values)
+        self.dtypes = {}  # column -> (dtype before, dtype after)
+
+    def __bool__(self):
+        return self.removed_rows is not None or bool(self.cells) or bool(self.dtypes)
+
+    def remove_rows(self, df, positions):
+        self.removed_positions = np.asarray(positions, dtype=np.int64)
+        self.removed_rows = df.take(self.removed_positions)
+
+    def write(self, column, labels, old, new):
+        if len(labels):
+            self.cells.append((column, np.asarray(labels), np.asarray(old, dtype=object),
+                               np.asarray(new, dtype=object)))
+
+    def note_dtypes(self, before, after):
+        for column in after.columns:
+            if column in before.index and before[column] != after[column].dtype:
+                self.dtypes[column] = (before[column], after[column].dtype)
+
+    def cell_count(self):
+        return sum(len(labels) for _, labels, _, _ in self.cells)
+
+    def undo(self, workbook):
+        df = workbook.sheets[self.sheet]
+        for column, labels, old, _ in reversed(self.cells):
+            replay_cells(workbook, self.sheet, df, column, labels, old)
+        for column, (before, _) in self.dtypes.items():
+            cast_column(df, column, before)
+        if self.removed_rows is not None:
+            n = len(df) + len(self.removed_positions)
+            kept_positions = np.setdiff1d(np.arange(n), self.removed_positions)
+            order = np.argsort(np.concatenate([kept_positions, self.removed_positions]),
+                               kind='stable')
+            df = pd.concat([df, self.removed_rows]).take(order)
+            pending = workbook.pending_removed.get(self.sheet, {})
+            for label in self.removed_rows.index.tolist():
+                # Back as it was before the last validation, or new to it
+                if pending.pop(label, None) is None:
+                    for column in df.columns:
+                        record_cell_change(workbook, self.sheet, label, column, None)
+        workbook.sheets[self.sheet] = df
+
+    def redo(self, workbook):
+        df = workbook.sheets[self.sheet]
+        if self.removed_rows is not None:
+            rows = self.removed_rows.to_dict(orient='records')
+            record_removed_rows(workbook, self.sheet,
+                                dict(zip(self.removed_rows.index.tolist(), rows)))
+            keep = np.ones(len(df), dtype=bool)
+            keep[self.removed_positions] = False
+            df = df.take(np.flatnonzero(keep))
+        for column, (_, after) in self.dtypes.items():
+            cast_column(df, column, after)
+        for column, labels, _, new in self.cells:
+            replay_cells(workbook, self.sheet, df, column, labels, new)
+        workbook.sheets[self.sheet] = df
+
+
+def replay_cells(workbook, sheet, df, column, labels, values):
+    for label, value in zip(labels.tolist(), df.loc[labels, column].tolist()):
+        record_cell_change(workbook, sheet, label, column, value)
+    write_cells(df, column, labels, values)
+
+
+class ChangeSet:
+    """One journaled action: the per-sheet deltas of an /edit-cell or /bulk-fix call."""
+
+    def __init__(self, action, details, deltas):
+        self.action = action
+        self.details = details
+        self.deltas = deltas
+        self.time = time.time()
+
+    def summary(self, version):
+        return {
+            "version": version,
+            "action": self.action,
+            "details": self.details,
+            "sheets": [delta.sheet for delta in self.deltas],
+            "cells_changed": sum(delta.cell_count() for delta in self.deltas),
+            "rows_removed": sum(len(delta.removed_positions) for delta in self.deltas
+                                if delta.removed_positions is not None),
+            "time": self.time,
+        }
+
+
+class ChangeJournal:
+    """Undo/redo history of a workbook. Version 0 is the upload; change i leads to version i."""
+
+    def __init__(self, max_versions=MAX_VERSIONS):
+        self.max_versions = max_versions
+        self.changes = []
+        self.base = 0  # version before changes[0]; older changes were dropped
+        self.version = 0
+
+    def record(self, change):
+        del self.changes[self.version - self.base:]  # a new change discards the redo branch
+        self.changes.append(change)
+        self.version += 1
+        if len(self.changes) > self.max_versions:
+            self.changes.pop(0)
+            self.base += 1
+
+    def oldest(self):
+        return self.base
+
+    def latest(self):
+        return self.base + len(self.changes)
+
+    def goto(self, workbook, version):
+        """Undo or redo changes until the workbook is at version; returns the sheets touched."""
+        touched = set()
+        while self.version > version:
+            change = self.changes[self.version - self.base - 1]
+            for delta in reversed(change.deltas):
+                delta.undo(workbook)
+                touched.add(delta.sheet)
+            self.version -= 1
+        while self.version < version:
+            change = self.changes[self.version - self.base]
+            for delta in change.deltas:
+                delta.redo(workbook)
+                touched.add(delta.sheet)
+            self.version += 1
+        return touched
+
+    def history(self):
+        return [change.summary(self.base + i + 1) for i, change in enumerate(self.changes)]
+
+
+# --- Audit log ---
+# log_audit() only appends a record to an in-memory batch; a writer thread per log file
+# writes the batch every LEDGERLIFT_AUDIT_FLUSH_SECONDS or once LEDGERLIFT_AUDIT_FLUSH_RECORDS
+# records are waiting, so handlers never open a file. Records are JSON lines ("ts" first,
+# UTC ISO-8601, plus the request id from the X-Request-ID middleware and the workbook id).
+# A file over LEDGERLIFT_AUDIT_MAX_BYTES is rotated to audit.log.1 ... audit.log.N
+# (LEDGERLIFT_AUDIT_BACKUPS). Every server worker appends to the same files, so appending
+# and rotating take an flock on audit.log.lock. One worker's records are in timestamp
+# order, and while a file stays that way GET /audit-log finds the start of a time range by
+# binary search over byte offsets and reads only the range. A batch older than the end of
+# the file it is appended to (another worker wrote in between) marks the file with an
+# .unsorted file, which moves with it on rotation; marked files are read whole and their
+# matches sorted. /feedback goes through a second AuditLog for feedback.log.
+AUDIT_LOG_PATH = os.environ.get('LEDGERLIFT_AUDIT_LOG', 'audit.log')
+FEEDBACK_LOG_PATH = os.environ.get('LEDGERLIFT_FEEDBACK_LOG', 'feedback.log')
+AUDIT_FLUSH_SECONDS = float(os.environ.get('LEDGERLIFT_AUDIT_FLUSH_SECONDS', 1.0))
+AUDIT_FLUSH_RECORDS = int(os.environ.get('LEDGERLIFT_AUDIT_FLUSH_RECORDS', 500))
+AUDIT_MAX_BYTES = int(os.environ.get('LEDGERLIFT_AUDIT_MAX_BYTES', 10 * 1024 * 1024))
+AUDIT_BACKUPS = int(os.environ.get('LEDGERLIFT_AUDIT_BACKUPS', 5))
+AUDIT_QUERY_LIMIT = 1000
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+
+def audit_timestamp(when=None):
+    """UTC ISO-8601 to the millisecond; timestamps in this form sort as strings."""
+    when = (when or datetime.now(timezone.utc)).astimezone(timezone.utc)
+    return when.isoformat(timespec='milliseconds')
+
+
+def record_ts(line):
+    try:
+        return json.loads(line)['ts']
+    except (ValueError, KeyError, TypeError):
+        return ''
+
+
+class AuditLog:
+    """A JSON-lines file written in batches by a background thread and rotated by size."""
+
+    def __init__(self, path, flush_seconds=AUDIT_FLUSH_SECONDS, flush_records=AUDIT_FLUSH_RECORDS,
+                 max_bytes=AUDIT_MAX_BYTES, backups=AUDIT_BACKUPS):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.flush_records = flush_records
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._pending = []
+        self._cond = threading.Condition()
+        self._file_lock = threading.Lock()  # see _locked()
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def write(self, record):
+        """Queue record, stamped with the time and the current request id."""
+        with self._cond:
+            self._pending.append({"ts": audit_timestamp(), "request_id": request_id_var.get(),
+                                  **record})
+            if self._thread is None or self._closed:
+                self._start()
+            if len(self._pending) >= self.flush_records:
+                self._cond.notify()
+
+    def _start(self):
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f'audit-writer:{os.path.basename(self.path)}')
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.flush_records,
+                    timeout=self.flush_seconds)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        """Held while a batch is written or the files are read: a lock for this process's
+        threads and, with fcntl, an flock for the other workers."""
+        with self._file_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(f'{self.path}.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                yield
+
+    def flush(self):
+        """Write whatever is queued now."""
+        with self._cond:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        data = ''.join(json.dumps(record, default=str, ensure_ascii=False) + '\n'
+                       for record in batch).encode('utf-8')
+        try:
+            with self._locked():
+                self._rotate(len(data))
+                if batch[0]['ts'] < self._last_ts(self.path):
+                    open(f'{self.path}.unsorted', 'a').close()
+                with open(self.path, 'ab') as f:
+                    f.write(data)
+        except OSError:
+            logging.getLogger("audit").exception(
+                f"Could not write {len(batch)} record(s) to {self.path}")
+
+    @staticmethod
+    def _last_ts(path, window=64 * 1024):
+        """The "ts" of the last record in path that has one near its end, or ''."""
+        try:
+            with open(path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - window))
+                tail = f.read().splitlines()
+        except FileNotFoundError:
+            return ''
+        return next(filter(None, map(record_ts, reversed(tail))), '')
+
+    def close(self):
+        """Stop the writer thread after it has written everything queued."""
+        with self._cond:
+            thread, self._closed = self._thread, True
+            self._cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def _rotate(self, incoming):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        if size == 0 or size + incoming <= self.max_bytes:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                self._replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            self._replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+            self._remove_marker(self.path)
+
+    @staticmethod
+    def _remove_marker(path):
+        try:
+            os.remove(f'{path}.unsorted')
+        except FileNotFoundError:
+            pass
+
+    def _replace(self, src, dst):
+        """os.replace for a log file; its .unsorted marker, or the lack of one, goes along."""
+        os.replace(src, dst)
+        if os.path.exists(f'{src}.unsorted'):
+            os.replace(f'{src}.unsorted', f'{dst}.unsorted')
+        else:
+            self._remove_marker(dst)
+
+    def segments(self):
+        """The log's files, oldest first."""
+        paths = [f'{self.path}.{i}' for i in range(self.backups, 0, -1)] + [self.path]
+        return [path for path in paths if os.path.exists(path)]
+
+    @staticmethod
+    def _first_at(f, ts):
+        """Offset of the first line of f whose "ts" is >= ts (the file's size if none is)."""
+        def line_start(pos):
+            if pos == 0:
+                return 0
+            f.seek(pos - 1)
+            f.readline()
+            return f.tell()
+
+        def at_or_after(pos):
+            # A line without a readable "ts" (a torn write) counts as the next line that has one
+            f.seek(line_start(pos))
+            for line in f:
+                line_ts = record_ts(line)
+                if line_ts:
+                    return line_ts >= ts
+            return True
+
+        f.seek(0, os.SEEK_END)
+        lo, hi = 0, f.tell()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if at_or_after(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return line_start(lo)
+
+    def query(self, actions=(), since=None, until=None, workbook_id=None, limit=100):
+        """(records, truncated): records with since <= ts < until, oldest first, at most limit.
+
+        since and until are audit_timestamp() strings; actions, if given, filters by action.
+        """
+        self.flush()
+        records = []
+        with self._locked(shared=True):
+            for path in self.segments():
+                with open(path, 'rb') as f:
+                    for record in self._records_between(f, since, until):
+                        if actions and record.get('action') not in actions:
+                            continue
+                        if workbook_id and record.get('workbook_id') != workbook_id:
+                            continue
+                        if len(records) == limit:
+                            return records, True
+                        records.append(record)
+        return records, False
+
+    def _records_between(self, f, since, until):
+        """The records of one log file with since <= ts < until, oldest first."""
+        def records():
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+        if os.path.exists(f'{f.name}.unsorted'):
+            # Batches of several workers interleave in this file: read it whole
+            matches = [record for record in records()
+                       if (not since or record.get('ts', '') >= since)
+                       and (not until or record.get('ts', '') < until)]
+            yield from sorted(matches, key=lambda record: record.get('ts', ''))
+            return
+        f.seek(self._first_at(f, since) if since else 0)
+        for record in records():
+            if until and record.get('ts', '') >= until:
+                return
+            yield record
+
+
+audit_log = AuditLog(AUDIT_LOG_PATH)
+feedback_log = AuditLog(FEEDBACK_LOG_PATH)
+
+
+def log_audit(action, details=None, user=None, workbook_id=None):
+    """Queue an audit record; returns at once, the writer thread puts it on disk."""
+    record = {"action": action, "workbook_id": workbook_id, "user": user, "details": details}
+    audit_log.write({key: value for key, value in record.items() if value is not None})
+
+
+def audit_bound(text):
+    """A since/until query value (ISO-8601, naive meaning UTC, or epoch seconds) as an
+    audit_timestamp()."""
+    try:
+        when = datetime.fromtimestamp(float(text), timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        when = datetime.fromisoformat(text)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+    return audit_timestamp(when)
+
+
+# --- Request metrics ---
+# /upload, /jobs, /bulk-fix, /custom-errors and /download-csv time their stages (spool,
+# parse, checks, anomaly fit and scoring, reconcile, annotate, serialize, ...) with a
+# RequestMetrics. When the request finishes, each stage is observed once in
+# ledgerlift_stage_seconds: a stage a handler runs per sheet is summed first. The rows a
+# stage handled and the bytes read and written go into counters. Dividing a counter by
+# the histogram _sum gives throughput. Parsing, the sheet checks and the anomaly model run
+# on the validation pool. The workers time those and send the times back with their
+# results, so parse and checks are CPU time summed over sheets. The validate stage is the
+# wall time of the pool jobs. The middleware records every request in
+# ledgerlift_request_seconds by route and status. GET /metrics serves all of it in the
+# Prometheus text format. Metrics are per process; with several server workers, scrape
+# each one.
+#
+# Set LEDGERLIFT_PROFILE_SLOW_SECONDS to profile requests. Every request then runs under
+# pyinstrument, or under cProfile when pyinstrument is not installed. The profile of any
+# request slower than the threshold is saved to LEDGERLIFT_PROFILE_DIR, which keeps the
+# newest LEDGERLIFT_PROFILE_KEEP. cProfile profiles one request at a time. It also sees
+# whatever else runs on the event loop meanwhile. Neither profiler sees work done on the
+# validation pool; the stage metrics cover that.
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRICS_MEDIA_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PROFILE_SLOW_SECONDS = float(os.environ.get('LEDGERLIFT_PROFILE_SLOW_SECONDS', 0))  # 0: off
+PROFILE_DIR = os.environ.get('LEDGERLIFT_PROFILE_DIR',
+                             os.path.join(tempfile.gettempdir(), 'ledgerlift_profiles'))
+PROFILE_KEEP = int(os.environ.get('LEDGERLIFT_PROFILE_KEEP', 50))
+
+
+def metric_labels(names, values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in values)
+    pairs = [f'{name}="{value}"' for name, value in zip(names, escaped)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class MetricCounter:
+    """A labelled Prometheus counter; inc() is thread-safe."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{metric_labels(self.labels, labels)} {value}'
+                for labels, value in values]
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help_text}',
+                f'# TYPE {self.name} {self.kind}'] + self.samples()
+
+
+class MetricHistogram(MetricCounter):
+    """A labelled Prometheus histogram; observe() is thread-safe."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels, buckets=STAGE_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        slot = bisect.bisect_left(self.buckets, value)  # len(buckets) is +Inf
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[slot] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(series)) for labels, series in sorted(self._values.items())]
+        lines = []
+        for labels, series in values:
+            count = 0
+            for bound, hits in zip(self.buckets + (math.inf,), series):
+                count += hits
+                le = '+Inf' if bound == math.inf else f'{bound:g}'
+                bucket = metric_labels(self.labels + ("le",), labels + (le,))
+                lines.append(f'{self.name}_bucket{bucket} {count}')
+            lines.append(f'{self.name}_sum{metric_labels(self.labels, labels)} {series[-1]}')
+            lines.append(f'{self.name}_count{metric_labels(self.labels, labels)} {count}')
+        return lines
+
+
+request_seconds = MetricHistogram(
+    'ledgerlift_request_seconds', 'Time to send the whole response, by route and status.',
+    ('method', 'route', 'status'))
+stage_seconds = MetricHistogram(
+    'ledgerlift_stage_seconds', 'Time one request spent in a stage of an endpoint.',
+    ('endpoint', 'stage'))
+stage_rows = MetricCounter(
+    'ledgerlift_stage_rows_total', 'Rows handled by a stage of an endpoint.', ('endpoint', 'stage'))
+endpoint_bytes = MetricCounter(
+    'ledgerlift_endpoint_bytes_total', 'Bytes an endpoint read (in) and wrote (out).',
+    ('endpoint', 'direction'))
+endpoint_requests = MetricCounter(
+    'ledgerlift_endpoint_requests_total', 'Requests whose stages were recorded, by endpoint.',
+    ('endpoint',))
+mail_events = MetricCounter(
+    'ledgerlift_mail_events_total',
+    'Emails queued, sent, retried and failed, and SMTP sessions opened.', ('event',))
+METRICS = (request_seconds, endpoint_requests, stage_seconds, stage_rows, endpoint_bytes,
+           mail_events)
+
+
+def metrics_text():
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+
+class RequestMetrics:
+    """Stage timings, rows and bytes of one request to endpoint, recorded by finish()."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}  # stage -> [seconds, rows], in the order first seen
+        self.bytes = {'in': 0, 'out': 0}
+        self.finished = False
+
+    def add(self, stage, seconds, rows=0):
+        totals = self.stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += rows
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        """Time the block as stage name; rows can also be set on the yielded span."""
+        span = types.SimpleNamespace(rows=rows)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.add(name, time.perf_counter() - start, span.rows)
+
+    def bytes_in(self, n):
+        self.bytes['in'] += n
+
+    def bytes_out(self, n):
+        self.bytes['out'] += n
+
+    def summary(self):
+        return ', '.join(f'{stage} {seconds * 1000:.1f} ms' + (f' ({rows} rows)' if rows else '')
+                         for stage, (seconds, rows) in self.stages.items())
+
+    def finish(self):
+        """Record the request once; later calls do nothing."""
+        if self.finished:
+            return
+        self.finished = True
+        endpoint_requests.inc(1, self.endpoint)
+        for stage, (seconds, rows) in self.stages.items():
+            stage_seconds.observe(seconds, self.endpoint, stage)
+            if rows:
+                stage_rows.inc(rows, self.endpoint, stage)
+        for direction, n in self.bytes.items():
+            if n:
+                endpoint_bytes.inc(n, self.endpoint, direction)
+
+
+def metered_chunks(chunks, timer, stage, rows=0):
+    """Yield a streaming body's chunks, timing their production as stage and counting bytes out.
+
+    The request is recorded when the body ends or the client goes away.
+    """
+    seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+            timer.bytes_out(len(chunk))
+            yield chunk
+    finally:
+        timer.add(stage, seconds, rows)
+        timer.finish()
+
+
+class RequestProfiler:
+    """Profiles one request with pyinstrument, or with cProfile without pyinstrument."""
+
+    _cprofile_lock = threading.Lock()  # cProfile cannot profile two requests at once
+
+    def __init__(self):
+        self.profiler = None
+        self.kind = None
+
+    def start(self):
+        """False when no profiler is free."""
+        try:
+            import pyinstrument
+        except ImportError:
+            if not self._cprofile_lock.acquire(blocking=False):
+                return False
+            import cProfile
+            self.profiler, self.kind = cProfile.Profile(), 'cprofile'
+            self.profiler.enable()
+            return True
+        self.profiler, self.kind = pyinstrument.Profiler(async_mode='enabled'), 'pyinstrument'
+        self.profiler.start()
+        return True
+
+    def stop(self):
+        if self.kind == 'cprofile':
+            self.profiler.disable()
+            self._cprofile_lock.release()
+        else:
+            self.profiler.stop()
+
+    def save(self, name):
+        """Write the profile to PROFILE_DIR and return its path.
+
+        cProfile writes .prof (for pstats or snakeviz), pyinstrument .html.
+        """
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if self.kind == 'cprofile':
+            path = os.path.join(PROFILE_DIR, name + '.prof')
+            self.profiler.dump_stats(path)
+        else:
+            path = os.path.join(PROFILE_DIR, name + '.html')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.profiler.output_html())
+        saved = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(PROFILE_DIR)
+                       if entry.name.endswith(('.prof', '.html')))
+        for _, old in saved[:max(0, len(saved) - PROFILE_KEEP)]:
+            with contextlib.suppress(OSError):
+                os.remove(old)
+        return path
+
+
+def profile_name(method, path, request_id):
+    slug = re.sub(r'[^0-9A-Za-z]+', '_', f'{method} {path}').strip('_')
+    request_id = re.sub(r'[^0-9A-Za-z_-]', '_', request_id)[:64]
+    return f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{slug}-{request_id}"
+
+
+# --- Input validation for uploads ---
+MAX_FILE_SIZE = int(os.environ.get('LEDGERLIFT_MAX_FILE_SIZE', 1024 * 1024 * 1024))  # 1 GB
+ALLOWED_EXTENSIONS = {'.csv', '.xlsx'}
+
+def allowed_file(filename):
+    return any(filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS)
+
+# --- Streaming ingestion ---
+# Uploads are copied to a spool file in fixed-size chunks (hashing as they go), so the
+# request body is never held in memory. CSVs are then read LEDGERLIFT_CSV_CHUNK_ROWS rows
+# at a time and every chunk goes through the same checks as a whole sheet; trial-balance
+# totals, duplicate keys and key lines are carried across chunks. XLSX files are read
+# with openpyxl in read-only mode, one sheet at a time and LEDGERLIFT_XLSX_CHUNK_ROWS rows
+# per chunk, and /upload?sheet=... limits parsing to the named sheets. Uploads (CSV or
+# XLSX) larger than LEDGERLIFT_UPLOAD_KEEP_BYTES are not kept in memory after validation,
+# apart from the chart of accounts the other sheets are checked against: the workbook
+# reads them back from the spool file the first time an endpoint needs the rows. Anomaly
+# scoring needs whole sheets, so it is skipped for those uploads and the response's
+# "notices" says so.
+UPLOAD_SPOOL_DIR = os.environ.get('LEDGERLIFT_SPOOL_DIR',
+                                  os.path.join(tempfile.gettempdir(), 'ledgerlift_uploads'))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+CSV_CHUNK_ROWS = int(os.environ.get('LEDGERLIFT_CSV_CHUNK_ROWS', 50000))
+UPLOAD_KEEP_BYTES = int(os.environ.get('LEDGERLIFT_UPLOAD_KEEP_BYTES', 64 * 1024 * 1024))
+XLSX_CHUNK_ROWS = int(os.environ.get('LEDGERLIFT_XLSX_CHUNK_ROWS', 20000))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def sweep_spool_dir(ttl):
+    now = time.time()
+    for entry in os.scandir(UPLOAD_SPOOL_DIR):
+        try:
+            if now - entry.stat().st_mtime <= ttl:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)  # a process pool's sheet files
+            else:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+async def spool_upload(file, max_bytes=MAX_FILE_SIZE):
+    """Copy an upload to a spool file chunk by chunk. Returns (path, size, sha256 hex digest)."""
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    sweep_spool_dir(WORKBOOK_TTL_SECONDS)
+    fd, path = tempfile.mkstemp(dir=UPLOAD_SPOOL_DIR,
+                                suffix=os.path.splitext(file.filename.lower())[1])
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(size)
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, size, digest.hexdigest()
+
+
+def csv_sheet_name(filename):
+    """A CSV is one sheet, named after the file when the name says what it holds."""
+    stem = os.path.splitext(os.path.basename(filename or ''))[0]
+    return stem if sheet_kind(stem) else 'CSV'
+
+
+def read_csv_chunks(path, chunk_rows=CSV_CHUNK_ROWS):
+    return pd.read_csv(path, chunksize=chunk_rows, on_bad_lines='skip', encoding='utf-8')
+
+
+def load_spooled_upload(path, filename, selected=()):
+    try:
+        os.utime(path)  # keep the spool file alive while the workbook is in use
+        parts = {}
+        for name, chunk in iter_upload_chunks(path, os.path.splitext(path)[1], filename, selected):
+            parts.setdefault(name, []).append(chunk)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {name: pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+            for name, chunks in parts.items()}
+
+
+def open_xlsx(path):
+    import openpyxl
+    # The options pandas uses: stream rows, cached formula results, no external links
+    return openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+
+
+def xlsx_cell_value(cell):
+    """Convert a cell the way pandas' openpyxl reader does, so chunks match pd.read_excel."""
+    if cell.value is None:
+        return ''
+    if cell.data_type == 'e':
+        return np.nan
+    if cell.data_type == 'n':
+        value = int(cell.value)
+        return value if value == cell.value else float(cell.value)
+    return cell.value
+
+
+def xlsx_rows(ws):
+    """Rows as lists of cell values with trailing empty cells and trailing empty rows dropped."""
+    ws.reset_dimensions()
+    blank_rows = 0
+    for row in ws.rows:
+        values = [xlsx_cell_value(cell) for cell in row]
+        while values and values[-1] == '':
+            values.pop()
+        if not values:
+            blank_rows += 1
+            continue
+        for _ in range(blank_rows):
+            yield []
+        blank_rows = 0
+        yield values
+
+
+def iter_xlsx_chunks(ws, chunk_rows=XLSX_CHUNK_ROWS):
+    """Yield a worksheet as DataFrames of up to chunk_rows rows, parsed like pd.read_excel."""
+    from pandas.io.parsers import TextParser
+    rows = xlsx_rows(ws)
+    header = next(rows, None)
+    if header is None:
+        yield pd.DataFrame()
+        return
+    columns = None
+    start = 0
+    while True:
+        batch = list(itertools.islice(rows, chunk_rows))
+        if columns is None:
+            data = [header] + batch
+            # Blank rows are only yielded ahead of a non-blank one, so a sheet is at least one
+            # column wide
+            width = max(max(len(row) for row in data), 1 if batch else 0)
+            chunk = TextParser([row + [''] * (width - len(row)) for row in data], header=0,
+                               skip_blank_lines=False).read()
+            columns = list(chunk.columns)
+        elif batch:
+            width = max(len(row) for row in batch)
+            # Cells past the header get the names pandas would give them
+            columns.extend(f'Unnamed: {k}' for k in range(len(columns), width))
+            width = len(columns)
+            chunk = TextParser([row + [''] * (width - len(row)) for row in batch], names=columns,
+                               header=None, skip_blank_lines=False).read()
+        else:
+            return
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+        if len(batch) < chunk_rows:
+            return
+
+
+def xlsx_sheet_info(path):
+    """Name, size and header of every sheet, read from the sheet's <dimension> element and
+    first row only."""
+    wb = open_xlsx(path)
+    try:
+        info = []
+        for ws in wb.worksheets:
+            if ws.max_row is None or ws.max_column is None:
+                ws.calculate_dimension(force=True)  # no recorded dimension: scan the rows
+            header = next(ws.iter_rows(max_row=1), ())
+            names = [xlsx_cell_value(cell) for cell in header]
+            while names and names[-1] == '':
+                names.pop()
+            info.append({
+                "name": ws.title,
+                "rows": max(ws.max_row - 1, 0),
+                "columns": ws.max_column,
+                "column_names": [name if name != '' else f'Unnamed: {i}'
+                                 for i, name in enumerate(names)]
+            })
+        return info
+    finally:
+        wb.close()
+
+
+def iter_upload_chunks(path, file_ext, filename, selected=()):
+    """Yield (sheet name, DataFrame chunk) for an uploaded file, one sheet after another.
+
+    Only the sheets in selected are read when it is given. Excel chunks get the same
+    inf/NaN -> None cleanup the whole-sheet parse used.
+    """
+    if file_ext == '.csv':
+        name = csv_sheet_name(filename)
+        for chunk in read_csv_chunks(path):
+            yield name, chunk
+        return
+    wb = open_xlsx(path)
+    try:
+        for ws in wb.worksheets:
+            if selected and ws.title not in selected:
+                continue
+            for chunk in iter_xlsx_chunks(ws):
+                # Replace inf and NaN with None for JSON serialization
+                chunk = chunk.replace([np.inf, -np.inf], pd.NA)
+                yield ws.title, chunk.where(pd.notnull(chunk), None)
+    finally:
+        wb.close()
+
+
+class SheetValidator:
+    """validate_sheet() plus the formula audit and key lines, fed one chunk of rows at a time.
+
+    Row-local checks run on each chunk as it arrives; trial-balance totals, the first
+    suspicious rows, chart duplicates and key-line amounts are kept running, so the
+    result matches validating the concatenated sheet.
+    """
+
+    def __init__(self, name, plan=AUDIT_PLAN, accounts=None):
+        self.name = name
+        self.plan = plan
+        self.accounts = accounts
+        self.kind = sheet_kind(name)
+        self.audit_formulas = audits_formulas(name, plan)
+        self.rows = 0
+        self.row_errors = []
+        self.formula_errors = []
+        self.missing = {col: [] for col, _, issue_type in CHART_REQUIRED_COLUMNS
+                        if plan.enabled(issue_type)}
+        self.duplicates = []
+        self.seen = set()
+        self.has_totals = False
+        self.amounts = {'Debit': [], 'Credit': []}  # numeric chunks, summed once in totals()
+        self.suspicious = []
+        self.key_values = {}
+        self.rollup = None
+        if self.kind in ('journal', 'trial') and plan.enabled('trial_journal_mismatch'):
+            self.rollup = AccountRollup()
+
+    def feed(self, df):
+        self.rows += len(df)
+        if self.kind == 'chart':
+            labels = df.index.tolist()
+            for col, missing in self.missing.items():
+                if col in df.columns:
+                    missing.extend(labels[pos]
+                                   for pos in np.flatnonzero(df[col].isnull().to_numpy()).tolist())
+            rows = ()
+            if self.plan.enabled('duplicate_row'):
+                rows = df.itertuples(index=False, name=None)
+            for label, values in zip(labels, rows):
+                key = row_key(values)
+                if key in self.seen:
+                    self.duplicates.append(label)
+                else:
+                    self.seen.add(key)
+        elif self.kind == 'journal':
+            self.row_errors.extend(validate_journal_sheet(df, self.name, self.plan, self.accounts))
+        elif self.kind == 'trial':
+            if ('Debit' in df.columns and 'Credit' in df.columns
+                    and self.plan.enabled('trial_out_of_balance')):
+                self.has_totals = True
+                for col, parts in self.amounts.items():
+                    parts.append(pd.to_numeric(df[col], errors='coerce'))
+                if len(self.suspicious) < 3:
+                    flagged = df.index[trial_suspicious_mask(df).to_numpy()]
+                    self.suspicious.extend(flagged[:3 - len(self.suspicious)].tolist())
+            self.row_errors.extend(trial_row_errors(df, self.plan, self.accounts))
+        cells = formula_cells(df) if self.kind == 'statement' or self.audit_formulas else None
+        if self.kind == 'statement':
+            self.row_errors.extend(validate_statement_sheet(df, self.plan, cells))
+        if self.audit_formulas:
+            self.formula_errors.extend(formula_audit_errors(df, cells))
+        if self.rollup is not None:
+            self.rollup.add(df, self.accounts)
+        for key, labels in key_line_labels(self.name, df).items():
+            value = key_line_value(df, labels)
+            if value is not None:
+                self.key_values[key] = value
+
+    def totals(self):
+        """(total debit, total credit); one sum per column, so the float rounding matches
+        validate_trial_sheet."""
+        return tuple(pd.concat(parts).sum() for parts in self.amounts.values())
+
+    def error_count(self):
+        """len(self.errors()) without building the list."""
+        count = len(self.row_errors) + len(self.formula_errors)
+        if self.kind == 'chart':
+            count += sum(len(labels) for labels in self.missing.values()) + len(self.duplicates)
+        elif self.kind == 'trial' and self.has_totals:
+            count += trial_balance_error(*self.totals(), []) is not None
+        return count
+
+    def errors(self):
+        if self.kind == 'chart':
+            errors = [{"row": label + 1, "issue": issue} for col, issue, _ in CHART_REQUIRED_COLUMNS
+                      for label in self.missing.get(col, ())]
+            errors.extend({"row": label + 1, "issue": "Duplicate row"} for label in self.duplicates)
+        elif self.kind == 'trial' and self.has_totals:
+            balance_error = trial_balance_error(*self.totals(),
+                                                [label + 1 for label in self.suspicious])
+            errors = ([balance_error] if balance_error else []) + self.row_errors
+        else:
+            errors = list(self.row_errors)
+        return errors + self.formula_errors
+
+
+# --- Anomaly models ---
+# Journal entries are scored against a model trained once per client (/upload?client=...)
+# or, without one, per chart of accounts (a fingerprint of the Chart of Accounts sheet's
+# account numbers), and saved under LEDGERLIFT_MODEL_DIR. An entry therefore gets the same
+# verdict in every upload until the model is retrained with POST /anomaly-model; the
+# first upload for a key trains it. A workbook with neither a client nor a chart has no
+# key of its own: it is scored within the batch, by z-score against its own account
+# statistics, and nothing is saved, unless a model for DEFAULT_MODEL_KEY was trained
+# explicitly with POST /anomaly-model. Features are the debit and credit, the entry's
+# robust z-score among its account's amounts, the day of week and round-number flags.
+# Account statistics use every row, the Isolation Forest at most
+# LEDGERLIFT_ANOMALY_SAMPLE_ROWS sampled ones. Without sklearn, entries whose |z| exceeds
+# LEDGERLIFT_ANOMALY_Z are flagged.
+ANOMALY_MODEL_DIR = os.environ.get('LEDGERLIFT_MODEL_DIR',
+                                   os.path.join(tempfile.gettempdir(), 'ledgerlift_models'))
+ANOMALY_SAMPLE_ROWS = int(os.environ.get('LEDGERLIFT_ANOMALY_SAMPLE_ROWS', 100000))
+ANOMALY_CONTAMINATION = float(os.environ.get('LEDGERLIFT_ANOMALY_CONTAMINATION', 0.1))
+ANOMALY_Z_THRESHOLD = float(os.environ.get('LEDGERLIFT_ANOMALY_Z', 3.5))
+ANOMALY_MIN_ROWS = 11  # smaller journals are not scored
+ANOMALY_MIN_ACCOUNT_ROWS = 5  # accounts with fewer entries use the ledger-wide statistics
+ANOMALY_MODEL_VERSION = 1
+DEFAULT_MODEL_KEY = 'default'
+
+
+@functools.lru_cache(maxsize=None)
+def isolation_forest_class():
+    """sklearn's IsolationForest, imported once per process (it takes over a second); None
+    without sklearn."""
+    try:
+        from sklearn.ensemble import IsolationForest
+    except ImportError:
+        return None
+    return IsolationForest
+
+
+def anomaly_candidate(name, df):
+    return ('journal' in name.lower() and 'Debit' in df.columns and 'Credit' in df.columns
+            and len(df) >= ANOMALY_MIN_ROWS)
+
+
+def anomaly_model_key(client, sheets):
+    """The model a workbook is scored with: its client's, else its chart of accounts'."""
+    if client:
+        return f'client:{client}'
+    for name, df in sheets.items():
+        if sheet_kind(name) == 'chart' and 'Account Number' in df.columns:
+            numbers = str_column(df, 'Account Number').str.strip()
+            numbers = sorted(set(numbers) - BLANK_ACCOUNT_NUMBERS)
+            if numbers:
+                return 'coa:' + hashlib.sha256('\n'.join(numbers).encode()).hexdigest()[:16]
+    return DEFAULT_MODEL_KEY
+
+
+def entry_magnitudes(df):
+    """(debit, credit, log1p(|debit| + |credit|), account) arrays of a journal."""
+    debit = amount_column(df, 'Debit')[0].fillna(0.0).to_numpy()
+    credit = amount_column(df, 'Credit')[0].fillna(0.0).to_numpy()
+    accounts = str_column(df, 'Account').str.strip().to_numpy()
+    return debit, credit, np.log1p(np.abs(debit) + np.abs(credit)), accounts
+
+
+def entry_weekdays(df):
+    """Day of week (Monday 0) of each entry's Date, -1 where it does not parse."""
+    dates = df['Date'] if 'Date' in df.columns else pd.Series(np.nan, index=df.index)
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        if pd.api.types.is_numeric_dtype(dates):
+            dates = pd.Series(pd.NaT, index=df.index)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            try:
+                dates = pd.to_datetime(dates, errors='coerce')
+            except (ValueError, TypeError, OverflowError):
+                dates = pd.Series(pd.NaT, index=df.index)
+    return dates.dt.dayofweek.fillna(-1).to_numpy(dtype=float)
+
+
+def anomaly_features(df, model):
+    """(feature matrix, account z-scores) of a journal under a model's account statistics."""
+    debit, credit, magnitude, accounts = entry_magnitudes(df)
+    accounts = pd.Series(accounts)
+    median = accounts.map(model['account_median']).fillna(model['global_median'])
+    scale = accounts.map(model['account_scale']).fillna(model['global_scale'])
+    median, scale = median.to_numpy(dtype=float), scale.to_numpy(dtype=float)
+    z = 0.6745 * (magnitude - median) / scale
+    weekday = entry_weekdays(df)
+    amount = np.abs(debit) + np.abs(credit)
+    features = np.column_stack([
+        debit, credit, z, weekday, weekday >= 5,
+        (amount >= 100) & (np.mod(amount, 100) == 0),
+        (amount >= 1000) & (np.mod(amount, 1000) == 0),
+    ]).astype(float)
+    return features, z
+
+
+def train_anomaly_model(key, frames, forest=True):
+    """Fit a model on journal frames. Returns the dict AnomalyModelStore saves.
+
+    forest=False keeps only the account statistics, for z-score scoring.
+    """
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    _, _, magnitude, accounts = entry_magnitudes(df)
+    global_median = float(np.median(magnitude))
+    global_mad = float(np.median(np.abs(magnitude - global_median)))
+    global_scale = global_mad if global_mad > 0 else 1.0
+    stats = pd.DataFrame({'account': accounts, 'magnitude': magnitude})
+    grouped = stats.groupby('account')['magnitude']
+    median = grouped.median()
+    deviation = (stats['magnitude'] - stats['account'].map(median)).abs()
+    mad = deviation.groupby(stats['account']).median()
+    reliable = grouped.size() >= ANOMALY_MIN_ACCOUNT_ROWS
+    model = {
+        "version": ANOMALY_MODEL_VERSION,
+        "key": key,
+        "trained_at": time.time(),
+        "rows": len(df),
+        "sampled_rows": 0,
+        "accounts": int(reliable.sum()),
+        "account_median": median[reliable],
+        "account_scale": mad[reliable].where(mad[reliable] > 0, global_scale),
+        "global_median": global_median,
+        "global_scale": global_scale,
+        "forest": None,  # pickled IsolationForest, so the model loads without sklearn
+    }
+    IsolationForest = isolation_forest_class() if forest else None
+    if IsolationForest is None:
+        return model
+    features, _ = anomaly_features(df, model)
+    if len(features) > ANOMALY_SAMPLE_ROWS:
+        sample = np.random.default_rng(42).choice(len(features), ANOMALY_SAMPLE_ROWS,
+                                                  replace=False)
+        features = features[sample]
+    forest = IsolationForest(contamination=ANOMALY_CONTAMINATION, random_state=42).fit(features)
+    model['sampled_rows'] = len(features)
+    model['forest'] = pickle.dumps(forest, protocol=pickle.HIGHEST_PROTOCOL)
+    return model
+
+
+class AnomalyModelStore:
+    """Trained models on disk, one pickle per key, cached per process until the file changes.
+
+    The forest is only unpickled (importing sklearn) when estimator() is first asked for it.
+    """
+
+    def __init__(self, directory=ANOMALY_MODEL_DIR):
+        self.directory = directory
+        self._cache = {}  # key -> (mtime, model)
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[:32] + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            mtime = os.path.getmtime(path)
+            with self._lock:
+                cached = self._cache.get(key)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            with open(path, 'rb') as f:
+                model = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        if model.get('version') != ANOMALY_MODEL_VERSION or model.get('key') != key:
+            return None
+        with self._lock:
+            self._cache[key] = (mtime, model)
+        return model
+
+    def put(self, key, model):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._cache[key] = (os.path.getmtime(path), model)
+        return model
+
+    @staticmethod
+    def estimator(model):
+        """The model's IsolationForest, or None if it has none or sklearn is missing."""
+        if 'estimator' not in model:
+            try:
+                model['estimator'] = None
+                if model['forest'] is not None:
+                    model['estimator'] = pickle.loads(model['forest'])
+            except ImportError:
+                model['estimator'] = None  # scored with the z-score fallback
+        return model['estimator']
+
+
+anomaly_models = AnomalyModelStore()
+
+
+def model_summary(model):
+    return {
+        "key": model['key'],
+        "trained_at": model['trained_at'],
+        "rows": model['rows'],
+        "sampled_rows": model['sampled_rows'],
+        "accounts": model['accounts'],
+        "method": "isolation_forest" if model['forest'] is not None else "z_score",
+    }
+
+
+def retrain_anomaly_model(key, frames):
+    return model_summary(anomaly_models.put(key, train_anomaly_model(key, frames)))
+
+
+def anomaly_errors(name, df, model_key=DEFAULT_MODEL_KEY, timings=None):
+    """Score a journal sheet with the model for model_key, training that model if there is none yet.
+
+    DEFAULT_MODEL_KEY is never trained here: without a saved model the sheet is scored by
+    z-score against its own statistics. timings, if given, gets the seconds spent fitting
+    ('anomaly_fit') and scoring ('anomaly_score').
+    """
+    if not anomaly_candidate(name, df):
+        return []
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    model = anomaly_models.get(model_key)
+    if model is None and model_key == DEFAULT_MODEL_KEY:
+        # A shared model trained on whichever workbook came first would judge every later
+        # one; keep the statistics to this upload
+        model = train_anomaly_model(model_key, [df], forest=False)
+        timings['anomaly_fit'] = time.perf_counter() - start
+        start = time.perf_counter()
+    elif model is None:
+        model = anomaly_models.put(model_key, train_anomaly_model(model_key, [df]))
+        timings['anomaly_fit'] = time.perf_counter() - start
+        start = time.perf_counter()
+    features, z = anomaly_features(df, model)
+    estimator = anomaly_models.estimator(model)
+    if estimator is not None:
+        flagged = estimator.predict(features) == -1
+    else:
+        flagged = np.abs(z) > ANOMALY_Z_THRESHOLD
+    timings['anomaly_score'] = time.perf_counter() - start
+    return [{
+        "row": idx+1,
+        "issue": ANOMALY_ISSUE,
+        "why": ANOMALY_WHY
+    } for idx in np.flatnonzero(flagged).tolist()]
+
+
+# --- Custom rules ---
+# /custom-errors evaluates user rules as whole-column masks. A rule is {"column",
+# "condition", "value"} or {"all": [rules]} / {"any": [rules]}. >, <, >= and <= compare
+# float() of the cell and the value (cells float() rejects never match), == and != compare
+# their str(), empty and notempty test for missing or blank cells. A rule set compiles once
+# (cached on its JSON); RuleColumns coerces each column at most once however many rules read
+# it. POST /rule-sets saves a named set under LEDGERLIFT_RULE_SET_DIR for later sessions.
+RULE_SET_DIR = os.environ.get('LEDGERLIFT_RULE_SET_DIR',
+                              os.path.join(tempfile.gettempdir(), 'ledgerlift_rule_sets'))
+NUMERIC_CONDITIONS = {'>': np.greater, '<': np.less, '>=': np.greater_equal, '<=': np.less_equal}
+TEXT_CONDITIONS = ('==', '!=', 'empty', 'notempty')
+
+
+class RuleColumns:
+    """The columns of one sheet as rules read them, each coerced on first use."""
+
+    def __init__(self, df):
+        self.df = df
+        self._numbers = {}
+        self._text = {}
+
+    def nothing(self):
+        return np.zeros(len(self.df), dtype=bool)
+
+    def numbers(self, col):
+        """float() of every cell; NaN where float() fails, blanks and None included."""
+        if col not in self._numbers:
+            values, blank = amount_column(self.df, col)
+            self._numbers[col] = values.mask(blank).to_numpy()
+        return self._numbers[col]
+
+    def text(self, col):
+        """(codes, uniques, missing): str() of every cell as codes into its distinct strings."""
+        if col not in self._text:
+            raw = self.df[col]
+            # str() of object cells first, so that 1, 1.0 and True stay apart
+            codes, uniques = pd.factorize(raw.map(str) if raw.dtype == object else raw,
+                                          use_na_sentinel=False)
+            self._text[col] = (codes, [str(u) for u in uniques], raw.isna().to_numpy())
+        return self._text[col]
+
+
+def rule_text(rule):
+    if 'all' in rule or 'any' in rule:
+        joiner = ' and ' if 'all' in rule else ' or '
+        parts = rule.get('all', rule.get('any'))
+        return '(' + joiner.join(rule_text(part).strip() for part in parts) + ')'
+    value = rule.get('value')
+    return f"{rule.get('column')} {rule.get('condition')} {value if value else ''}"
+
+
+def compile_rule(rule):
+    """A rule as mask(columns) -> bool array over the sheet's rows.
+
+    Raises ValueError if the rule is malformed.
+    """
+    if not isinstance(rule, dict):
+        raise ValueError(f"A rule must be an object, not {rule!r}.")
+    if 'all' in rule or 'any' in rule:
+        parts = rule.get('all', rule.get('any'))
+        if not isinstance(parts, list) or not parts:
+            raise ValueError("'all' and 'any' take a non-empty list of rules.")
+        masks = [compile_rule(part) for part in parts]
+        combine = np.logical_and if 'all' in rule else np.logical_or
+        return lambda columns: functools.reduce(combine, (mask(columns) for mask in masks))
+    column, condition, value = rule.get('column'), rule.get('condition'), rule.get('value')
+    if condition in NUMERIC_CONDITIONS:
+        compare = NUMERIC_CONDITIONS[condition]
+        try:
+            threshold = float(value)
+        except (TypeError, ValueError):
+            return lambda columns: columns.nothing()  # no cell compares with it
+
+        def mask(columns):
+            if column not in columns.df.columns:
+                return columns.nothing()
+            return compare(columns.numbers(column), threshold)
+        return mask
+    if condition in TEXT_CONDITIONS:
+        text = str(value)
+
+        def mask(columns):
+            if column not in columns.df.columns:
+                return columns.nothing()
+            codes, uniques, missing = columns.text(column)
+            if condition in ('==', '!='):
+                matches = np.array([u == text for u in uniques], dtype=bool)[codes]
+                return matches if condition == '==' else ~matches
+            empty = missing | np.array([u.strip() == '' for u in uniques], dtype=bool)[codes]
+            return empty if condition == 'empty' else ~empty
+        return mask
+    raise ValueError(f"Unknown condition {condition!r}. "
+                     f"Use one of: {', '.join([*NUMERIC_CONDITIONS, *TEXT_CONDITIONS])}.")
+
+
+@functools.lru_cache(maxsize=256)
+def compiled_rule_set(rules_json):
+    """(issue, mask) per rule of a JSON-encoded rule list, in order."""
+    compiled = []
+    for rule in json.loads(rules_json):
+        mask = compile_rule(rule)  # validates the rule before rule_text() reads it
+        compiled.append((f"Custom rule: {rule_text(rule)}", mask))
+    return tuple(compiled)
+
+
+def custom_rule_errors(df, rules):
+    """Rows of df matching each rule, rule by rule. Raises ValueError for a malformed rule."""
+    if not isinstance(rules, list):
+        raise ValueError("rules must be a list.")
+    compiled = compiled_rule_set(json.dumps(rules, sort_keys=True))
+    columns = RuleColumns(df)
+    labels = df.index.tolist()
+    errors = []
+    for issue, mask in compiled:
+        errors.extend({"row": labels[pos] + 1, "issue": issue}
+                      for pos in np.flatnonzero(mask(columns)).tolist())
+    return errors
+
+
+class RuleSetStore:
+    """Named rule sets on disk, one JSON file per name."""
+
+    def __init__(self, directory=RULE_SET_DIR):
+        self.directory = directory
+
+    def _path(self, name):
+        digest = hashlib.sha256(name.encode()).hexdigest()[:32]
+        return os.path.join(self.directory, digest + '.json')
+
+    def get(self, name):
+        try:
+            with open(self._path(name), encoding='utf-8') as f:
+                rule_set = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return rule_set if rule_set.get('name') == name else None
+
+    def put(self, name, rules):
+        os.makedirs(self.directory, exist_ok=True)
+        rule_set = {"name": name, "rules": rules, "saved_at": datetime.now().isoformat()}
+        path = self._path(name)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(rule_set, f)
+        os.replace(tmp_path, path)
+        return rule_set
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list(self):
+        try:
+            paths = [os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                     if f.endswith('.json')]
+        except FileNotFoundError:
+            return []
+        rule_sets = []
+        for path in paths:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    rule_sets.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                pass
+        return sorted(rule_sets, key=lambda rule_set: rule_set.get('name', ''))
+
+
+rule_sets = RuleSetStore()
+
+# --- Validation pool ---
+# Parsing, the sheet checks and anomaly scoring run on a pool (LEDGERLIFT_VALIDATION_POOL=
+# process|thread, LEDGERLIFT_VALIDATION_WORKERS workers) with one job per sheet, so a big
+# upload neither blocks the event loop nor stays on a single core. A job scores its own
+# sheet, so the frame never goes back out for scoring. On a process pool with pyarrow, a
+# kept sheet comes back as a columnar file in the spool directory rather than pickled
+# through the pool, and parse cache hits hand workers that file instead of the frame. At most
+# LEDGERLIFT_MAX_HEAVY_JOBS uploads use the pool at once and LEDGERLIFT_HEAVY_QUEUE_SIZE
+# more may wait; anything beyond that gets 503 with Retry-After: LEDGERLIFT_RETRY_AFTER.
+VALIDATION_POOL_KIND = os.environ.get('LEDGERLIFT_VALIDATION_POOL', 'process')
+VALIDATION_WORKERS = int(os.environ.get('LEDGERLIFT_VALIDATION_WORKERS', os.cpu_count() or 1))
+MAX_HEAVY_JOBS = int(os.environ.get('LEDGERLIFT_MAX_HEAVY_JOBS', 2))
+HEAVY_QUEUE_SIZE = int(os.environ.get('LEDGERLIFT_HEAVY_QUEUE_SIZE', 8))
+RETRY_AFTER_SECONDS = int(os.environ.get('LEDGERLIFT_RETRY_AFTER', 10))
+
+
+def upload_sheet_names(path, file_ext, filename, selected=()):
+    """The sheets iter_upload_chunks would yield, in the same order, without reading any rows."""
+    if file_ext == '.csv':
+        return [csv_sheet_name(filename)]
+    wb = open_xlsx(path)
+    try:
+        return [title for title in wb.sheetnames if not selected or title in selected]
+    finally:
+        wb.close()
+
+
+def pool_crosses_processes():
+    """Whether frames sent to or from the validation pool are pickled."""
+    return VALIDATION_POOL_KIND != 'thread'
+
+
+def sheet_result(name, validator, preview, frame, timings, model_key=None, frame_dir=None):
+    """The result of one sheet job. A frame is scored with model_key's anomaly model if given,
+    and saved to frame_dir (save_columnar_sheets) instead of returned if that is given."""
+    anomalies = []
+    if model_key is not None and frame is not None:
+        anomalies = anomaly_errors(name, frame, model_key, timings)
+    if frame_dir is not None and frame is not None:
+        save_columnar_sheets(frame_dir, {name: frame})
+        frame = None
+    else:
+        frame_dir = None
+    return {
+        "name": name,
+        "rows": validator.rows,
+        "errors": validator.errors(),
+        "anomalies": anomalies,
+        "key_values": validator.key_values,
+        "rollup": validator.rollup,
+        "preview": preview,
+        "frame": frame,
+        "frame_dir": frame_dir,
+        "timings": timings,  # seconds spent parsing, checking and scoring in the worker
+    }
+
+
+def result_frame(result):
+    """The kept frame of a sheet job, read back from its columnar file if it was saved to one."""
+    if result['frame'] is None and result['frame_dir'] is not None:
+        result['frame'] = load_columnar_sheets(result['frame_dir'])[result['name']]
+    return result['frame']
+
+
+def validate_upload_sheet(path, file_ext, filename, sheet, keep, plan=AUDIT_PLAN, accounts=None,
+                          progress=None, model_key=None, frame_dir=None):
+    """Parse and validate one sheet of a spooled upload chunk by chunk, on the validation pool.
+
+    progress(rows, errors) is called after every chunk. A kept sheet is scored and saved as
+    sheet_result() describes.
+    """
+    validator = SheetValidator(sheet, plan, accounts)
+    preview = None
+    parts = []
+    timings = {'parse': 0.0, 'checks': 0.0}
+    chunks = iter_upload_chunks(path, file_ext, filename, (sheet,))
+    while True:
+        start = time.perf_counter()
+        _, chunk = next(chunks, (None, None))
+        timings['parse'] += time.perf_counter() - start
+        if chunk is None:
+            break
+        if preview is None:
+            preview = {
+                "columns": list(chunk.columns),
+                "sample": []
+            }
+        if len(preview['sample']) < 5:
+            # Chunks can be shorter than the sample, which then spans several of them
+            preview['sample'] += frame_records(chunk.head(5 - len(preview['sample'])))
+        start = time.perf_counter()
+        validator.feed(chunk)
+        timings['checks'] += time.perf_counter() - start
+        if progress is not None:
+            progress(validator.rows, validator.error_count())
+        if keep:
+            parts.append(chunk)
+    frame = (pd.concat(parts) if len(parts) > 1 else parts[0]) if keep and parts else None
+    return sheet_result(sheet, validator, preview, frame, timings, model_key, frame_dir)
+
+
+def validate_frame(name, df, plan=AUDIT_PLAN, accounts=None, progress=None, model_key=None):
+    """validate_upload_sheet() for a sheet that is already parsed (parse cache hit)."""
+    validator = SheetValidator(name, plan, accounts)
+    start = time.perf_counter()
+    validator.feed(df)
+    timings = {'checks': time.perf_counter() - start}
+    if progress is not None:
+        progress(validator.rows, validator.error_count())
+    preview = {
+        "columns": list(df.columns),
+        "sample": frame_records(df.head(5))
+    }
+    result = sheet_result(name, validator, preview, df, timings, model_key)
+    result['frame'] = None  # the caller already has it
+    return result
+
+
+def validate_saved_frame(frame_dir, name, plan=AUDIT_PLAN, accounts=None, progress=None,
+                         model_key=None):
+    """validate_frame() reading the sheet from the columnar file its first parse saved."""
+    return validate_frame(name, load_columnar_sheets(frame_dir)[name], plan, accounts, progress,
+                          model_key)
+
+
+_validation_pool = None
+_validation_pool_lock = threading.Lock()
+
+
+def validation_pool():
+    global _validation_pool
+    with _validation_pool_lock:
+        if _validation_pool is None:
+            if VALIDATION_POOL_KIND == 'thread':
+                _validation_pool = concurrent.futures.ThreadPoolExecutor(
+                    VALIDATION_WORKERS, thread_name_prefix='validation')
+            else:
+                _validation_pool = concurrent.futures.ProcessPoolExecutor(VALIDATION_WORKERS)
+        return _validation_pool
+
+
+def discard_validation_pool(pool):
+    global _validation_pool
+    with _validation_pool_lock:
+        if _validation_pool is pool:
+            _validation_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def in_validation_pool(fn, *args):
+    pool = validation_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(fn, *args))
+    except concurrent.futures.BrokenExecutor:
+        # A worker died (e.g. out of memory); start a fresh pool for the next job
+        discard_validation_pool(pool)
+        raise
+
+
+class HeavyJobGate:
+    """Admission control for uploads: max_running use the pool at once, max_queued wait."""
+
+    def __init__(self, max_running=MAX_HEAVY_JOBS, max_queued=HEAVY_QUEUE_SIZE):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.admitted = 0
+        self._running = asyncio.Semaphore(max_running)
+
+    def try_admit(self):
+        # Only touched from the event loop, so no lock is needed
+        if self.admitted >= self.max_running + self.max_queued:
+            return False
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.admitted -= 1
+
+    def running(self):
+        return self._running
+
+
+heavy_jobs = HeavyJobGate()
+
+
+def busy_response():
+    return FastJSONResponse(
+        content={"error": "Server is busy validating other uploads. Please retry shortly."},
+        status_code=503,
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+
+# --- Validation jobs ---
+# POST /jobs spools an upload and validates it in the background with the same code as
+# /upload; GET /jobs/{id} reports per-sheet progress and GET /jobs/{id}/results returns the
+# payload one sheet at a time. Pool workers report progress (and notice cancellation)
+# through small files next to the spooled upload, which works for thread and process
+# pools alike. The job's own state (and its payload once done) is saved there too, so
+# any worker can answer for a job another worker runs. Finished jobs are dropped
+# LEDGERLIFT_JOB_TTL seconds after they end.
+JOB_TTL_SECONDS = int(os.environ.get('LEDGERLIFT_JOB_TTL', 3600))
+JOB_RESULTS_PAGE_SIZE = int(os.environ.get('LEDGERLIFT_JOB_PAGE_SIZE', 1000))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def replace_json_file(path, content):
+    """Write content as JSON to path in one step, so readers never see half a file."""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(FastJSONResponse(content=content).body)
+    os.replace(tmp_path, path)
+
+
+class ProgressFile:
+    """Picklable progress callback for one sheet job: writes {rows, errors} and checks for
+    cancellation."""
+
+    def __init__(self, path, cancel_path):
+        self.path = path
+        self.cancel_path = cancel_path
+
+    def __call__(self, rows, errors):
+        if os.path.exists(self.cancel_path):
+            raise JobCancelled()
+        replace_json_file(self.path, {"rows": int(rows), "errors": int(errors)})
+
+
+class JobProgress:
+    """Per-sheet progress of one validation job, as reported by its ProgressFiles."""
+
+    def __init__(self, job_id, directory=UPLOAD_SPOOL_DIR):
+        self.prefix = os.path.join(directory, job_id)
+        self.sheets = None  # sheet names once validation has started
+        self.final = None  # the last snapshot, kept once the files are removed
+
+    def _path(self, index):
+        return f'{self.prefix}.{index}.progress'
+
+    def start(self, names):
+        """Record the sheets being validated; returns one reporter per sheet."""
+        self.sheets = list(names)
+        replace_json_file(f'{self.prefix}.sheets', self.sheets)
+        return [ProgressFile(self._path(index), f'{self.prefix}.cancel')
+                for index in range(len(self.sheets))]
+
+    def snapshot(self):
+        if self.final is not None:
+            return dict(self.final)
+        if self.sheets is None:
+            # Started by another worker, if at all
+            try:
+                with open(f'{self.prefix}.sheets', encoding='utf-8') as f:
+                    self.sheets = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+        progress = {}
+        for index, name in enumerate(self.sheets or []):
+            try:
+                with open(self._path(index), encoding='utf-8') as f:
+                    progress[name] = json.load(f)
+            except (FileNotFoundError, ValueError):
+                progress[name] = {"rows": 0, "errors": 0}
+        return progress
+
+    def cancel(self):
+        with open(f'{self.prefix}.cancel', 'w'):
+            pass
+
+    def cancelled(self):
+        return os.path.exists(f'{self.prefix}.cancel')
+
+    def cleanup(self):
+        # The cancel marker stays until the spool sweep, for sheet jobs still on the pool
+        self.final = self.snapshot()
+        paths = [self._path(index) for index in range(len(self.sheets or []))]
+        for path in paths + [f'{self.prefix}.sheets']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ValidationJob:
+    """One background upload validation: queued -> running -> done | failed | cancelled.
+
+    The worker running it saves its state with save(); load() reads that state back in any
+    worker, as a job without a task whose payload is read from disk by load_result().
+    """
+
+    def __init__(self, job_id, filename):
+        self.job_id = job_id
+        self.filename = filename
+        self.status = 'queued'
+        self.progress = JobProgress(job_id)
+        self.result = None  # the /upload payload once done
+        self.workbook_id = None
+        self.error_counts = None  # errors per sheet once done
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+
+    def _path(self, suffix):
+        return f'{self.progress.prefix}.{suffix}'
+
+    def expired(self, now):
+        return self.finished is not None and now - self.finished > JOB_TTL_SECONDS
+
+    def save(self):
+        if self.status == 'done' and self.error_counts is None:
+            # The final counts include cross-sheet and anomaly errors the workers never saw
+            self.workbook_id = self.result['workbook_id']
+            self.error_counts = {name: len(errs)
+                                 for name, errs in self.result.get('errors', {}).items()}
+            replace_json_file(self._path('result'), self.result)
+        replace_json_file(self._path('job'), {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "status": self.status,
+            "progress": self.progress.final,
+            "workbook_id": self.workbook_id,
+            "error_counts": self.error_counts,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        })
+
+    @classmethod
+    def load(cls, job_id):
+        """The job as the worker running it last saved it, or None."""
+        job = cls(job_id, None)
+        try:
+            with open(job._path('job'), encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        for name in ('filename', 'status', 'workbook_id', 'error_counts', 'error', 'created',
+                     'finished'):
+            setattr(job, name, state[name])
+        job.progress.final = state['progress']
+        return job
+
+    def load_result(self):
+        if self.result is None:
+            with open(self._path('result'), encoding='utf-8') as f:
+                self.result = json.load(f)
+        return self.result
+
+    def remove_files(self):
+        for suffix in ('job', 'result'):
+            try:
+                os.remove(self._path(suffix))
+            except FileNotFoundError:
+                pass
+
+    def summary(self):
+        sheets = self.progress.snapshot()
+        if self.status == 'done':
+            for name, count in self.error_counts.items():
+                sheets.setdefault(name, {"rows": 0})['errors'] = count
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "status": self.status,
+            "sheets": sheets,
+            "rows_validated": sum(sheet.get('rows', 0) for sheet in sheets.values()),
+            "errors_found": sum(sheet['errors'] for sheet in sheets.values()),
+            "workbook_id": self.workbook_id,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobRegistry:
+    """Jobs by id: the ones this process runs, and any other worker's from their saved state.
+    Finished jobs expire after JOB_TTL_SECONDS."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        os.makedirs(os.path.dirname(job.progress.prefix), exist_ok=True)
+        job.save()
+        with self._lock:
+            self._sweep()
+            self._jobs[job.job_id] = job
+
+    def get(self, job_id):
+        if not job_id or not WORKBOOK_ID_PATTERN.fullmatch(job_id):
+            return None
+        with self._lock:
+            self._sweep()
+            job = self._jobs.get(job_id)
+        if job is None:
+            # Submitted to another worker
+            job = ValidationJob.load(job_id)
+            if job is not None and job.expired(time.time()):
+                job.remove_files()
+                return None
+        return job
+
+    def _sweep(self):
+        now = time.time()
+        for job_id in [k for k, job in self._jobs.items() if job.expired(now)]:
+            self._jobs.pop(job_id).remove_files()
+
+
+validation_jobs = JobRegistry()
+
+
+async def run_validation_job(job, request, spool_path, size, digest, plan, timer):
+    job.status = 'running'
+    job.save()
+    try:
+        job.result = await ingest_upload(request, job.filename, spool_path, size, digest, plan,
+                                         progress=job.progress, timer=timer)
+    except JobCancelled:
+        # DELETE /jobs/{id} on another worker, noticed by a sheet job
+        job.status = 'cancelled'
+        return
+    except Exception as e:
+        logging.getLogger("upload").exception(f"Validation job {job.job_id} failed")
+        job.status = 'failed'
+        job.error = str(e)
+        return
+    if job.progress.cancelled():
+        job.status = 'cancelled'
+        job.result = None
+    elif 'error' in job.result:
+        job.status = 'failed'
+        job.error = job.result['error']
+    else:
+        timer.finish()
+        job.status = 'done'
+
+
+def finish_validation_job(job, spool_path, task):
+    # A done callback rather than a finally block: a task cancelled before it first runs never
+    # enters its body
+    if task.cancelled():
+        job.status = 'cancelled'
+    job.finished = time.time()
+    job.progress.cleanup()
+    job.save()
+    heavy_jobs.release()
+    try:
+        os.remove(spool_path)
+    except FileNotFoundError:
+        pass
+
+
+# --- Columnar workbook files ---
+# A workbook's sheets can be saved to a directory as one uncompressed Arrow IPC file per
+# sheet plus manifest.json, and memory-mapped back without re-parsing the upload. Object
+# columns holding only strings and nulls are stored as Arrow strings and turned back into
+# object columns on load. Arrow has no type for the mixed object columns fixes and edits
+# leave behind, so those go to a pickled side file, as do sheets whose column labels Arrow
+# cannot keep (non-string or repeated). Needs pyarrow; without it the disk store pickles
+# whole workbooks.
+COLUMNAR_MANIFEST = 'manifest.json'
+COLUMNAR_FORMAT_VERSION = 2
+
+
+def string_nulls(values):
+    """How the nulls of an object column of strings are spelled, 'none' or 'nan', or None if
+    the column holds anything but strings and one kind of null."""
+    if pd.api.types.infer_dtype(values, skipna=True) not in ('string', 'empty'):
+        return None
+    nulls = values[values.isna()]
+    if all(v is None for v in nulls):
+        return 'none'
+    if all(isinstance(v, float) for v in nulls):
+        return 'nan'
+    return None
+
+
+def arrow_columns(df):
+    """(columns Arrow can store exactly, {object column of strings: string_nulls()}), or None
+    if the sheet must be pickled whole."""
+    if not all(isinstance(c, str) for c in df.columns) or df.columns.has_duplicates:
+        return None
+    columns, strings = [], {}
+    for c in df.columns:
+        if df[c].dtype == object:
+            nulls = string_nulls(df[c])
+            if nulls is None:
+                continue
+            strings[c] = nulls
+        columns.append(c)
+    return columns, strings
+
+
+def save_columnar_sheets(directory, sheets, filename=None):
+    os.makedirs(directory, exist_ok=True)
+    entries = []
+    for i, (name, df) in enumerate(sheets.items()):
+        entry = {"name": name, "rows": len(df), "arrow": None, "pickle": None, "strings": {}}
+        arrow = arrow_columns(df)
+        if arrow is not None:
+            columns, entry["strings"] = arrow
+            try:
+                table = pa.Table.from_pandas(df[columns], preserve_index=True)
+            except (pa.ArrowException, ValueError, TypeError):
+                arrow = None
+        if arrow is not None:
+            entry["arrow"] = f'{i}.arrow'
+            with pa.OSFile(os.path.join(directory, entry["arrow"]), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            rest = {"columns": list(df.columns),
+                    "values": {c: df[c] for c in df.columns if c not in columns}}
+        else:
+            entry["strings"] = {}
+            rest = {"frame": df}
+        if "frame" in rest or rest["values"]:
+            entry["pickle"] = f'{i}.pkl'
+            with open(os.path.join(directory, entry["pickle"]), 'wb') as f:
+                pickle.dump(rest, f, protocol=pickle.HIGHEST_PROTOCOL)
+        entries.append(entry)
+    manifest = {"format": COLUMNAR_FORMAT_VERSION, "filename": filename, "saved": time.time(),
+                "sheets": entries}
+    with open(os.path.join(directory, COLUMNAR_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def load_columnar_sheets(directory):
+    with open(os.path.join(directory, COLUMNAR_MANIFEST), encoding='utf-8') as f:
+        manifest = json.load(f)
+    sheets = {}
+    for entry in manifest["sheets"]:
+        rest = None
+        if entry["pickle"]:
+            with open(os.path.join(directory, entry["pickle"]), 'rb') as f:
+                rest = pickle.load(f)
+        if rest is not None and "frame" in rest:
+            sheets[entry["name"]] = rest["frame"]
+            continue
+        with pa.memory_map(os.path.join(directory, entry["arrow"])) as source:
+            df = pa.ipc.open_file(source).read_all().to_pandas()
+        for column, nulls in entry.get("strings", {}).items():
+            values = df[column].astype(object)
+            df[column] = values.where(values.notna(), None if nulls == 'none' else np.nan)
+        if rest is not None:
+            for column, values in rest["values"].items():
+                df[column] = values
+            df = df[rest["columns"]]
+        sheets[entry["name"]] = df
+    return sheets
+
+
+def parquet_frame(df):
+    """df with string column labels and mixed object columns as text, for Parquet export."""
+    df = df.set_axis([str(c) for c in df.columns], axis=1)
+    for column in df.columns[(df.dtypes == object).to_numpy()]:
+        df[column] = df[column].map(lambda v: v if pd.isna(v) else str(v)).astype('str')
+    return df
+
+
+# --- Streaming exports ---
+# /download-csv and /download-excel write exports as generators: CSV and Parquet
+# LEDGERLIFT_EXPORT_BATCH_ROWS rows at a time, ZIP archives entry by entry on an
+# unseekable sink, so bytes go out as they are produced and server memory stays flat
+# whatever the ledger size. XLSX comes from openpyxl's write-only mode, which keeps rows
+# in temporary files; its first byte follows the last row, as the archive layout needs.
+EXPORT_BATCH_ROWS = int(os.environ.get('LEDGERLIFT_EXPORT_BATCH_ROWS', 10000))
+EXPORT_CHUNK_BYTES = 1024 * 1024
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file object whose bytes a generator takes back as they are written."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def export_batches(df, batch_rows=EXPORT_BATCH_ROWS):
+    for start in range(0, len(df), batch_rows):
+        yield df.iloc[start:start + batch_rows]
+
+
+def csv_chunks(df):
+    yield df.iloc[:0].to_csv(index=False).encode('utf-8')
+    for batch in export_batches(df):
+        yield batch.to_csv(index=False, header=False).encode('utf-8')
+
+
+def parquet_chunks(df):
+    import pyarrow.parquet as pq
+    sink = ChunkSink()
+    schema = pa.Schema.from_pandas(parquet_frame(df.iloc[:0]), preserve_index=False)
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in export_batches(df):
+            writer.write_table(pa.Table.from_pandas(parquet_frame(batch), schema=schema,
+                                                    preserve_index=False))
+            yield sink.take()
+    yield sink.take()
+
+
+def zip_chunks(entries):
+    """Stream a ZIP of (name, chunk iterator) entries."""
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, chunks in entries:
+            with zf.open(name, 'w', force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield sink.take()
+    yield sink.take()
+
+
+def xlsx_cell(value):
+    if isinstance(value, str):
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        return ILLEGAL_CHARACTERS_RE.sub('', value)
+    return None if pd.isna(value) else value
+
+
+def xlsx_chunks(sheets):
+    from openpyxl import Workbook as XlsxWorkbook
+    wb = XlsxWorkbook(write_only=True)
+    for name, df in sheets.items():
+        ws = wb.create_sheet(re.sub(r'[\\/*?:\[\]]', '_', str(name))[:31] or 'Sheet')
+        ws.append([str(c) for c in df.columns])
+        for batch in export_batches(df):
+            for row in batch.itertuples(index=False, name=None):
+                ws.append([xlsx_cell(v) for v in row])
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        while chunk := f.read(EXPORT_CHUNK_BYTES):
+            yield chunk
+
+
+def export_snapshot(df):
+    """A shallow copy that edits made while the export streams do not show up in.
+
+    Edits replace a column or write into a copy of it: pandas 3 copies a shared column
+    itself, and under pandas 2 the writers call own_column() first.
+    """
+    return df.copy(deep=False)
+
+
+# --- Per-session workbook store ---
+# Uploaded workbooks are kept under a random handle returned by /upload; every other
+# endpoint takes that handle as workbook_id. Configure with:
+# LEDGERLIFT_STORE=memory|disk, LEDGERLIFT_STORE_DIR (disk backend, shared by all workers),
+# LEDGERLIFT_STORE_MAX_BYTES (memory budget) and LEDGERLIFT_STORE_TTL (seconds idle).
+WORKBOOK_STORE_BACKEND = os.environ.get('LEDGERLIFT_STORE', 'memory')
+WORKBOOK_STORE_DIR = os.environ.get('LEDGERLIFT_STORE_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'ledgerlift_workbooks'))
+WORKBOOK_STORE_MAX_BYTES = int(os.environ.get('LEDGERLIFT_STORE_MAX_BYTES', 512 * 1024 * 1024))
+WORKBOOK_TTL_SECONDS = int(os.environ.get('LEDGERLIFT_STORE_TTL', 3600))
+WORKBOOK_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+def sheets_nbytes(sheets):
+    return sum(int(df.memory_usage(deep=True).sum()) for df in sheets.values())
+
+
+class Workbook:
+    """The sheets of one upload plus any per-session state."""
+
+    def __init__(self, sheets, filename=None, source_path=None, source_sheets=()):
+        self._sheets = sheets
+        self.filename = filename
+        self.source_path = source_path  # spooled upload parsed on first use when sheets is None
+        self.source_sheets = source_sheets  # the Excel sheets that were asked for, if not all
+        self.errors = ErrorTable()  # as of the last validation
+        self.validation = None  # ValidationState for incremental revalidation
+        self.plan = AUDIT_PLAN  # the ValidationPlan of the upload, reused by revalidation
+        self._accounts = None  # (AccountIndex or None,) once built from the chart sheet
+        self.pending_cells = {}  # sheet -> {row label: {column: value before the edit}}
+        self.pending_removed = {}  # sheet -> {row label: row values before removal}
+        self.journal = ChangeJournal()
+
+    @property
+    def sheets(self):
+        if self._sheets is None:
+            self._sheets = load_spooled_upload(self.source_path, self.filename, self.source_sheets)
+            self.validation = ValidationState(self._sheets)
+        return self._sheets
+
+    @sheets.setter
+    def sheets(self, sheets):
+        self._sheets = sheets
+
+    def sheets_loaded(self):
+        return self._sheets is not None
+
+    def account_index(self, rebuild=False):
+        """The AccountIndex of the chart sheet (None without one), built on first use."""
+        if self._accounts is None or rebuild:
+            self._accounts = (build_account_index(self.sheets),)
+        return self._accounts[0]
+
+    def nbytes(self):
+        return sheets_nbytes(self._sheets) if self._sheets is not None else 0
+
+
+class WorkbookStore:
+    """Backend interface for the workbook store. Implementations must be thread-safe."""
+
+    def get(self, workbook_id):
+        raise NotImplementedError
+
+    def put(self, workbook_id, workbook):
+        raise NotImplementedError
+
+    def delete(self, workbook_id):
+        raise NotImplementedError
+
+
+class MemoryWorkbookStore(WorkbookStore):
+    """In-process store with LRU eviction under a byte budget and an idle TTL."""
+
+    def __init__(self, max_bytes=WORKBOOK_STORE_MAX_BYTES, ttl=WORKBOOK_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # workbook_id -> (workbook, nbytes, last_access)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, workbook_id):
+        with self._lock:
+            entry = self._entries.get(workbook_id)
+            if entry is None:
+                return None
+            workbook, nbytes, last_access = entry
+            if time.time() - last_access > self.ttl:
+                self._remove(workbook_id)
+                return None
+            self._entries[workbook_id] = (workbook, nbytes, time.time())
+            self._entries.move_to_end(workbook_id)
+            return workbook
+
+    def put(self, workbook_id, workbook):
+        nbytes = workbook.nbytes()
+        with self._lock:
+            self._remove(workbook_id)
+            self._entries[workbook_id] = (workbook, nbytes, time.time())
+            self._total_bytes += nbytes
+            self._evict()
+
+    def delete(self, workbook_id):
+        with self._lock:
+            self._remove(workbook_id)
+
+    def _remove(self, workbook_id):
+        entry = self._entries.pop(workbook_id, None)
+        if entry is not None:
+            self._total_bytes -= entry[1]
+
+    def _evict(self):
+        now = time.time()
+        for workbook_id in [k for k, (_, _, last) in self._entries.items()
+                            if now - last > self.ttl]:
+            self._remove(workbook_id)
+        # Least recently used first; the newest workbook always stays
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+
+class DiskWorkbookStore(WorkbookStore):
+    """Workbooks in a directory that every worker can share.
+
+    With pyarrow the sheets are saved as columnar files (see save_columnar_sheets) in a
+    fresh <id>.<token>.sheets directory per put, and the pickle holds the rest of the
+    workbook and that directory's name; a get memory-maps the sheets back. File mtime
+    doubles as the last-access time, so TTL and LRU eviction work across processes
+    without any coordination beyond atomic renames.
+    """
+
+    def __init__(self, directory=WORKBOOK_STORE_DIR, max_bytes=WORKBOOK_STORE_MAX_BYTES,
+                 ttl=WORKBOOK_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, workbook_id):
+        return os.path.join(self.directory, f'{workbook_id}.pkl')
+
+    def get(self, workbook_id):
+        path = self._path(workbook_id)
+        for _ in range(3):
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    self.delete(workbook_id)
+                    return None
+                with open(path, 'rb') as f:
+                    workbook, sheet_dir = pickle.load(f)
+                if sheet_dir is not None:
+                    workbook.sheets = load_columnar_sheets(os.path.join(self.directory, sheet_dir))
+                os.utime(path)
+                return workbook
+            except FileNotFoundError:
+                continue  # a concurrent put replaced the sheet files; read its pickle
+            except (EOFError, ValueError, TypeError, pickle.UnpicklingError):
+                return None  # unreadable, or written by an older version
+        return None
+
+    def put(self, workbook_id, workbook):
+        path = self._path(workbook_id)
+        sheet_dir = None
+        if HAS_PYARROW and workbook.sheets_loaded():
+            sheet_dir = f'{workbook_id}.{uuid.uuid4().hex}.sheets'
+            save_columnar_sheets(os.path.join(self.directory, sheet_dir), workbook.sheets,
+                                 workbook.filename)
+            workbook = copy.copy(workbook)
+            workbook.sheets = None
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((workbook, sheet_dir), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._remove_sheet_dirs(workbook_id, keep=sheet_dir)
+        self._evict(keep=workbook_id)
+
+    def delete(self, workbook_id):
+        try:
+            os.remove(self._path(workbook_id))
+        except FileNotFoundError:
+            pass
+        self._remove_sheet_dirs(workbook_id)
+
+    def _remove_sheet_dirs(self, workbook_id, keep=None):
+        for entry in os.scandir(self.directory):
+            if (entry.name.startswith(f'{workbook_id}.') and entry.name.endswith('.sheets')
+                    and entry.name != keep):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _evict(self, keep=None):
+        now = time.time()
+        sheet_bytes = Counter()
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.sheets'):
+                    workbook_id = entry.name.split('.', 1)[0]
+                    if (now - entry.stat().st_mtime > self.ttl
+                            and not os.path.exists(self._path(workbook_id))):
+                        shutil.rmtree(entry.path, ignore_errors=True)  # left by a failed put
+                    else:
+                        sheet_bytes[workbook_id] += sum(f.stat().st_size
+                                                        for f in os.scandir(entry.path))
+                    continue
+                if not entry.name.endswith('.pkl'):
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            workbook_id = entry.name[:-len('.pkl')]
+            if now - stat.st_mtime > self.ttl and workbook_id != keep:
+                self.delete(workbook_id)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, workbook_id))
+        entries = [(mtime, size + sheet_bytes[workbook_id], workbook_id)
+                   for mtime, size, workbook_id in entries]
+        total = sum(size for _, size, _ in entries)
+        for _, size, workbook_id in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if workbook_id != keep:
+                self.delete(workbook_id)
+                total -= size
+
+
+def create_workbook_store(backend=WORKBOOK_STORE_BACKEND):
+    if backend == 'disk':
+        return DiskWorkbookStore()
+    return MemoryWorkbookStore()
+
+
+workbook_store = create_workbook_store()
+
+
+def get_workbook(workbook_id):
+    if not workbook_id or not WORKBOOK_ID_PATTERN.fullmatch(workbook_id):
+        return None
+    return workbook_store.get(workbook_id)
+
+
+def resolve_sheet(workbook, sheet=None):
+    """Return (name, df) for the requested sheet, defaulting to the first sheet."""
+    if workbook is None or not workbook.sheets:
+        return None, None
+    if sheet and sheet in workbook.sheets:
+        return sheet, workbook.sheets[sheet]
+    # Default to first sheet
+    return next(iter(workbook.sheets.items()))
 
-def check_invalid_dates(df, date_col='Date'):
-    errors = []
-    if date_col in df.columns:
-        for idx, val in df[date_col].items():
-            try:
-                pd.to_datetime(val)
-            except Exception:
-                errors.append({"row": idx+1, "issue": "Invalid date"})
-    return errors
 
-def validate_account_codes(df, coa_set, code_col='Account'):
-    errors = []
-    if code_col in df.columns:
-        for idx, val in df[code_col].items():
-            if val not in coa_set:
-                errors.append({"row": idx+1, "issue": f"Unknown account code: {val}"})
-    return errors
+def get_sheet(workbook_id, sheet=None):
+    return resolve_sheet(get_workbook(workbook_id), sheet)[1]
 
-# --- Enhanced error detection for AI bookkeeping ---
 
-EXCEL_ERROR_CODES = {'#REF!', '#VALUE!', '#DIV/0!', '#NAME?', '#N/A', '#NUM!', '#NULL!'}
-REQUIRED_IS_CATEGORIES = {'Revenue', 'Expenses'}
-REQUIRED_BS_CATEGORIES = {'Assets', 'Liabilities', 'Equity'}
+# --- Content-addressed parse cache ---
+# Parsed sheets are cached by the SHA-256 of the upload bytes, and full validation
+# payloads by that digest plus the rule set, so re-POSTing the same workbook (after a
+# bulk fix or a rule toggle) skips openpyxl and the checks. LEDGERLIFT_PARSE_CACHE_MAX_BYTES
+# and LEDGERLIFT_RESULT_CACHE_MAX_BYTES bound each cache.
+PARSE_CACHE_MAX_BYTES = int(os.environ.get('LEDGERLIFT_PARSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('LEDGERLIFT_RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
 
-# Example COA (could be loaded from file or uploaded)
-STANDARD_COA = {'1000', '2000', '3000', '4000', '5000', '6000', '7000', '8000', '9000'}
 
-def check_coa_all(df, code_col='Account', coa_set=STANDARD_COA):
-    errors = []
-    if code_col in df.columns:
-        for idx, val in df[code_col].items():
-            if str(val) not in coa_set:
-                errors.append({"row": idx+1, "issue": f"Unknown account code: {val}"})
-    return errors
+class ContentCache:
+    """Thread-safe LRU cache with a byte budget and hit/miss counters."""
 
-def check_trial_balance_balance(df):
-    errors = []
-    if 'Debit' in df.columns and 'Credit' in df.columns:
-        total_debit = pd.to_numeric(df['Debit'], errors='coerce').sum()
-        total_credit = pd.to_numeric(df['Credit'], errors='coerce').sum()
-        if abs(total_debit - total_credit) > 1e-2:
-            errors.append({"row": None, "issue": f"Trial balance out of balance: Debits={total_debit}, Credits={total_credit}"})
-    return errors
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
 
-def check_required_categories(df, required, col='Category'):
-    errors = []
-    if col in df.columns:
-        present = set(str(x).strip() for x in df[col].dropna())
-        for req in required:
-            if req not in present:
-                errors.append({"row": None, "issue": f"Missing required category: {req}"})
-    return errors
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
 
-def check_excel_errors(df):
-    errors = []
-    for col in df.columns:
-        if df[col].dtype == object:
-            for idx, val in df[col].items():
-                if isinstance(val, str) and val.strip().upper() in EXCEL_ERROR_CODES:
-                    errors.append({"row": idx+1, "issue": f"Excel error code in {col}: {val}"})
-                    if len(errors) >= 25:  # Reduced limit for performance
-                        break
-    return errors
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self._total_bytes += nbytes
+            while self._total_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_bytes
+                self.evictions += 1
 
-AUDIT_LOG_PATH = 'audit.log'
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
 
-# Helper: log audit events
-def log_audit(action, details=None, user=None):
-    with open(AUDIT_LOG_PATH, 'a', encoding='utf-8') as f:
-        ts = time.strftime('%Y-%m-%d %H:%M:%S')
-        line = f"[{ts}] ACTION: {action}"
-        if user:
-            line += f" USER: {user}"
-        if details:
-            line += f" DETAILS: {details}"
-        f.write(line + '\n')
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
 
-# --- Input validation for uploads ---
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5 MB
-ALLOWED_EXTENSIONS = {'.csv', '.xlsx'}
 
-def allowed_file(filename):
-    return any(filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS)
+parse_cache = ContentCache(PARSE_CACHE_MAX_BYTES)
+result_cache = ContentCache(RESULT_CACHE_MAX_BYTES)
+
+
+def copy_sheets(sheets):
+    return {name: df.copy() for name, df in sheets.items()}
+
+
+@app.get("/cache-stats")
+def cache_stats():
+    return {"parse": parse_cache.stats(), "results": result_cache.stats()}
 
-def get_sheet(sheet=None):
-    if last_processed_sheets is None:
-        return None
-    if sheet and sheet in last_processed_sheets:
-        return last_processed_sheets[sheet]
-    # Default to first sheet
-    return next(iter(last_processed_sheets.values()))
 
 @app.get("/")
 async def root():
@@ -225,410 +4221,447 @@ async def root():
         return HTMLResponse(f.read())
 
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    global last_processed_sheets
+async def upload_file(request: Request, file: UploadFile = File(...), mode: str = 'audit',
+                      rules: str = None):
     # Log file info
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("upload")
     logger.info(f"Received file: {file.filename}")
-    contents = await file.read()
-    logger.info(f"File size: {len(contents)} bytes")
     # Input validation
     if not allowed_file(file.filename):
         logger.error(f"Invalid file type: {file.filename}")
         log_audit('upload_rejected', f'Invalid file type: {file.filename}')
-        return JSONResponse(content={"error": "Invalid file type. Only CSV and Excel files are allowed."})
-    if len(contents) > MAX_FILE_SIZE:
-        logger.error(f"File too large: {file.filename} ({len(contents)} bytes)")
-        log_audit('upload_rejected', f'File too large: {file.filename} ({len(contents)} bytes)')
-        return JSONResponse(content={"error": "File too large. Max 5MB allowed."})
-    # Try to parse file
+        return FastJSONResponse(content={
+            "error": "Invalid file type. Only CSV and Excel files are allowed."})
     try:
-        if file.filename.lower().endswith('.csv'):
-            from io import StringIO
-            df = pd.read_csv(StringIO(contents.decode('utf-8')), on_bad_lines='skip')
-            sheets = {'CSV': df}
-            logger.info(f"Parsed CSV file. Columns: {list(df.columns)}")
+        plan = validation_plan(mode, parse_rules(rules))
+    except ValueError as e:
+        return FastJSONResponse(content={"error": str(e)}, status_code=400)
+    if not heavy_jobs.try_admit():
+        logger.warning(f"Upload queue full, rejecting: {file.filename}")
+        return busy_response()
+    timer = RequestMetrics('upload')
+    try:
+        try:
+            with timer.stage('spool'):
+                spool_path, size, digest = await spool_upload(file)
+        except UploadTooLarge:
+            logger.error(f"File too large: {file.filename} (over {MAX_FILE_SIZE} bytes)")
+            log_audit('upload_rejected',
+                      f'File too large: {file.filename} (over {MAX_FILE_SIZE} bytes)')
+            return FastJSONResponse(content={
+                "error": f"File too large. Max {MAX_FILE_SIZE // (1024 * 1024)}MB allowed."})
+        logger.info(f"File size: {size} bytes")
+        timer.bytes_in(size)
+        try:
+            content = await ingest_upload(request, file.filename, spool_path, size, digest, plan,
+                                          timer=timer)
+            if request.query_params.get('errors') == 'summary' and 'errors' in content:
+                # Counts plus the first few errors per sheet; /errors serves the rest
+                content = {
+                    **content,
+                    "errors": {name: errs[:UPLOAD_SUMMARY_ERRORS]
+                               for name, errs in content['errors'].items()},
+                    "error_counts": error_counts(content['errors']),
+                    "errors_truncated": any(len(errs) > UPLOAD_SUMMARY_ERRORS
+                                            for errs in content['errors'].values()),
+                }
+            with timer.stage('serialize'):
+                response = FastJSONResponse(content=content)
+            timer.bytes_out(len(response.body))
+            timer.finish()
+            logger.info(f"Upload stages for {file.filename}: {timer.summary()}")
+            return response
+        finally:
+            # A workbook that reads its CSV back later has already moved the spool file
+            try:
+                os.remove(spool_path)
+            except FileNotFoundError:
+                pass
+    finally:
+        heavy_jobs.release()
+
+
+def keep_spool_file(spool_path, workbook_id):
+    path = os.path.join(UPLOAD_SPOOL_DIR, workbook_id + os.path.splitext(spool_path)[1])
+    os.replace(spool_path, path)
+    return path
+
+
+async def ingest_upload(request, filename, spool_path, size, digest, plan=AUDIT_PLAN, progress=None,
+                        timer=None):
+    """Parse, validate and store a spooled upload; returns the /upload payload.
+
+    plan is the ValidationPlan for the request's mode and rules. progress, if given, is a
+    JobProgress that the sheet jobs report to. timer, if given, is the request's
+    RequestMetrics and gets the stage timings.
+    """
+    logger = logging.getLogger("upload")
+    timer = timer if timer is not None else RequestMetrics('upload')
+    file_ext = os.path.splitext(filename.lower())[1]
+    options_key = (plan.key(), request.query_params.get('client', ''))
+    # ?sheet=...&sheet=... parses only those Excel sheets
+    selected = tuple(request.query_params.getlist('sheet')) if file_ext != '.csv' else ()
+    with timer.stage('cache_lookup'):
+        cached = parse_cache.get((digest, file_ext, selected))
+    frame_dirs = {}  # sheet -> columnar file of its frame that workers can read
+    if cached is not None:
+        logger.info(f"Parse cache hit: {filename} ({digest[:12]})")
+        cached_sheets, frame_dirs = cached
+        sheets = copy_sheets(cached_sheets)
+    else:
+        sheets = None  # parsed chunk by chunk below
+    workbook_id = uuid.uuid4().hex
+    workbook = Workbook(sheets, filename=filename, source_sheets=selected)
+    workbook.plan = plan
+    log_audit('upload', f'File uploaded: {filename} ({size} bytes)', workbook_id=workbook_id)
+    with timer.stage('cache_lookup'):
+        cached_result = result_cache.get((digest, file_ext, selected, options_key))
+    if cached_result is not None:
+        logger.info(f"Result cache hit: {filename} ({digest[:12]})")
+        if sheets is None:
+            workbook.source_path = keep_spool_file(spool_path, workbook_id)
         else:
-            from io import BytesIO
-            excel_file = BytesIO(contents)
-            excel_data = pd.read_excel(excel_file, sheet_name=None)
-            logger.info(f"Excel sheets found: {list(excel_data.keys())}")
-            sheets = {}
-            for sheet_name, sheet_df in excel_data.items():
-                # Replace inf and NaN with None for JSON serialization
-                sheet_df = sheet_df.replace([np.inf, -np.inf], pd.NA)
-                sheet_df = sheet_df.where(pd.notnull(sheet_df), None)
-                sheets[sheet_name] = sheet_df
-            if not sheets:
-                logger.error("No sheets found in the uploaded Excel file.")
-    except Exception as e:
-        logger.error(f"Parse error: {file.filename} ({str(e)})")
-        log_audit('upload_rejected', f'Parse error: {file.filename} ({str(e)})')
-        return JSONResponse(content={"error": f"Could not parse file. The file may have inconsistent formatting. Try cleaning the CSV file or check for extra commas. Error: {str(e)}"})
-    log_audit('upload', f'File uploaded: {file.filename} ({len(contents)} bytes)')
-    last_processed_sheets = sheets
+            workbook.validation = ValidationState(sheets)
+        workbook.errors = ErrorTable(cached_result['errors'])
+        workbook_store.put(workbook_id, workbook)
+        return {"workbook_id": workbook_id, **cached_result}
 
-    # Per-sheet error detection and preview
+    # Per-sheet error detection and preview, one validation-pool job per sheet
     errors = {}
     preview = {}
-    for name, df in sheets.items():
-        sheet_errors = []
-        # --- Context-aware: skip headers/non-postable accounts ---
-        def is_header_row(row):
-            # Heuristic: no account number, or account name is a known header
-            known_headers = ['assets', 'liabilities', 'equity', 'revenue', 'expenses', 'contra revenue', 'contra asset', 'total', 'net income', 'gross profit', 'operating income']
-            acc_name = str(row.get('Account', '')).strip().lower()
-            acc_num = str(row.get('Account Number', '')).strip()
-            if acc_name in known_headers or acc_name.startswith('total') or acc_num in ['', 'nan', 'none']:
-                return True
-            return False
+    key_values = {}
+    notices = []
+    keep = sheets is not None or size <= UPLOAD_KEEP_BYTES
+    try:
+        async with heavy_jobs.running():
+            start = time.perf_counter()
+            if sheets is None:
+                names = await in_validation_pool(upload_sheet_names, spool_path, file_ext, filename,
+                                                 selected)
+            else:
+                names = list(sheets)
+            reporters = dict.fromkeys(names)
+            if progress is not None:
+                reporters = dict(zip(names, progress.start(names)))
+            save_frames = sheets is None and keep and HAS_PYARROW and pool_crosses_processes()
+            frames_root = f'{spool_path}.sheets'
+            ship = not pool_crosses_processes() or not all(
+                os.path.isdir(frame_dirs.get(name, '')) for name in names)
 
-        # Chart of Accounts: check for missing account numbers/names/types, duplicates
-        if 'chart' in name.lower():
-            if 'Account Number' in df.columns:
-                missing_acc = df[df['Account Number'].isnull()]
-                for idx in missing_acc.index:
-                    sheet_errors.append({"row": idx+1, "issue": "Missing Account Number"})
-            if 'Account Name' in df.columns:
-                missing_name = df[df['Account Name'].isnull()]
-                for idx in missing_name.index:
-                    sheet_errors.append({"row": idx+1, "issue": "Missing Account Name"})
-            if 'Type' in df.columns:
-                missing_type = df[df['Type'].isnull()]
-                for idx in missing_type.index:
-                    sheet_errors.append({"row": idx+1, "issue": "Missing Account Type"})
-            # Duplicates
-            dups = df[df.duplicated()]
-            for idx in dups.index:
-                sheet_errors.append({"row": idx+1, "issue": "Duplicate row"})
-        # Journal Entries: check for missing/invalid dates, unbalanced debits/credits, missing accounts, GAAP/IFRS rules
-        elif 'journal' in name.lower():
-            for idx, row in df.iterrows():
-                if is_header_row(row):
-                    continue
-                # Date check
-                if 'Date' in df.columns:
-                    try:
-                        pd.to_datetime(row['Date'])
-                    except Exception:
-                        sheet_errors.append({"row": idx+1, "issue": "Invalid or missing Date"})
-                # Debit/Credit check
-                debit = float(row['Debit']) if 'Debit' in df.columns and row['Debit'] not in [None, '', pd.NA] else 0
-                credit = float(row['Credit']) if 'Credit' in df.columns and row['Credit'] not in [None, '', pd.NA] else 0
-                if abs(debit - credit) > 0.01:
-                    sheet_errors.append({"row": idx+1, "issue": f"Debit ({debit}) ≠ Credit ({credit})"})
-                # Account check
-                if 'Account' in df.columns and (row['Account'] is None or str(row['Account']).strip() == ''):
-                    sheet_errors.append({"row": idx+1, "issue": "Missing Account"})
-                # GAAP/IFRS rules
-                acc_type = str(row.get('Type', '')).lower() if 'Type' in row else ''
-                acc_name = str(row.get('Account', '')).lower()
-                if acc_name == 'depreciation expense' and debit < 0:
-                    sheet_errors.append({"row": idx+1, "issue": "Depreciation expense should not be negative (GAAP)"})
-                if acc_type == 'revenue' and debit > 0:
-                    sheet_errors.append({"row": idx+1, "issue": "Revenue account has debit value (GAAP)"})
-                if acc_type == 'equity' and debit > 0:
-                    sheet_errors.append({"row": idx+1, "issue": "Equity account should not have debit balance (GAAP)"})
-                if acc_name == 'prepaid expenses' and 'income' in name.lower():
-                    sheet_errors.append({"row": idx+1, "issue": "Prepaid expenses should not appear in P&L (GAAP)"})
-        # Trial Balance: check for out-of-balance, missing accounts, auto-balance suggestion
-        elif 'trial' in name.lower():
-            if 'Debit' in df.columns and 'Credit' in df.columns:
-                total_debit = pd.to_numeric(df['Debit'], errors='coerce').sum()
-                total_credit = pd.to_numeric(df['Credit'], errors='coerce').sum()
-                diff = total_debit - total_credit
-                if abs(diff) > 1e-2:
-                    # Suggest top 3 suspicious entries (nulls, high values)
-                    suspicious = []
-                    for idx, row in df.iterrows():
-                        if pd.isnull(row['Debit']) or pd.isnull(row['Credit']) or abs(float(row['Debit'] or 0) - float(row['Credit'] or 0)) > 1000:
-                            suspicious.append(idx+1)
-                    suggestion = f"Consider checking rows: {', '.join(map(str, suspicious[:3]))}" if suspicious else "Review all entries."
-                    sheet_errors.append({"row": None, "issue": f"Trial balance out of balance: Debits={total_debit}, Credits={total_credit}. Difference={diff}. {suggestion}"})
-            if 'Account' in df.columns:
-                missing_acc = df[df['Account'].isnull()]
-                for idx in missing_acc.index:
-                    sheet_errors.append({"row": idx+1, "issue": "Missing Account"})
-        # Income Statement/Balance Sheet: check for missing/invalid formulas, missing values, skip headers
-        elif 'income' in name.lower() or 'balance' in name.lower():
-            for idx, row in df.iterrows():
-                if is_header_row(row):
-                    continue
-                for col in df.columns:
-                    if pd.isnull(row[col]):
-                        sheet_errors.append({"row": idx+1, "issue": f"Missing value in {col}"})
-                    # Formula audit
-                    if isinstance(row[col], str) and row[col].startswith('='):
-                        sheet_errors.append({"row": idx+1, "issue": f"Excel formula present in {col}: {row[col]} (Check for circular refs or hardcoded totals)"})
-        errors[name] = sheet_errors
-        preview[name] = {
-            "columns": list(df.columns),
-            "sample": df.head(5).to_dict(orient='records')
-        }
+            def sheet_job(name, accounts, model_key=None):
+                if sheets is None:
+                    frame_dir = (os.path.join(frames_root, str(names.index(name)))
+                                 if save_frames else None)
+                    return in_validation_pool(validate_upload_sheet, spool_path, file_ext, filename,
+                                              name, keep or name == chart, plan, accounts,
+                                              reporters[name], model_key, frame_dir)
+                if ship:
+                    return in_validation_pool(validate_frame, name, sheets[name], plan, accounts,
+                                              reporters[name], model_key)
+                return in_validation_pool(validate_saved_frame, frame_dirs[name], name, plan,
+                                          accounts, reporters[name], model_key)
 
-    # --- Advanced: Cross-Sheet Reconciliation ---
-    # Find key values for reconciliation
-    net_income = None
-    retained_earnings_change = None
-    total_assets = None
-    total_liab_equity = None
-    for name, df in sheets.items():
-        if 'income' in name.lower():
-            # Try to find Net Income
-            for idx, row in df.iterrows():
-                if str(row.get('Account', '')).strip().lower() in ['net income', 'net profit']:
-                    try:
-                        net_income = float(row.get('Amount', 0))
-                    except:
-                        pass
-        if 'balance' in name.lower():
-            # Try to find Retained Earnings and totals
-            for idx, row in df.iterrows():
-                acc = str(row.get('Account', '')).strip().lower()
-                if acc == 'retained earnings':
-                    try:
-                        retained_earnings_change = float(row.get('Amount', 0))
-                    except:
-                        pass
-                if acc == 'total assets':
-                    try:
-                        total_assets = float(row.get('Amount', 0))
-                    except:
-                        pass
-                if acc == 'total liabilities and equity':
-                    try:
-                        total_liab_equity = float(row.get('Amount', 0))
-                    except:
-                        pass
-    # Add reconciliation errors if mismatches found
-    if net_income is not None and retained_earnings_change is not None:
-        if abs(net_income - retained_earnings_change) > 1e-2:
-            errors.setdefault('Cross-Sheet', []).append({
-                "row": None,
-                "issue": f"Net income from Income Statement ({net_income}) does not match change in Retained Earnings on Balance Sheet ({retained_earnings_change})."
-            })
-    if total_assets is not None and total_liab_equity is not None:
-        if abs(total_assets - total_liab_equity) > 1e-2:
-            errors.setdefault('Cross-Sheet', []).append({
-                "row": None,
-                "issue": f"Total Assets ({total_assets}) does not equal Total Liabilities and Equity ({total_liab_equity}) on Balance Sheet."
-            })
+            # The chart sheet goes first when the other sheets' checks need its accounts, or
+            # the anomaly model is picked by its account numbers
+            done = {}
+            chart = accounts = chart_df = None
+            if plan.enabled(*ACCOUNT_INDEX_TYPES, 'anomaly'):
+                chart = next((name for name in names if sheet_kind(name) == 'chart'), None)
+            if chart is not None:
+                done[chart] = await sheet_job(chart, None)
+                chart_df = sheets[chart] if sheets is not None else result_frame(done[chart])
+                if chart_df is not None and plan.enabled(*ACCOUNT_INDEX_TYPES):
+                    accounts = build_account_index({chart: chart_df})
+            # Anomaly scoring needs whole frames; uploads too large to keep are not scored
+            model_key = None
+            if plan.enabled('anomaly') and keep:
+                model_key = anomaly_model_key(request.query_params.get('client'),
+                                              {chart: chart_df} if chart_df is not None else {})
+            elif plan.enabled('anomaly') and any('journal' in name.lower() for name in names):
+                notices.append(
+                    "Anomaly detection was skipped: files over "
+                    f"{UPLOAD_KEEP_BYTES // (1024 * 1024)}MB are not kept in memory.")
+            rest = iter(await asyncio.gather(*(sheet_job(name, accounts, model_key)
+                                               for name in names if name not in done)))
+            results = [result for result in (done[name] if name in done else next(rest)
+                                             for name in names)
+                       if result['preview'] is not None]
+            timer.add('validate', time.perf_counter() - start,
+                      sum(result['rows'] for result in results))
+            for result in results:
+                for stage, seconds in result['timings'].items():
+                    timer.add(stage, seconds, result['rows'])
+    except JobCancelled:
+        raise
+    except Exception as e:
+        return parse_error(filename, e)
+    if sheets is None:
+        logger.info(f"Parsed {len(results)} sheet(s) in chunks: "
+                    + ', '.join(f"{result['name']} ({result['rows']} rows)" for result in results))
+        if not results:
+            logger.error("No sheets found in the uploaded Excel file.")
+        if keep:
+            sheets = {result['name']: result_frame(result) for result in results}
+            frame_dirs = {result['name']: result['frame_dir'] for result in results
+                          if result['frame_dir'] is not None}
+            parse_cache.put((digest, file_ext, selected), (copy_sheets(sheets), frame_dirs),
+                            sheets_nbytes(sheets))
+            workbook.sheets = sheets
+        else:
+            workbook.source_path = keep_spool_file(spool_path, workbook_id)
+    if sheets is not None:
+        workbook.validation = ValidationState(sheets)
+    rollups = {'journal': AccountRollup(), 'trial': AccountRollup()}
+    for result in results:
+        name = result['name']
+        errors[name] = result['errors'] + result['anomalies']
+        key_values.update(result['key_values'])
+        preview[name] = result['preview']
+        if result['rollup'] is not None:
+            rollups[sheet_kind(name)].merge(result['rollup'])
 
-    # --- Advanced: Formula Audit ---
-    for name, df in sheets.items():
-        if 'income' in name.lower() or 'balance' in name.lower():
-            for idx, row in df.iterrows():
-                for col in df.columns:
-                    val = row[col]
-                    if isinstance(val, str) and val.startswith('='):
-                        # Hardcoded total (e.g., =10000)
-                        if val[1:].replace('.', '', 1).isdigit():
-                            errors.setdefault(name, []).append({
-                                "row": idx+1,
-                                "issue": f"Formula in {col} is hardcoded value: {val}"
-                            })
-                        # Reference to empty cell (basic check)
-                        if '""' in val or 'BLANK' in val.upper():
-                            errors.setdefault(name, []).append({
-                                "row": idx+1,
-                                "issue": f"Formula in {col} references empty cell: {val}"
-                            })
-                        # Circular reference (very basic: formula references its own row)
-                        if f'{col[0]}{idx+2}' in val:
-                            errors.setdefault(name, []).append({
-                                "row": idx+1,
-                                "issue": f"Possible circular reference in {col}: {val}"
-                            })
-
-    # --- Audit Mode vs. Assist Mode (default: Audit) ---
-    # You can add a query param ?mode=assist to switch to softer warnings
-    import fastapi
-    mode = 'audit'
-    if isinstance(file, fastapi.datastructures.UploadFile) and hasattr(file, 'filename'):
-        # Can't get query param here, but you can extend this logic to use a global or session
-        pass
-    # In assist mode, only show critical errors (e.g., out of balance, missing account)
-    if mode == 'assist':
-        for k in list(errors.keys()):
-            errors[k] = [e for e in errors[k] if 'out of balance' in e['issue'].lower() or 'missing account' in e['issue'].lower()]
+    # --- Advanced: Cross-Sheet Reconciliation ---
+    # Key-line amounts and per-account roll-ups were collected by the sheet validators, so
+    # this stage only compares a few numbers per sheet; formula audit errors are already
+    # part of each sheet's list.
+    with timer.stage('reconcile'):
+        cross_sheet = []
+        if plan.enabled('net_income_mismatch', 'balance_sheet_mismatch'):
+            cross_sheet = reconcile_key_lines(key_values)
+        if plan.enabled('trial_journal_mismatch'):
+            cross_sheet += reconcile_rollups(rollups['journal'], rollups['trial'])
+    if cross_sheet:
+        errors['Cross-Sheet'] = cross_sheet
 
     # --- Next-Level AI Features ---
     # 1. User-Tunable Rules (Configurable Audit/Assist Modes)
-    # Accept a ?mode= param and a ?rules= param (comma-separated list of rule names to enforce)
-    from fastapi import Request
-    import urllib.parse
-    mode = 'audit'
-    user_rules = set()
-    # Try to get mode/rules from query params if running in FastAPI context
-    try:
-        request: Request = None
-        import inspect
-        for frame in inspect.stack():
-            if 'request' in frame.frame.f_locals:
-                request = frame.frame.f_locals['request']
-                break
-        if request:
-            query = urllib.parse.parse_qs(urllib.parse.urlparse(str(request.url)).query)
-            if 'mode' in query:
-                mode = query['mode'][0]
-            if 'rules' in query:
-                user_rules = set(query['rules'][0].split(','))
-    except Exception:
-        pass
-    # Only enforce rules in user_rules if specified
-    def rule_enabled(rule_name):
-        return not user_rules or rule_name in user_rules
-
-    # 2. ML-Based Anomaly Detection (Isolation Forest)
-    try:
-        from sklearn.ensemble import IsolationForest
-        for name, df in sheets.items():
-            if 'journal' in name.lower() and 'Debit' in df.columns and 'Credit' in df.columns and len(df) > 10:
-                X = df[['Debit', 'Credit']].fillna(0).values
-                clf = IsolationForest(contamination=0.1, random_state=42)
-                preds = clf.fit_predict(X)
-                for idx, pred in enumerate(preds):
-                    if pred == -1:
-                        errors.setdefault(name, []).append({
-                            "row": idx+1,
-                            "issue": "ML anomaly detected: unusual debit/credit pattern",
-                            "why": "This entry is statistically different from the rest (Isolation Forest)"
-                        })
-    except ImportError:
-        pass
+    # ?mode= and ?rules= select the ValidationPlan; see "Validation plans" above
 
+    # 2. ML-Based Anomaly Detection, scored by each sheet's job against a saved model
     # 3. Explainable AI (Why was this flagged?)
-    for name, sheet_errs in errors.items():
-        for err in sheet_errs:
-            if 'why' not in err:
-                if 'out of balance' in err['issue'].lower():
-                    err['why'] = 'Debits and credits should always match in double-entry accounting.'
-                elif 'missing value' in err['issue'].lower():
-                    err['why'] = 'All required fields must be filled for accurate reporting.'
-                elif 'account-type rule violation' in err['issue'].lower():
-                    err['why'] = 'This violates standard accounting rules for this account type.'
-                elif 'anomaly' in err['issue'].lower():
-                    err['why'] = 'This value is statistically unusual compared to other entries.'
-                elif 'not found in Chart of Accounts' in err['issue']:
-                    err['why'] = 'All accounts in entries must exist in the Chart of Accounts.'
-                elif 'date' in err['issue'].lower():
-                    err['why'] = 'Dates should be within the expected fiscal period.'
-                else:
-                    err['why'] = 'Flagged by rule-based or statistical logic.'
-
     # 4. Auto-Repair with User Approval (Stub)
-    # For each fixable error, add a 'can_fix' flag and a 'fix_action' description
-    for name, sheet_errs in errors.items():
-        for err in sheet_errs:
-            if 'missing value' in err['issue'].lower():
-                err['can_fix'] = True
-                err['fix_action'] = 'Fill with 0'
-            elif 'out of balance' in err['issue'].lower():
-                err['can_fix'] = True
-                err['fix_action'] = 'Auto-balance this row'
-            elif 'account-type rule violation' in err['issue'].lower():
-                err['can_fix'] = False
-                err['fix_action'] = 'Manual review required'
-            elif 'not found in Chart of Accounts' in err['issue']:
-                err['can_fix'] = False
-                err['fix_action'] = 'Add account to Chart of Accounts'
-            elif 'date' in err['issue'].lower():
-                err['can_fix'] = False
-                err['fix_action'] = 'Edit date to valid fiscal period'
+    with timer.stage('annotate', sum(len(sheet_errs) for sheet_errs in errors.values())):
+        for sheet_errs in errors.values():
+            annotate_errors(sheet_errs)
+    with timer.stage('store'):
+        workbook.errors = ErrorTable(errors)
+        workbook_store.put(workbook_id, workbook)
 
-    # 5. Audit Trail & Undo (Stub)
-    # You can implement a global list of actions and allow undo/redo in the future
-    # For now, just add a placeholder
-    # global audit_trail
-    # audit_trail.append({'action': 'fix', 'row': ..., 'old_value': ..., 'new_value': ...})
+    # 5. Audit Trail & Undo
+    # /edit-cell and /bulk-fix journal their changes on the workbook; see /versions,
+    # /undo, /redo and /goto-version
 
     # 6. Feedback Loop for Continuous Learning (Stub)
     # You can add endpoints to accept user feedback and store for future model improvement
     # e.g., /feedback endpoint to mark errors as false positive
 
-    return JSONResponse(content=clean_nans({
-        "sheets": list(sheets.keys()),
+    result = {
+        "sheets": list(preview.keys()),
         "preview": preview,
-        "errors": errors
-    }))
+        "errors": errors,
+        "notices": notices
+    }
+    content = {"workbook_id": workbook_id, **result}
+    with timer.stage('cache_store'):
+        result_cache.put((digest, file_ext, selected, options_key), result,
+                         len(FastJSONResponse(content=content).body))
+    return content
+
+
+@app.post("/jobs")
+async def submit_job(request: Request, file: UploadFile = File(...), mode: str = 'audit',
+                     rules: str = None):
+    """Validate an upload in the background; takes the same query parameters as /upload."""
+    if not allowed_file(file.filename):
+        log_audit('upload_rejected', f'Invalid file type: {file.filename}')
+        return FastJSONResponse(content={
+            "error": "Invalid file type. Only CSV and Excel files are allowed."})
+    try:
+        plan = validation_plan(mode, parse_rules(rules))
+    except ValueError as e:
+        return FastJSONResponse(content={"error": str(e)}, status_code=400)
+    if not heavy_jobs.try_admit():
+        return busy_response()
+    timer = RequestMetrics('jobs')
+    try:
+        with timer.stage('spool'):
+            spool_path, size, digest = await spool_upload(file)
+    except UploadTooLarge:
+        heavy_jobs.release()
+        log_audit('upload_rejected',
+                  f'File too large: {file.filename} (over {MAX_FILE_SIZE} bytes)')
+        return FastJSONResponse(content={
+            "error": f"File too large. Max {MAX_FILE_SIZE // (1024 * 1024)}MB allowed."})
+    except BaseException:
+        heavy_jobs.release()
+        raise
+    timer.bytes_in(size)
+    job = ValidationJob(uuid.uuid4().hex, file.filename)
+    validation_jobs.add(job)
+    job.task = asyncio.create_task(run_validation_job(job, request, spool_path, size, digest, plan,
+                                                      timer))
+    # Releases the admission slot and removes the spool file however the job ends
+    job.task.add_done_callback(functools.partial(finish_validation_job, job, spool_path))
+    log_audit('job_submitted', f'Job {job.job_id} for {file.filename} ({size} bytes)')
+    return FastJSONResponse(content={"job_id": job.job_id, "status": job.status}, status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = validation_jobs.get(job_id)
+    if job is None:
+        return FastJSONResponse(content={"error": "Unknown or expired job."}, status_code=404)
+    return FastJSONResponse(content=job.summary())
+
+
+@app.get("/jobs/{job_id}/results")
+async def job_results(job_id: str, sheet: str = None, offset: int = 0,
+                      limit: int = JOB_RESULTS_PAGE_SIZE):
+    """One sheet of a finished job: its preview and errors[offset:offset + limit]."""
+    job = validation_jobs.get(job_id)
+    if job is None:
+        return FastJSONResponse(content={"error": "Unknown or expired job."}, status_code=404)
+    if job.status != 'done':
+        return FastJSONResponse(content={"error": f"Job is {job.status}.", "status": job.status},
+                                status_code=409)
+    result = job.load_result()
+    errors = result['errors']
+    names = list(result['sheets']) + [name for name in errors if name not in result['sheets']]
+    if not names:
+        return FastJSONResponse(content={"job_id": job_id, "workbook_id": job.workbook_id,
+                                         "sheets": [], "sheet": None})
+    if sheet is None:
+        sheet = names[0]
+    if sheet not in names:
+        return FastJSONResponse(content={"error": f"No sheet named {sheet}."}, status_code=404)
+    offset = max(offset, 0)
+    limit = max(1, min(limit, JOB_RESULTS_PAGE_SIZE))
+    sheet_errors = errors.get(sheet, [])
+    next_sheet = names[names.index(sheet) + 1] if names.index(sheet) + 1 < len(names) else None
+    return FastJSONResponse(content={
+        "job_id": job_id,
+        "workbook_id": job.workbook_id,
+        "sheets": names,
+        "sheet": sheet,
+        "preview": result['preview'].get(sheet),
+        "errors": sheet_errors[offset:offset + limit],
+        "total_errors": len(sheet_errors),
+        "offset": offset,
+        "next_offset": offset + limit if offset + limit < len(sheet_errors) else None,
+        "next_sheet": next_sheet,
+    })
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = validation_jobs.get(job_id)
+    if job is None:
+        return FastJSONResponse(content={"error": "Unknown or expired job."}, status_code=404)
+    if job.status in ('queued', 'running'):
+        # Sheet jobs already on the pool stop at their next chunk. A job running on another
+        # worker (no task here) stops there and saves itself as cancelled.
+        job.progress.cancel()
+        if job.task is not None:
+            job.task.cancel()
+        log_audit('job_cancelled', f'Job {job_id}')
+    status = 'cancelled' if job.status in ('queued', 'running') else job.status
+    return FastJSONResponse(content={"job_id": job_id, "status": status})
+
+
+def parse_error(filename, e):
+    logging.getLogger("upload").error(f"Parse error: {filename} ({str(e)})")
+    log_audit('upload_rejected', f'Parse error: {filename} ({str(e)})')
+    return {"error": "Could not parse file. The file may have inconsistent formatting. Try "
+                     f"cleaning the CSV file or check for extra commas. Error: {str(e)}"}
 
 # Add the /bulk-fix endpoint after /upload
 
 @app.post("/bulk-fix")
 async def bulk_fix(
     fixes: str = Form(...),  # comma-separated list: 'auto-balance,fill-missing,remove-duplicates'
-    sheet: str = Form(None)  # optional: which sheet to fix
+    sheet: str = Form(None),  # optional: which sheet to fix
+    workbook_id: str = Form(None)  # handle returned by /upload
 ):
-    global last_processed_sheets
-    if last_processed_sheets is None:
-        return Response(json.dumps({"error": "No data loaded. Please upload a file first."}), status_code=400, media_type="application/json")
-    
+    workbook = get_workbook(workbook_id)
+    if workbook is None:
+        return FastJSONResponse(content={"error": "No data loaded. Please upload a file first."},
+                                status_code=400)
+
+    timer = RequestMetrics('bulk_fix')
     applied = [f.strip() for f in fixes.split(',')]
-    sheets_to_fix = [sheet] if sheet and sheet in last_processed_sheets else list(last_processed_sheets.keys())
+    sheets_to_fix = [sheet] if sheet and sheet in workbook.sheets else list(workbook.sheets.keys())
     result = {}
+    deltas = []
     for name in sheets_to_fix:
-        df = last_processed_sheets[name].copy()
-        summary = []
-        if 'remove-duplicates' in applied:
-            before = len(df)
-            df = df.drop_duplicates()
-            after = len(df)
-            summary.append(f"Removed {before - after} duplicate rows.")
-        if 'fill-missing' in applied:
-            num_missing = df.isnull().sum().sum()
-            df = df.fillna(0)
-            summary.append(f"Filled {num_missing} missing values with 0.")
-        if 'auto-balance' in applied and 'Debit' in df.columns and 'Credit' in df.columns:
-            for idx, row in df.iterrows():
-                try:
-                    debit = float(row['Debit']) if row['Debit'] not in [None, "", pd.NA] else 0
-                    credit = float(row['Credit']) if row['Credit'] not in [None, "", pd.NA] else 0
-                except (ValueError, TypeError):
-                    continue
-                if pd.isnull(debit) or pd.isnull(credit):
-                    continue
-                diff = debit - credit
-                if abs(diff) <= 1e-2 and diff != 0:
-                    if debit > credit:
-                        df.at[idx, 'Credit'] = debit
-                    else:
-                        df.at[idx, 'Debit'] = credit
-            summary.append("Auto-balanced small rounding errors (≤ 1 cent).")
-        # Clean NaN/inf for JSON
-        df = df.replace([np.inf, -np.inf], pd.NA)
-        df = df.where(pd.notnull(df), None)
-        # Update global
-        last_processed_sheets[name] = df.copy()
+        df = workbook.sheets[name]
+        with timer.stage('plan', len(df)):
+            plan = BulkFixPlan(df, applied)
+        with timer.stage('record', len(df)):
+            delta = SheetDelta(name)
+            dtypes = df.dtypes
+            # Old values are recorded for /revalidate and the journal before the writes land
+            record_removed_rows(workbook, name, plan.removed_rows(df))
+            if plan.drop.any():
+                delta.remove_rows(df, np.flatnonzero(plan.drop))
+            for column, labels, old, new in plan.cell_writes(df):
+                for label, value in zip(labels, old.tolist()):
+                    record_cell_change(workbook, name, label, column, value)
+                delta.write(column, labels, old, new)
+        with timer.stage('apply', len(df)):
+            df = plan.apply(df)
+            delta.note_dtypes(dtypes, df)
+        if delta:
+            deltas.append(delta)
+        workbook.sheets[name] = df
         result[name] = {
-            "fixed_entries": df.head(5).to_dict(orient='records'),
-            "summary": summary,
+            "fixed_entries": frame_records(df.head(5)),
+            "summary": plan.summary(),
             "columns": list(df.columns)
         }
-    log_audit('bulk_fix', f'Fixes applied: {fixes} to sheets: {sheets_to_fix}')
-    return JSONResponse(content=clean_nans(result))
+    with timer.stage('store'):
+        if deltas:
+            workbook.journal.record(ChangeSet('bulk_fix', f'Fixes applied: {fixes}', deltas))
+        workbook_store.put(workbook_id, workbook)
+    log_audit('bulk_fix', f'Fixes applied: {fixes} to sheets: {sheets_to_fix}',
+              workbook_id=workbook_id)
+    with timer.stage('serialize'):
+        response = FastJSONResponse(content=result)
+    timer.bytes_out(len(response.body))
+    timer.finish()
+    return response
 
 # Add a new endpoint for CSV download
 
 @app.get("/download-csv")
-def download_csv(sheet: str = None):
-    if last_processed_sheets is None:
+def download_csv(sheet: str = None, workbook_id: str = None, format: str = 'csv'):
+    workbook = get_workbook(workbook_id)
+    if workbook is None:
         return Response("No data available for download.", status_code=404)
-    if sheet and sheet in last_processed_sheets:
-        stream = io.StringIO()
-        last_processed_sheets[sheet].to_csv(stream, index=False)
-        stream.seek(0)
-        return StreamingResponse(stream, media_type="text/csv", headers={
-            "Content-Disposition": f"attachment; filename={sheet.replace(' ', '_')}.csv"
+    if format not in ('csv', 'parquet'):
+        return Response("Unknown format. Use csv or parquet.", status_code=400)
+    if format == 'parquet' and not HAS_PYARROW:
+        return Response("Parquet export needs pyarrow, which is not installed.", status_code=501)
+    if format == 'parquet':
+        sheet_chunks, media_type, ext = parquet_chunks, "application/vnd.apache.parquet", 'parquet'
+    else:
+        sheet_chunks, media_type, ext = csv_chunks, "text/csv", 'csv'
+    timer = RequestMetrics('download_csv')
+    if sheet and sheet in workbook.sheets:
+        with timer.stage('snapshot'):
+            df = export_snapshot(workbook.sheets[sheet])
+        body = metered_chunks(sheet_chunks(df), timer, f'export_{format}', len(df))
+        return StreamingResponse(body, media_type=media_type, headers={
+            "Content-Disposition": f"attachment; filename={sheet.replace(' ', '_')}.{ext}"
         })
     # If no sheet specified, zip all sheets
-    mem_zip = io.BytesIO()
-    with zipfile.ZipFile(mem_zip, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for name, df in last_processed_sheets.items():
-            csv_bytes = df.to_csv(index=False).encode('utf-8')
-            zf.writestr(f"{name.replace(' ', '_')}.csv", csv_bytes)
-    mem_zip.seek(0)
-    return StreamingResponse(mem_zip, media_type="application/zip", headers={
+    with timer.stage('snapshot'):
+        snapshots = {name: export_snapshot(df) for name, df in workbook.sheets.items()}
+    entries = [(f"{name.replace(' ', '_')}.{ext}", sheet_chunks(df))
+               for name, df in snapshots.items()]
+    rows = sum(len(df) for df in snapshots.values())
+    body = metered_chunks(zip_chunks(entries), timer, f'export_{format}', rows)
+    return StreamingResponse(body, media_type="application/zip", headers={
         "Content-Disposition": "attachment; filename=ledgerlift_export.zip"
     })
 
@@ -639,85 +4672,107 @@ async def analyze_excel_sheets(file: UploadFile = File(...)):
         return {"error": "This endpoint only works with Excel files (.xlsx, .xls)"}
     
     try:
-        contents = await file.read()
-        excel_file = BytesIO(contents)
-        excel_data = pd.read_excel(excel_file, sheet_name=None)
-        
-        sheets_info = []
-        for sheet_name, sheet_df in excel_data.items():
-            sheets_info.append({
-                "name": sheet_name,
-                "rows": len(sheet_df),
-                "columns": len(sheet_df.columns),
-                "column_names": list(sheet_df.columns)
-            })
+        spool_path, _, _ = await spool_upload(file)
+    except UploadTooLarge:
+        return {"error": f"File too large. Max {MAX_FILE_SIZE // (1024 * 1024)}MB allowed."}
+    try:
+        # Sizes come from each sheet's recorded dimension; only header rows are read
+        sheets_info = xlsx_sheet_info(spool_path)
         
         return {
-            "total_sheets": len(excel_data),
+            "total_sheets": len(sheets_info),
             "sheets": sheets_info
         }
     except Exception as e:
         return {"error": f"Could not analyze Excel file: {str(e)}"}
+    finally:
+        os.remove(spool_path)
 
-# Placeholder for Excel export (future)
-# @app.get("/download-excel")
-# def download_excel():
-#     global last_processed_df
-#     if last_processed_df is None:
-#         return Response("No data available for download.", status_code=404)
-#     stream = io.BytesIO()
-#     last_processed_df.to_excel(stream, index=False)
-#     stream.seek(0)
-#     return StreamingResponse(stream, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={
-#         "Content-Disposition": "attachment; filename=ledgerlift_export.xlsx"
-#     })
+
+@app.get("/download-excel")
+def download_excel(sheet: str = None, workbook_id: str = None):
+    workbook = get_workbook(workbook_id)
+    if workbook is None:
+        return Response("No data available for download.", status_code=404)
+    if sheet and sheet in workbook.sheets:
+        sheets = {sheet: export_snapshot(workbook.sheets[sheet])}
+        filename = f"{sheet.replace(' ', '_')}.xlsx"
+    else:
+        sheets = {name: export_snapshot(df) for name, df in workbook.sheets.items()}
+        filename = "ledgerlift_export.xlsx"
+    return StreamingResponse(xlsx_chunks(sheets), media_type=XLSX_MEDIA_TYPE, headers={
+        "Content-Disposition": f"attachment; filename={filename}"
+    })
 
 @app.post("/custom-errors")
 async def custom_errors(request: Request):
-    data = await request.json()
-    sheet = data.get("sheet")
-    df = get_sheet(sheet)
+    """Rows matching the posted rules, and/or a saved rule set ({"rule_set": name})."""
+    timer = RequestMetrics('custom_errors')
+    with timer.stage('load'):
+        data = await request.json()
+        sheet = data.get("sheet")
+        df = get_sheet(data.get("workbook_id"), sheet)
+    timer.bytes_in(len(await request.body()))
     if df is None:
         return {"custom_errors": []}
     rules = data.get("rules", [])
-    custom_errors = []
-    for rule in rules:
-        col = rule.get("column")
-        cond = rule.get("condition")
-        val = rule.get("value")
-        if col not in df.columns:
-            continue
-        for idx, row in df.iterrows():
-            cell = row[col]
-            match = False
-            try:
-                if cond == ">":
-                    match = float(cell) > float(val)
-                elif cond == "<":
-                    match = float(cell) < float(val)
-                elif cond == ">=":
-                    match = float(cell) >= float(val)
-                elif cond == "<=":
-                    match = float(cell) <= float(val)
-                elif cond == "==":
-                    match = str(cell) == str(val)
-                elif cond == "!=":
-                    match = str(cell) != str(val)
-                elif cond == "empty":
-                    match = cell is None or str(cell).strip() == "" or (isinstance(cell, float) and pd.isnull(cell))
-                elif cond == "notempty":
-                    match = not (cell is None or str(cell).strip() == "" or (isinstance(cell, float) and pd.isnull(cell)))
-            except Exception:
-                continue
-            if match:
-                custom_errors.append({"row": idx+1, "issue": f"Custom rule: {col} {cond} {val if val else ''}"})
-    return JSONResponse(content=clean_nans({"custom_errors": custom_errors}))
+    if data.get("rule_set"):
+        saved = rule_sets.get(data["rule_set"])
+        if saved is None:
+            return FastJSONResponse(content={"error": f"No rule set named {data['rule_set']}."},
+                                    status_code=404)
+        rules = saved['rules'] + (rules if isinstance(rules, list) else [])
+    try:
+        with timer.stage('evaluate', len(df)):
+            errors = custom_rule_errors(df, rules)
+    except ValueError as e:
+        return FastJSONResponse(content={"error": str(e)}, status_code=400)
+    with timer.stage('serialize'):
+        response = FastJSONResponse(content={"custom_errors": errors})
+    timer.bytes_out(len(response.body))
+    timer.finish()
+    return response
+
+
+@app.get("/rule-sets")
+async def list_rule_sets():
+    return FastJSONResponse(content={"rule_sets": rule_sets.list()})
+
+
+@app.post("/rule-sets")
+async def save_rule_set(request: Request):
+    """Save {"name", "rules"} for /custom-errors to reuse; replaces a set of that name."""
+    data = await request.json()
+    name = data.get("name")
+    rules = data.get("rules", [])
+    if not isinstance(name, str) or not name.strip():
+        return FastJSONResponse(content={"error": "A rule set needs a name."}, status_code=400)
+    try:
+        if not isinstance(rules, list):
+            raise ValueError("rules must be a list.")
+        for rule in rules:
+            compile_rule(rule)
+    except ValueError as e:
+        return FastJSONResponse(content={"error": str(e)}, status_code=400)
+    rule_set = rule_sets.put(name, rules)
+    log_audit('rule_set_saved', f'Rule set {name} ({len(rules)} rules)')
+    return FastJSONResponse(content=rule_set)
+
+
+@app.delete("/rule-sets/{name}")
+async def delete_rule_set(name: str):
+    if not rule_sets.delete(name):
+        return FastJSONResponse(content={"error": f"No rule set named {name}."}, status_code=404)
+    log_audit('rule_set_deleted', f'Rule set {name}')
+    return FastJSONResponse(content={"name": name, "deleted": True})
+
 
 @app.post("/edit-cell")
 async def edit_cell(request: Request):
     data = await request.json()
-    sheet = data.get("sheet")
-    df = get_sheet(sheet)
+    workbook_id = data.get("workbook_id")
+    workbook = get_workbook(workbook_id)
+    sheet, df = resolve_sheet(workbook, data.get("sheet"))
     if df is None:
         return {"success": False, "error": "No data loaded."}
     row = data.get("row")
@@ -725,54 +4780,204 @@ async def edit_cell(request: Request):
     value = data.get("value")
     try:
         if column in df.columns and 0 <= row < len(df):
-            df.at[row, column] = value
-            log_audit('edit_cell', f'Sheet {sheet}, Row {row}, Column {column}, Value {value}')
-            last_processed_sheets[sheet] = df
+            old = df.at[row, column]
+            dtypes = df.dtypes
+            write_cells(df, column, [row], [value])
+            record_cell_change(workbook, sheet, row, column, old)
+            delta = SheetDelta(sheet)
+            delta.write(column, [row], [old], [value])
+            delta.note_dtypes(dtypes, df)
+            workbook.journal.record(ChangeSet('edit_cell', f'Row {row}, Column {column}', [delta]))
+            log_audit('edit_cell', f'Sheet {sheet}, Row {row}, Column {column}, Value {value}',
+                      workbook_id=workbook_id)
+            workbook.sheets[sheet] = df
+            workbook_store.put(workbook_id, workbook)
             return {"success": True}
         else:
             return {"success": False, "error": "Invalid row or column."}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+
+@app.post("/revalidate")
+async def revalidate(request: Request):
+    """Re-check only the rows changed by /edit-cell and /bulk-fix and return the error diff."""
+    data = await request.json()
+    workbook_id = data.get("workbook_id")
+    workbook = get_workbook(workbook_id)
+    if workbook is None or workbook.validation is None:
+        return FastJSONResponse(content={"error": "No data loaded. Please upload a file first."},
+                                status_code=400)
+    changes, rows_checked = revalidate_workbook(workbook)
+    workbook_store.put(workbook_id, workbook)
+    return FastJSONResponse(content={"changes": changes, "rows_revalidated": rows_checked})
+
+
+@app.get("/errors")
+async def list_errors(request: Request, workbook_id: str = None, cursor: str = None,
+                      limit: int = ERRORS_PAGE_SIZE, row_min: int = None, row_max: int = None):
+    """A page of a workbook's errors in (sheet, row) order.
+
+    Filter with ?sheet=...&type=... (both repeatable) and row_min/row_max; pass the
+    returned next_cursor back to get the following page. counts covers every match.
+    """
+    workbook = get_workbook(workbook_id)
+    if workbook is None:
+        return FastJSONResponse(content={"error": "No data loaded. Please upload a file first."},
+                                status_code=400)
+    position = None
+    if cursor:
+        position = parse_error_cursor(cursor)
+        if position is None:
+            return FastJSONResponse(content={"error": "Invalid cursor."}, status_code=400)
+    table = workbook.errors
+    mask = table.select(
+        sheets=request.query_params.getlist('sheet') or None,
+        types=request.query_params.getlist('type') or None,
+        row_min=row_min,
+        row_max=row_max
+    )
+    positions, next_cursor = table.page(mask, position, max(1, min(limit, ERRORS_MAX_PAGE_SIZE)))
+    return FastJSONResponse(content={
+        "errors": table.errors(positions, with_sheet=True),
+        "next_cursor": next_cursor,
+        "total": int(mask.sum()),
+        "counts": table.counts(mask),
+        "types": [name for name, _, _ in ISSUE_TYPES],
+    })
+
+
+def journal_state(workbook):
+    journal = workbook.journal
+    return {
+        "version": journal.version,
+        "oldest_version": journal.oldest(),
+        "latest_version": journal.latest(),
+        "can_undo": journal.version > journal.oldest(),
+        "can_redo": journal.version < journal.latest(),
+    }
+
+
+def move_to_version(workbook_id, target):
+    """Shared by /undo, /redo and /goto-version; target(journal) gives the version to reach."""
+    workbook = get_workbook(workbook_id)
+    if workbook is None:
+        return FastJSONResponse(content={"error": "No data loaded. Please upload a file first."},
+                                status_code=400)
+    journal = workbook.journal
+    version = target(journal)
+    if version is None or not journal.oldest() <= version <= journal.latest():
+        return FastJSONResponse(content={"success": False, "error": "No such version.",
+                                         **journal_state(workbook)}, status_code=409)
+    before = journal.version
+    sheets = journal.goto(workbook, version)
+    workbook_store.put(workbook_id, workbook)
+    log_audit('goto_version', f'Version {before} -> {version}', workbook_id=workbook_id)
+    # Changed rows are pending for /revalidate, like after an edit
+    return FastJSONResponse(content={"success": True, "sheets": sorted(sheets),
+                                     **journal_state(workbook)})
+
+
+@app.get("/versions")
+async def versions(workbook_id: str = None):
+    workbook = get_workbook(workbook_id)
+    if workbook is None:
+        return FastJSONResponse(content={"error": "No data loaded. Please upload a file first."},
+                                status_code=400)
+    return FastJSONResponse(content={"versions": workbook.journal.history(),
+                                     **journal_state(workbook)})
+
+
+@app.post("/undo")
+async def undo(request: Request):
+    data = await request.json()
+    return move_to_version(data.get("workbook_id"),
+                           lambda journal: journal.version - 1
+                           if journal.version > journal.oldest() else None)
+
+
+@app.post("/redo")
+async def redo(request: Request):
+    data = await request.json()
+    return move_to_version(data.get("workbook_id"),
+                           lambda journal: journal.version + 1
+                           if journal.version < journal.latest() else None)
+
+
+@app.post("/goto-version")
+async def goto_version(request: Request):
+    data = await request.json()
+    version = data.get("version")
+    return move_to_version(data.get("workbook_id"),
+                           lambda journal: version if isinstance(version, int) else None)
+
+
+@app.get("/anomaly-model")
+async def anomaly_model(workbook_id: str = None, client: str = None):
+    """The anomaly model a client, or else a workbook's chart of accounts, is scored with."""
+    if client:
+        key = anomaly_model_key(client, {})
+    else:
+        workbook = get_workbook(workbook_id)
+        if workbook is None:
+            return FastJSONResponse(
+                content={"error": "No data loaded. Please upload a file first."}, status_code=400)
+        key = anomaly_model_key(None, workbook.sheets)
+    model = anomaly_models.get(key)
+    if model is None:
+        return FastJSONResponse(content={"key": key, "trained": False})
+    return FastJSONResponse(content={"trained": True, **model_summary(model)})
+
+
+@app.post("/anomaly-model")
+async def train_anomaly_model_endpoint(request: Request):
+    """Retrain the anomaly model from a workbook's journal sheets, e.g. once they are cleaned up."""
+    data = await request.json()
+    workbook_id = data.get("workbook_id")
+    workbook = get_workbook(workbook_id)
+    if workbook is None:
+        return FastJSONResponse(content={"error": "No data loaded. Please upload a file first."},
+                                status_code=400)
+    frames = [df for name, df in workbook.sheets.items() if anomaly_candidate(name, df)]
+    if not frames:
+        return FastJSONResponse(content={"error": "No journal sheet with Debit and Credit columns "
+                                                  f"and at least {ANOMALY_MIN_ROWS} rows."},
+                                status_code=400)
+    key = anomaly_model_key(data.get("client"), workbook.sheets)
+    if not heavy_jobs.try_admit():
+        return busy_response()
+    try:
+        async with heavy_jobs.running():
+            summary = await in_validation_pool(retrain_anomaly_model, key, frames)
+    finally:
+        heavy_jobs.release()
+    # Cached /upload results hold the old model's verdicts (in this process; other workers'
+    # entries age out)
+    result_cache.clear()
+    log_audit('anomaly_model_trained', f"Model {key} ({summary['rows']} rows)",
+              workbook_id=workbook_id)
+    return FastJSONResponse(content={"success": True, **summary})
+
+
 @app.post("/bulk-fix-preview")
 async def bulk_fix_preview(request: Request):
     data = await request.json()
     sheet = data.get("sheet")
     fixes = data.get("fixes", [])
-    df = get_sheet(sheet)
+    df = get_sheet(data.get("workbook_id"), sheet)
     if df is None:
         return {"preview": ["No data loaded."]}
-    preview = []
-    if 'remove-duplicates' in fixes:
-        before = len(df)
-        after = len(df.drop_duplicates())
-        preview.append(f"Would remove {before - after} duplicate rows.")
-    if 'fill-missing' in fixes:
-        num_missing = df.isnull().sum().sum()
-        preview.append(f"Would fill {num_missing} missing values with 0.")
-    if 'auto-balance' in fixes and 'Debit' in df.columns and 'Credit' in df.columns:
-        count = 0
-        for idx, row in df.iterrows():
-            try:
-                debit = float(row['Debit']) if row['Debit'] not in [None, "", pd.NA] else 0
-                credit = float(row['Credit']) if row['Credit'] not in [None, "", pd.NA] else 0
-            except (ValueError, TypeError):
-                continue
-            if pd.isnull(debit) or pd.isnull(credit):
-                continue
-            diff = debit - credit
-            if abs(diff) <= 1e-2 and diff != 0:
-                count += 1
-        preview.append(f"Would auto-balance {count} small rounding errors (≤ 1 cent).")
+    preview = BulkFixPlan(df, fixes).summary(preview=True)
     if not preview:
         preview.append("No changes would be made.")
-    return JSONResponse(content=clean_nans({"preview": preview}))
+    return FastJSONResponse(content={"preview": preview})
+
 
 @app.post("/financial-report")
 async def financial_report(request: Request):
     data = await request.json()
     sheet = data.get("sheet")
-    df = get_sheet(sheet)
+    df = get_sheet(data.get("workbook_id"), sheet)
     if df is None:
         return HTMLResponse("<h2>No data loaded.</h2>", status_code=400)
     errors = data.get("errors", [])
@@ -801,53 +5006,406 @@ async def financial_report(request: Request):
     html += "</body></html>"
     return HTMLResponse(content=html, headers={"Content-Disposition": "attachment; filename=financial_report.html"})
 
-# Helper function to send email using SMTP
-
-def send_email(recipient, subject, body):
-    smtp_host = os.environ.get('SMTP_HOST', 'smtp.example.com')
-    smtp_port = int(os.environ.get('SMTP_PORT', 587))
-    smtp_user = os.environ.get('SMTP_USER', 'user@example.com')
-    smtp_pass = os.environ.get('SMTP_PASS', 'password')
-    sender = os.environ.get('SMTP_SENDER', smtp_user)
-    msg = EmailMessage()
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = recipient
-    msg.set_content(body)
-    try:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_pass)
-            server.send_message(msg)
-        return True, None
-    except Exception as e:
-        return False, str(e)
+# --- Outbound mail ---
+# POST /send-email only queues the message and returns its id, and GET
+# /send-email/{message_id} reports queued -> sending -> sent, or retrying -> ... -> failed.
+# One sender thread keeps an SMTP session open (STARTTLS and login happen once) and sends
+# every message that is due over it, up to LEDGERLIFT_MAIL_BATCH per wake-up. A session
+# idle for LEDGERLIFT_MAIL_NOOP_SECONDS is checked with NOOP before it is reused, is reopened
+# when the relay has dropped it, and is closed after LEDGERLIFT_MAIL_IDLE_SECONDS without
+# mail. Temporary failures (4xx replies, connection errors) are retried after
+# LEDGERLIFT_MAIL_BACKOFF_SECONDS, doubling up to LEDGERLIFT_MAIL_MAX_BACKOFF_SECONDS, for
+# LEDGERLIFT_MAIL_ATTEMPTS attempts in all; a 5xx reply fails the message at once. Statuses
+# are kept for LEDGERLIFT_MAIL_TTL seconds after a message is sent or fails, in memory and
+# as one small file per message in LEDGERLIFT_MAIL_STATUS_DIR, which all workers share, so
+# GET /send-email/{message_id} works on a worker other than the one that queued it. For a local
+# stand-in server without TLS or AUTH, set SMTP_STARTTLS=0 and SMTP_USER to an empty string
+# (benchmarks/bench_mail.py has one).
+SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.example.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USER = os.environ.get('SMTP_USER', 'user@example.com')
+SMTP_PASS = os.environ.get('SMTP_PASS', 'password')
+SMTP_SENDER = os.environ.get('SMTP_SENDER') or SMTP_USER or 'ledgerlift@localhost'
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', 30))
+MAIL_BATCH = int(os.environ.get('LEDGERLIFT_MAIL_BATCH', 50))
+MAIL_NOOP_SECONDS = float(os.environ.get('LEDGERLIFT_MAIL_NOOP_SECONDS', 30))
+MAIL_IDLE_SECONDS = float(os.environ.get('LEDGERLIFT_MAIL_IDLE_SECONDS', 120))
+MAIL_ATTEMPTS = int(os.environ.get('LEDGERLIFT_MAIL_ATTEMPTS', 5))
+MAIL_BACKOFF_SECONDS = float(os.environ.get('LEDGERLIFT_MAIL_BACKOFF_SECONDS', 5))
+MAIL_MAX_BACKOFF_SECONDS = float(os.environ.get('LEDGERLIFT_MAIL_MAX_BACKOFF_SECONDS', 300))
+MAIL_TTL_SECONDS = int(os.environ.get('LEDGERLIFT_MAIL_TTL', 3600))
+MAIL_STATUS_DIR = os.environ.get('LEDGERLIFT_MAIL_STATUS_DIR',
+                                 os.path.join(tempfile.gettempdir(), 'ledgerlift_mail'))
+
+
+class MailMessage:
+    """One queued email: queued -> sending -> sent | retrying | failed."""
+
+    def __init__(self, message_id, recipient, subject, body, sender=SMTP_SENDER):
+        from email.message import EmailMessage
+        self.message_id = message_id
+        self.recipient = recipient
+        self.email = EmailMessage()
+        # Raises ValueError for header values with line breaks, before anything is queued
+        self.email['Subject'] = subject
+        self.email['From'] = sender
+        self.email['To'] = recipient
+        self.email.set_content(body)
+        self.status = 'queued'
+        self.attempts = 0
+        self.error = None
+        self.created = time.time()
+        self.next_attempt = self.created
+        self.finished = None
+
+    def expired(self, now):
+        return self.finished is not None and now - self.finished > MAIL_TTL_SECONDS
+
+    def summary(self):
+        return {
+            "message_id": self.message_id,
+            "recipient": self.recipient,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "next_attempt": self.next_attempt if self.status == 'retrying' else None,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+def mail_error(exc):
+    """(error text, permanent) for an exception from an SMTP session."""
+    import smtplib
+    if isinstance(exc, smtplib.SMTPRecipientsRefused) and exc.recipients:
+        code, reply = next(iter(exc.recipients.values()))
+    elif isinstance(exc, smtplib.SMTPResponseException):
+        code, reply = exc.smtp_code, exc.smtp_error
+    else:
+        return str(exc) or type(exc).__name__, False
+    if isinstance(reply, bytes):
+        reply = reply.decode('utf-8', 'replace')
+    return f'{code} {reply}', 500 <= code < 600
+
+
+class SMTPSession:
+    """A reusable SMTP connection: STARTTLS and login once, NOOP after idling, reopened if dropped.
+
+    Only the mail sender thread uses it.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASS,
+                 starttls=SMTP_STARTTLS, timeout=SMTP_TIMEOUT, noop_seconds=MAIL_NOOP_SECONDS):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.noop_seconds = noop_seconds
+        self.last_used = 0.0  # time.monotonic() of the last command
+        self._smtp = None
+
+    def connected(self):
+        return self._smtp is not None
+
+    def _open(self):
+        import smtplib
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        self.last_used = time.monotonic()
+        mail_events.inc(1, 'connected')
+
+    def ensure(self):
+        """Open the session, or check one that has idled for noop_seconds and reopen it if it is
+        gone."""
+        import smtplib
+        if self._smtp is not None and time.monotonic() - self.last_used > self.noop_seconds:
+            try:
+                alive = self._smtp.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                alive = False
+            if alive:
+                self.last_used = time.monotonic()
+            else:
+                self.close()
+        if self._smtp is None:
+            self._open()
+
+    def send(self, email):
+        import smtplib
+        self.ensure()
+        try:
+            self._smtp.send_message(email)
+        except smtplib.SMTPResponseException as e:
+            if e.smtp_code == 421:  # the relay is closing the session
+                self.close()
+            raise
+        except smtplib.SMTPRecipientsRefused:
+            raise  # the session is still usable
+        except (smtplib.SMTPException, OSError):
+            self.close()
+            raise
+        finally:
+            self.last_used = time.monotonic()
+
+    def close(self):
+        import smtplib
+        smtp, self._smtp = self._smtp, None
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+
+class MailQueue:
+    """Emails waiting for the sender thread, and the status of every recent one by id.
+
+    Every status change is also written to status_dir, where summary() finds the messages
+    other workers queued.
+    """
+
+    def __init__(self, session=None, batch=MAIL_BATCH, idle_seconds=MAIL_IDLE_SECONDS,
+                 attempts=MAIL_ATTEMPTS, backoff_seconds=MAIL_BACKOFF_SECONDS,
+                 max_backoff_seconds=MAIL_MAX_BACKOFF_SECONDS, status_dir=MAIL_STATUS_DIR):
+        self.session = session if session is not None else SMTPSession()
+        self.batch = batch
+        self.status_dir = status_dir
+        self.idle_seconds = idle_seconds
+        self.attempts = attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._messages = {}
+        self._due = []  # heap of (next_attempt, seq, message)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def submit(self, recipient, subject, body):
+        """Queue an email and return its MailMessage; ValueError if it cannot be built."""
+        message = MailMessage(uuid.uuid4().hex, recipient, subject, body)
+        os.makedirs(self.status_dir, exist_ok=True)
+        self._save(message)
+        with self._cond:
+            self._sweep()
+            self._messages[message.message_id] = message
+            heapq.heappush(self._due, (message.next_attempt, next(self._seq), message))
+            self._closed = False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mail-sender', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        mail_events.inc(1, 'queued')
+        return message
+
+    def get(self, message_id):
+        if not message_id or not WORKBOOK_ID_PATTERN.fullmatch(message_id):
+            return None
+        with self._cond:
+            self._sweep()
+            return self._messages.get(message_id)
+
+    def summary(self, message_id):
+        """The status of a message queued by any worker, or None if unknown or expired."""
+        message = self.get(message_id)
+        if message is not None:
+            return message.summary()
+        if not message_id or not WORKBOOK_ID_PATTERN.fullmatch(message_id):
+            return None
+        try:
+            with open(self._path(message_id), encoding='utf-8') as f:
+                summary = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        finished = summary['finished']
+        if finished is not None and time.time() - finished > MAIL_TTL_SECONDS:
+            self._remove(message_id)
+            return None
+        return summary
+
+    def _path(self, message_id):
+        return os.path.join(self.status_dir, f'{message_id}.json')
+
+    def _save(self, message):
+        replace_json_file(self._path(message.message_id), message.summary())
+
+    def _remove(self, message_id):
+        try:
+            os.remove(self._path(message_id))
+        except FileNotFoundError:
+            pass
+
+    def _sweep(self):
+        now = time.time()
+        for message_id in [k for k, message in self._messages.items() if message.expired(now)]:
+            del self._messages[message_id]
+            self._remove(message_id)
+
+    def _take_due(self):
+        now = time.time()
+        batch = []
+        while self._due and self._due[0][0] <= now and len(batch) < self.batch:
+            message = heapq.heappop(self._due)[2]
+            message.status = 'sending'
+            batch.append(message)
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    batch = self._take_due()
+                    if batch or self._closed:
+                        break
+                    timeout = self._due[0][0] - time.time() if self._due else None
+                    if self.session.connected():
+                        idle_left = self.session.last_used + self.idle_seconds - time.monotonic()
+                        if idle_left <= 0:
+                            break
+                        timeout = idle_left if timeout is None else min(timeout, idle_left)
+                    self._cond.wait(timeout)
+                if not batch and self._closed:
+                    # Decided under the lock, so a submit() after this starts a new thread
+                    self.session.close()
+                    self._thread = None
+                    if self._due:
+                        logging.getLogger("mail").warning(
+                            f"{len(self._due)} email(s) waiting to be retried were not sent "
+                            "before shutdown")
+                    return
+            if batch:
+                self._send(batch)
+            else:
+                self.session.close()  # idle for idle_seconds
+
+    def _send(self, batch):
+        for message in batch:
+            self._save(message)  # sending
+        for index, message in enumerate(batch):
+            try:
+                self.session.ensure()
+            except Exception as e:
+                # Without a session nothing else in the batch can go either
+                error, permanent = mail_error(e)
+                for waiting in batch[index:]:
+                    waiting.attempts += 1
+                    self._failed(waiting, error, permanent)
+                return
+            message.attempts += 1
+            try:
+                self.session.send(message.email)
+            except Exception as e:
+                self._failed(message, *mail_error(e))
+                continue
+            message.status = 'sent'
+            message.error = None
+            message.finished = time.time()
+            self._save(message)
+            mail_events.inc(1, 'sent')
+
+    def _failed(self, message, error, permanent):
+        message.error = error
+        if permanent or message.attempts >= self.attempts:
+            message.status = 'failed'
+            message.finished = time.time()
+            self._save(message)
+            mail_events.inc(1, 'failed')
+            logging.getLogger("mail").warning(
+                f"Email {message.message_id} failed after {message.attempts} attempt(s): {error}")
+            return
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (message.attempts - 1))
+        with self._cond:
+            message.status = 'retrying'
+            message.next_attempt = time.time() + delay
+            heapq.heappush(self._due, (message.next_attempt, next(self._seq), message))
+        self._save(message)
+        mail_events.inc(1, 'retried')
+
+    def close(self):
+        """Send what is due now, then stop the sender thread and quit the SMTP session."""
+        with self._cond:
+            thread, self._closed = self._thread, True
+            self._cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+
+mail_queue = MailQueue()
+
 
 @app.post("/send-email")
 async def send_email_endpoint(request: Request):
+    """Queue an email; GET /send-email/{message_id} reports whether it has been sent."""
     data = await request.json()
     recipient = data.get('recipient')
     subject = data.get('subject', 'LedgerLift Notification')
     body = data.get('body', '')
     if not recipient or not body:
         return {"success": False, "error": "Recipient and body required."}
-    ok, err = send_email(recipient, subject, body)
-    if ok:
-        return {"success": True}
-    else:
-        return {"success": False, "error": err}
+    try:
+        message = mail_queue.submit(recipient, subject, body)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    return FastJSONResponse(content={"success": True, **message.summary()}, status_code=202)
+
+
+@app.get("/send-email/{message_id}")
+async def email_status(message_id: str):
+    summary = mail_queue.summary(message_id)
+    if summary is None:
+        return FastJSONResponse(content={"error": "Unknown or expired message."}, status_code=404)
+    return FastJSONResponse(content=summary)
 
 @app.post("/feedback")
 async def feedback(request: Request):
     data = await request.json()
     feedback_text = data.get("feedback", "")
     if feedback_text.strip():
-        with open("feedback.log", "a", encoding="utf-8") as f:
-            f.write(f"[{datetime.now().isoformat()}] {feedback_text}\n")
+        feedback_log.write({"action": "feedback", "workbook_id": data.get("workbook_id"),
+                            "feedback": feedback_text})
     return {"success": True}
 
+
+@app.get("/audit-log")
+async def audit_log_records(request: Request, since: str = None, until: str = None,
+                            workbook_id: str = None, limit: int = 100):
+    """Audit records oldest first; filter with ?action=... (repeatable), since/until and
+    workbook_id."""
+    try:
+        since = audit_bound(since) if since else None
+        until = audit_bound(until) if until else None
+    except ValueError:
+        return FastJSONResponse(
+            content={"error": "since and until take ISO-8601 times or epoch seconds."},
+            status_code=400)
+    limit = max(1, min(limit, AUDIT_QUERY_LIMIT))
+    actions = tuple(request.query_params.getlist('action'))
+    records, truncated = await asyncio.to_thread(audit_log.query, actions, since, until,
+                                                 workbook_id, limit)
+    return FastJSONResponse(content={"records": records, "truncated": truncated})
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Request and per-stage metrics in the Prometheus text format."""
+    return Response(metrics_text(), media_type=METRICS_MEDIA_TYPE)
+
 # To use email notifications, set the following environment variables:
-# SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS, SMTP_SENDER (optional)
+# SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS, SMTP_SENDER (optional),
+# SMTP_STARTTLS and SMTP_TIMEOUT (optional); see "Outbound mail" above
 
 if __name__ == "__main__":
     import uvicorn
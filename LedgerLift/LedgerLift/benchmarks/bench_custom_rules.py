@@ -0,0 +1,120 @@
+"""/custom-errors evaluation time, old per-row loop vs compiled column masks.
+
+    python benchmarks/bench_custom_rules.py [--rows N] [--repeat N]
+
+"old" is the loop the endpoint used to run: df.iterrows() once per rule, float() or str()
+of every cell in a try/except. "new" is custom_rule_errors() with a cold rule-set cache;
+"new, cached" reuses the compiled set. Both evaluate the same ten rules, and their outputs
+are compared before timing.
+"""
+import argparse
+import functools
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import backend  # noqa: E402
+
+RULES = [
+    {"column": "Debit", "condition": ">", "value": "4000"},
+    {"column": "Debit", "condition": "<", "value": "10"},
+    {"column": "Credit", "condition": ">=", "value": "4990"},
+    {"column": "Credit", "condition": "<=", "value": "0"},
+    {"column": "Account", "condition": "==", "value": "Suspense"},
+    {"column": "Type", "condition": "!=", "value": "asset"},
+    {"column": "Memo", "condition": "empty", "value": ""},
+    {"column": "Memo", "condition": "notempty", "value": ""},
+    {"column": "Account", "condition": "empty", "value": ""},
+    {"column": "Amount Text", "condition": ">", "value": "2500"},
+]
+
+
+def sheet(rows):
+    rng = np.random.default_rng(0)
+    debit = rng.integers(0, 5000, rows).astype(float)
+    debit[rng.random(rows) < 0.02] = np.nan
+    return pd.DataFrame({
+        'Date': pd.date_range('2024-01-01', periods=rows, freq='min').strftime('%Y-%m-%d'),
+        'Account': rng.choice(np.array(['Cash', 'Revenue', 'Suspense', None], dtype=object), rows),
+        'Type': rng.choice(['asset', 'revenue', 'equity'], rows),
+        'Debit': debit,
+        'Credit': rng.integers(0, 5000, rows).astype(float),
+        'Memo': rng.choice(np.array(['', ' ', 'accrual', None], dtype=object), rows),
+        'Amount Text': rng.choice(np.array(['1,000', '3000', ' 42 ', 'n/a', None], dtype=object),
+                                  rows),
+    })
+
+
+def old_custom_errors(df, rules):
+    custom_errors = []
+    for rule in rules:
+        col = rule.get("column")
+        cond = rule.get("condition")
+        val = rule.get("value")
+        if col not in df.columns:
+            continue
+        for idx, row in df.iterrows():
+            cell = row[col]
+            match = False
+            try:
+                if cond == ">":
+                    match = float(cell) > float(val)
+                elif cond == "<":
+                    match = float(cell) < float(val)
+                elif cond == ">=":
+                    match = float(cell) >= float(val)
+                elif cond == "<=":
+                    match = float(cell) <= float(val)
+                elif cond == "==":
+                    match = str(cell) == str(val)
+                elif cond == "!=":
+                    match = str(cell) != str(val)
+                elif cond == "empty":
+                    match = (cell is None or str(cell).strip() == ""
+                             or (isinstance(cell, float) and pd.isnull(cell)))
+                elif cond == "notempty":
+                    match = not (cell is None or str(cell).strip() == ""
+                                 or (isinstance(cell, float) and pd.isnull(cell)))
+            except Exception:
+                continue
+            if match:
+                custom_errors.append({"row": idx+1,
+                                      "issue": f"Custom rule: {col} {cond} {val if val else ''}"})
+    return custom_errors
+
+
+def new_custom_errors(df, rules, cold):
+    if cold:
+        backend.compiled_rule_set.cache_clear()
+    return backend.custom_rule_errors(df, rules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    df = sheet(args.rows)
+    print(f'{args.rows} rows, {len(RULES)} rules')
+    start = timeit.default_timer()
+    expected = old_custom_errors(df, RULES)
+    old = timeit.default_timer() - start
+    got = backend.custom_rule_errors(df, RULES)
+    if got != expected:
+        print(f'outputs differ: old {len(expected)} errors, new {len(got)}')
+        return 1
+    print(f'{"old (run once)":<16} {old * 1000:10.1f} ms  {len(expected)} errors')
+    for label, cold in (('new', True), ('new, cached', False)):
+        run = functools.partial(new_custom_errors, df, RULES, cold)
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        print(f'{label:<16} {best * 1000:10.1f} ms  {old / best:.0f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
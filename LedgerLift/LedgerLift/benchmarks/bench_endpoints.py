@@ -0,0 +1,288 @@
+"""Latency, peak RSS and concurrent p50/p99 of /upload, /bulk-fix, /custom-errors and /download-csv.
+
+    python benchmarks/bench_endpoints.py [--rows 1k,10k] [--repeat N] [--concurrency N]
+                                         [--requests N] [--baseline PATH] [--save-baseline]
+                                         [--tolerance F]
+
+The app runs in this process behind httpx's ASGI transport, with its lifespan, so the
+validation pool is started and prewarmed as in production. It is driven with workbooks
+from synthetic_workbook.py (--rows takes 1k, 10k, 100k, 1M, ...), cached in
+--workbook-dir because the large ones take minutes to write. For each size and endpoint:
+
+  best/median  of --repeat requests sent one after another
+  p50/p99      of --requests requests sent --concurrency at a time
+  failed       responses other than 200 (503 when the upload gate is full, 400 when
+               the workbook store evicted a workbook a later request needed)
+  server/pool  peak RSS in MB of this process and, summed, of the validation pool
+               workers while the endpoint ran (peak since start where the kernel
+               cannot reset it)
+
+The parse and result caches are off, so every upload parses and validates. Each
+/bulk-fix request gets a workbook of its own from the uploads before it.
+
+--save-baseline writes the results to --baseline. Otherwise every figure is compared with
+that file and the run exits 1 if any is more than --tolerance worse (and worse by more than
+10 ms or 25 MB, below which differences are noise), or 2 if there is no baseline yet.
+Baselines are only comparable on the same machine with the same arguments, so none is
+committed; record one before the change under test.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..'))
+import synthetic_workbook  # noqa: E402
+
+METRICS = ['best_ms', 'median_ms', 'p50_ms', 'p99_ms', 'server_mb', 'pool_mb']
+NOISE = {'ms': 10.0, 'mb': 25.0}
+FIXES = 'fill-missing,remove-duplicates,auto-balance'
+RULES = [
+    {"column": "Debit", "condition": ">", "value": "5000"},
+    {"column": "Account", "condition": "empty", "value": ""},
+    {"column": "Description", "condition": "==", "value": "Accrual"},
+]
+
+
+def isolate(workdir):
+    """Point every file the backend writes into workdir and turn its caches off.
+
+    Call it before importing the backend.
+    """
+    for var, name in (('LEDGERLIFT_AUDIT_LOG', 'audit.log'),
+                      ('LEDGERLIFT_FEEDBACK_LOG', 'feedback.log'),
+                      ('LEDGERLIFT_MODEL_DIR', 'models'), ('LEDGERLIFT_RULE_SET_DIR', 'rule_sets'),
+                      ('LEDGERLIFT_STORE_DIR', 'workbooks'), ('LEDGERLIFT_SPOOL_DIR', 'uploads')):
+        os.environ[var] = os.path.join(workdir, name)
+    os.environ['LEDGERLIFT_PARSE_CACHE_MAX_BYTES'] = '0'
+    os.environ['LEDGERLIFT_RESULT_CACHE_MAX_BYTES'] = '0'
+    os.environ.pop('LEDGERLIFT_PROFILE_SLOW_SECONDS', None)
+
+
+def pool_pids(backend):
+    pool = backend._validation_pool
+    return list(getattr(pool, '_processes', None) or {})
+
+
+def reset_peak_rss(pids):
+    for pid in pids:
+        with contextlib.suppress(OSError):
+            with open(f'/proc/{pid}/clear_refs', 'w') as f:
+                f.write('5')
+
+
+def peak_rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid == os.getpid():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    return 0.0
+
+
+async def timed(send, i):
+    start = time.perf_counter()
+    response = await send(i)
+    return (time.perf_counter() - start) * 1000, response
+
+
+async def burst(send, requests, concurrency):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with gate:
+            return await timed(send, i)
+    return await asyncio.gather(*(one(i) for i in range(requests)))
+
+
+async def measure(backend, send, repeat, requests, concurrency):
+    """Sequential and concurrent timings of send(i), plus peak RSS while they ran.
+
+    send(-1) warms up.
+    """
+    await send(-1)  # warm up
+    pids = pool_pids(backend)
+    reset_peak_rss([os.getpid()] + pids)
+    sequential = [await timed(send, i) for i in range(repeat)]
+    concurrent = await burst(lambda i: send(repeat + i), requests, concurrency)
+    ok = [ms for ms, response in concurrent if response.status_code == 200]
+    row = {
+        'best_ms': min(ms for ms, _ in sequential),
+        'median_ms': statistics.median(ms for ms, _ in sequential),
+        'p50_ms': float(np.percentile(ok, 50)) if ok else None,
+        'p99_ms': float(np.percentile(ok, 99)) if ok else None,
+        'failed': sum(response.status_code != 200 for _, response in sequential + concurrent),
+        'server_mb': peak_rss_mb(os.getpid()),
+        'pool_mb': sum(peak_rss_mb(pid) for pid in pids),
+    }
+    return row
+
+
+async def bench_size(backend, client, path, args):
+    with open(path, 'rb') as f:
+        data = f.read()
+    filename = os.path.basename(path)
+    results = {}
+    workbooks = []
+
+    async def upload(i):
+        response = await client.post('/upload', files={'file': (filename, data)})
+        if response.status_code == 200:
+            workbooks.append(response.json().get('workbook_id'))
+        return response
+
+    runs = (args.repeat, args.requests, args.concurrency)
+    results['upload'] = await measure(backend, upload, *runs)
+    if not workbooks:
+        return results
+    shared = workbooks[0]
+    sheet = 'Journal Entries'
+
+    async def custom_errors(i):
+        return await client.post('/custom-errors',
+                                 json={'workbook_id': shared, 'sheet': sheet, 'rules': RULES})
+
+    async def download_csv(i):
+        return await client.get('/download-csv', params={'workbook_id': shared})
+
+    async def bulk_fix(i):
+        # One upload's workbook per request (the warm-up takes the shared one, which is
+        # done with by then), so every request has the same fixes to make
+        workbook_id = workbooks[(i + 1) % len(workbooks)]
+        return await client.post('/bulk-fix', data={'fixes': FIXES, 'workbook_id': workbook_id})
+
+    results['custom_errors'] = await measure(backend, custom_errors, *runs)
+    results['download_csv'] = await measure(backend, download_csv, *runs)
+    results['bulk_fix'] = await measure(backend, bulk_fix, *runs)
+    for workbook_id in workbooks:
+        backend.workbook_store.delete(workbook_id)
+    return results
+
+
+async def run(backend, paths, args):
+    import httpx
+    results = {}
+    async with backend.lifespan(backend.app):
+        transport = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench',
+                                     timeout=None) as client:
+            for rows, path in paths.items():
+                results[str(rows)] = await bench_size(backend, client, path, args)
+    return results
+
+
+def cell(value):
+    return f'{"-":>10}' if value is None else f'{value:10.1f}'
+
+
+def print_results(results):
+    print(f'{"rows":>9} {"endpoint":<14} {"best ms":>10} {"median ms":>10} {"p50 ms":>10} '
+          f'{"p99 ms":>10} {"failed":>7} {"server MB":>10} {"pool MB":>10}')
+    for rows, endpoints in results.items():
+        for endpoint, row in endpoints.items():
+            print(f'{rows:>9} {endpoint:<14} ' + ' '.join(cell(row[m]) for m in METRICS[:4])
+                  + f' {row["failed"]:7d} ' + ' '.join(cell(row[m]) for m in METRICS[4:]))
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for rows, endpoints in results.items():
+        for endpoint, row in endpoints.items():
+            base = baseline.get('results', {}).get(rows, {}).get(endpoint)
+            if base is None:
+                continue
+            for metric in METRICS:
+                new, old = row.get(metric), base.get(metric)
+                if new is None or old is None:
+                    continue
+                if new > old * (1 + tolerance) and new - old > NOISE[metric.rsplit('_', 1)[1]]:
+                    change = (new / old - 1) * 100 if old else float("inf")
+                    found.append(f'{rows} rows {endpoint} {metric}: {old:.1f} -> {new:.1f} '
+                                 f'(+{change:.0f}%)')
+            if row['failed'] > base.get('failed', 0):
+                found.append(f'{rows} rows {endpoint} failed: '
+                             f'{base.get("failed", 0)} -> {row["failed"]}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='1k,10k',
+                        help='comma-separated journal sizes, e.g. 1k,10k,100k,1M')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--workbook-dir',
+                        default=os.path.join(tempfile.gettempdir(), 'ledgerlift_bench_workbooks'))
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline_endpoints.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.3)
+    args = parser.parse_args()
+    sizes = [synthetic_workbook.parse_size(size) for size in args.rows.split(',')]
+    paths = {}
+    for rows in sizes:
+        start = time.perf_counter()
+        paths[rows] = synthetic_workbook.cached_workbook(args.workbook_dir, rows, args.seed,
+                                                         args.error_rate)
+        if time.perf_counter() - start > 1:
+            print(f'wrote {paths[rows]} in {time.perf_counter() - start:.1f}s')
+
+    workdir = tempfile.mkdtemp(prefix='ledgerlift_bench_')
+    isolate(workdir)
+    try:
+        import backend
+        logging.disable(logging.WARNING)
+        results = asyncio.run(run(backend, paths, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f'{backend.VALIDATION_POOL_KIND} pool, {backend.VALIDATION_WORKERS} worker(s); '
+          f'repeat {args.repeat}, {args.requests} requests {args.concurrency} at a time')
+    print_results(results)
+    config = {'repeat': args.repeat, 'concurrency': args.concurrency, 'requests': args.requests,
+              'seed': args.seed, 'error_rate': args.error_rate, 'python': platform.python_version(),
+              'machine': platform.machine(), 'cpus': os.cpu_count()}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=1)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'error: no baseline at {args.baseline}, so nothing was checked for regressions; '
+              'record one on this machine with --save-baseline', file=sys.stderr)
+        return 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    compared = ('repeat', 'concurrency', 'requests', 'seed', 'error_rate')
+    if {k: v for k, v in baseline.get('config', {}).items() if k in compared} != \
+            {k: config[k] for k in compared}:
+        print('warning: the baseline was recorded with different arguments')
+    found = regressions(results, baseline, args.tolerance)
+    for line in found:
+        print('REGRESSION ' + line)
+    if not found:
+        print(f'no regressions against {args.baseline} (tolerance {args.tolerance:.0%})')
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
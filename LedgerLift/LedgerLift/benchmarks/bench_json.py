@@ -0,0 +1,85 @@
+"""Serialization time of /upload-sized preview and error payloads, old path vs FastJSONResponse.
+
+    python benchmarks/bench_json.py [--errors N] [--sheets N] [--repeat N]
+
+"old" is what the endpoints did before: clean_nans() over the payload, then the stdlib
+JSONResponse. "new" is FastJSONResponse (orjson) on the payload as built today, with
+previews made by frame_records().
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import backend  # noqa: E402
+
+
+def preview_payload(sheets):
+    rng = np.random.default_rng(0)
+    preview = {}
+    for i in range(sheets):
+        df = pd.DataFrame({
+            'Date': pd.date_range('2024-01-01', periods=5).strftime('%Y-%m-%d'),
+            'Account': ['Cash', 'Revenue', None, 'Depreciation Expense', 'Equity'],
+            'Debit': rng.normal(1000, 500, 5).round(2),
+            'Credit': np.where(rng.random(5) < 0.4, np.nan, rng.normal(1000, 500, 5).round(2)),
+        })
+        preview[f'Sheet {i}'] = {"columns": list(df.columns), "old": df.to_dict(orient='records'),
+                                 "new": backend.frame_records(df)}
+    return preview
+
+
+def errors_payload(sheets, n):
+    per_sheet = n // sheets
+    errors = {}
+    for i in range(sheets):
+        errs = []
+        for row in range(per_sheet):
+            issue = f"Debit ({row * 1.5}) ≠ Credit (0)" if row % 3 else "Missing value in Credit"
+            errs.append({"row": row + 1, "issue": issue})
+        errors[f'Sheet {i}'] = backend.annotate_errors(errs)
+    return errors
+
+
+def bench(label, fn, repeat):
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+    print(f'{label:<28} {best * 1000:10.2f} ms')
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--errors', type=int, default=200000)
+    parser.add_argument('--sheets', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if not backend.HAS_ORJSON:
+        print('orjson is not installed: FastJSONResponse falls back to the old path.')
+
+    preview = preview_payload(args.sheets)
+    old_preview = {name: {"columns": p["columns"], "sample": p["old"]}
+                   for name, p in preview.items()}
+    new_preview = {name: {"columns": p["columns"], "sample": p["new"]}
+                   for name, p in preview.items()}
+    errors = errors_payload(args.sheets, args.errors)
+
+    print(f'{args.sheets} sheets, {args.errors} errors, best of {args.repeat}')
+    old = bench('preview: clean_nans + json',
+                lambda: JSONResponse(content=backend.clean_nans(old_preview)).body, args.repeat)
+    new = bench('preview: FastJSONResponse',
+                lambda: backend.FastJSONResponse(content=new_preview).body, args.repeat)
+    print(f'{"":<28} {old / new:10.1f}x')
+    old = bench('errors: clean_nans + json',
+                lambda: JSONResponse(content=backend.clean_nans(errors)).body, args.repeat)
+    new = bench('errors: FastJSONResponse',
+                lambda: backend.FastJSONResponse(content=errors).body, args.repeat)
+    print(f'{"":<28} {old / new:10.1f}x')
+
+
+if __name__ == '__main__':
+    main()
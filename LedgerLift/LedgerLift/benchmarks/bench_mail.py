@@ -0,0 +1,146 @@
+"""Email throughput against a stand-in server: an SMTP session per message vs the mail queue.
+
+    python benchmarks/bench_mail.py [--messages N] [--handshake-ms MS] [--reply-ms MS]
+                                    [--fail-every N]
+
+The stand-in server speaks just enough SMTP for smtplib (no TLS or AUTH). It sleeps
+--handshake-ms before its greeting, for the TCP, STARTTLS and login round trips a real relay
+costs, and --reply-ms before every reply. With --fail-every N it answers every Nth RCPT with
+a 451, which the queue retries. "old" sends the messages one after another as send_email()
+used to, one session each. "new" submits them all to a MailQueue and waits until none is
+queued, sending or retrying. Both count the sessions the server saw and the messages it
+accepted.
+"""
+import argparse
+import os
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import backend  # noqa: E402
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        time.sleep(self.server.reply_seconds)
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.sessions += 1
+        time.sleep(server.handshake_seconds)
+        self.reply('220 stand-in ESMTP')
+        for line in self.rfile:
+            verb = line[:4].upper()
+            if verb == b'EHLO':
+                self.reply('250-stand-in\r\n250 8BITMIME')
+            elif verb in (b'HELO', b'MAIL', b'RSET', b'NOOP'):
+                self.reply('250 OK')
+            elif verb == b'RCPT':
+                with server.lock:
+                    server.recipients += 1
+                    refuse = server.fail_every and server.recipients % server.fail_every == 0
+                self.reply('451 try again later' if refuse else '250 OK')
+            elif verb == b'DATA':
+                self.reply('354 end with .')
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                with server.lock:
+                    server.accepted += 1
+                self.reply('250 queued')
+            elif verb == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake_seconds=0.0, reply_seconds=0.0, fail_every=0):
+        super().__init__(('127.0.0.1', 0), StandInSMTPHandler)
+        self.handshake_seconds = handshake_seconds
+        self.reply_seconds = reply_seconds
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.sessions = self.recipients = self.accepted = 0
+
+    def reset(self):
+        with self.lock:
+            self.sessions = self.recipients = self.accepted = 0
+
+
+def old_send_email(port, recipient, subject, body):
+    # send_email() as it was, minus STARTTLS and login, which the stand-in does not offer
+    import smtplib
+    from email.message import EmailMessage
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = 'ledgerlift@example.com'
+    msg['To'] = recipient
+    msg.set_content(body)
+    try:
+        with smtplib.SMTP('127.0.0.1', port) as server:
+            server.send_message(msg)
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
+
+def run_old(port, messages):
+    sent = 0
+    for i in range(messages):
+        ok, _ = old_send_email(port, f'client{i}@example.com', 'LedgerLift Report',
+                               'Your report is ready.')
+        sent += ok
+    return sent
+
+
+def run_new(port, messages):
+    session = backend.SMTPSession('127.0.0.1', port, user='', starttls=False)
+    queue = backend.MailQueue(session, backoff_seconds=0.01)
+    ids = [queue.submit(f'client{i}@example.com', 'LedgerLift Report',
+                        'Your report is ready.').message_id for i in range(messages)]
+    while any(queue.get(message_id).status in ('queued', 'sending', 'retrying')
+              for message_id in ids):
+        time.sleep(0.005)
+    queue.close()
+    return sum(queue.get(message_id).status == 'sent' for message_id in ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--handshake-ms', type=float, default=20.0)
+    parser.add_argument('--reply-ms', type=float, default=1.0)
+    parser.add_argument('--fail-every', type=int, default=0)
+    args = parser.parse_args()
+
+    server = StandInSMTPServer(args.handshake_ms / 1000, args.reply_ms / 1000, args.fail_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    print(f'{args.messages} messages, {args.handshake_ms:g} ms handshake, '
+          f'{args.reply_ms:g} ms per reply'
+          + (f', 451 on every {args.fail_every}th RCPT' if args.fail_every else ''))
+    print(f'{"":<4} {"seconds":>9} {"msg/s":>9} {"sent":>6} {"sessions":>9} {"accepted":>9}')
+    rates = {}
+    for name, run in (('old', run_old), ('new', run_new)):
+        server.reset()
+        start = time.perf_counter()
+        sent = run(port, args.messages)
+        seconds = time.perf_counter() - start
+        rates[name] = args.messages / seconds
+        print(f'{name:<4} {seconds:9.2f} {rates[name]:9.0f} {sent:6d} {server.sessions:9d} '
+              f'{server.accepted:9d}')
+    server.shutdown()
+    print(f'new/old {rates["new"] / rates["old"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
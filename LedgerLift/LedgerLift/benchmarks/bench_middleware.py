@@ -0,0 +1,161 @@
+"""Request throughput through the middleware stack, old BaseHTTPMiddleware classes vs plain ASGI.
+
+    python benchmarks/bench_middleware.py [--requests N] [--concurrency N] [--chunks N]
+                                          [--repeat N]
+
+"old" is the security-header and request-logger middleware as they were, subclasses of
+BaseHTTPMiddleware that rebuilt the CSP string per response. "new" is backend.py's
+stack: the same two as plain ASGI plus CompressionMiddleware. Both wrap the same small
+FastAPI app, driven in-process through httpx's ASGI transport. The cases are a small
+JSON response, one at a time and --concurrency at a time, and a StreamingResponse of
+--chunks 1 KB CSV chunks, which the new stack also gzips (httpx asks for it). Compression
+ratios and times of an /upload-sized error payload and a CSV export are printed at the end.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+import timeit
+import uuid
+
+import pandas as pd
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import backend  # noqa: E402
+
+
+class OldSecurityHeadersMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        response.headers['Content-Security-Policy'] = (
+            "default-src 'self' https://fonts.googleapis.com https://fonts.gstatic.com "
+            "https://cdn.tailwindcss.com https://unpkg.com https://cdn.jsdelivr.net "
+            "https://www.googletagmanager.com https://www.google-analytics.com; "
+            "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com "
+            "https://cdn.tailwindcss.com https://cdn.jsdelivr.net; "
+            "script-src 'self' 'unsafe-inline' https://cdn.tailwindcss.com https://unpkg.com "
+            "https://cdn.jsdelivr.net https://www.googletagmanager.com "
+            "https://www.google-analytics.com; "
+            "font-src 'self' https://fonts.gstatic.com; "
+            "img-src 'self' data: https://fastapi.tiangolo.com; "
+            "connect-src *;"
+        )
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
+        response.headers['Permissions-Policy'] = 'geolocation=()'
+        return response
+
+
+class OldRequestLoggerMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        print(f"Request: {request.method} {request.url.path}")
+        request_id = request.headers.get('x-request-id') or uuid.uuid4().hex
+        token = backend.request_id_var.set(request_id)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            seconds = time.perf_counter() - start
+            backend.request_id_var.reset(token)
+        route = getattr(request.scope.get('route'), 'path', 'unmatched')
+        backend.request_seconds.observe(seconds, request.method, route, response.status_code)
+        response.headers['X-Request-ID'] = request_id
+        return response
+
+
+def make_app(middleware, chunks):
+    app = FastAPI(default_response_class=backend.FastJSONResponse)
+
+    @app.get('/small')
+    async def small():
+        return {"workbook_id": uuid.uuid4().hex, "status": "done", "errors": 3}
+
+    @app.get('/stream')
+    def stream():
+        body = (b'2024-01-01,Cash,100.00,100.00\n' * 34 for _ in range(chunks))
+        return StreamingResponse(body, media_type='text/csv')
+
+    for cls in middleware:
+        app.add_middleware(cls)
+    return app
+
+
+async def throughput(app, path, requests, concurrency):
+    import httpx
+    gate = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        async def one():
+            async with gate:
+                response = await client.get(path)
+                assert response.status_code == 200
+        await one()  # warm up
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        return requests / (time.perf_counter() - start)
+
+
+def compression_table(repeat):
+    amounts = pd.Series(range(200000)) * 1.25
+    errors = {"Journal Entries": [{"row": i + 1, "issue": f"Debit ({i * 1.5}) ≠ Credit (0)",
+                                   "why": "Debits and credits must match"}
+                                  for i in range(50000)]}
+    export = pd.DataFrame({'Date': '2024-01-01', 'Account': 'Cash', 'Debit': amounts,
+                           'Credit': amounts})
+    payloads = {
+        'errors JSON': backend.FastJSONResponse(content=errors).body,
+        'CSV export': b''.join(backend.csv_chunks(export)),
+    }
+    print(f'{"payload":<14} {"encoding":<8} {"bytes":>12} {"ratio":>7} {"ms":>9}')
+    for name, body in payloads.items():
+        print(f'{name:<14} {"identity":<8} {len(body):12d} {1:7.1f} {0:9.1f}')
+        for encoder in backend.ENCODERS:
+            def encode():
+                e = encoder()
+                return e.compress(body) + e.finish()
+            size = len(encode())
+            best = min(timeit.repeat(encode, number=1, repeat=repeat))
+            print(f'{name:<14} {encoder.encoding:<8} {size:12d} {len(body) / size:7.1f} '
+                  f'{best * 1000:9.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--chunks', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    stacks = {
+        'old': [OldSecurityHeadersMiddleware, OldRequestLoggerMiddleware],
+        'new': [backend.CompressionMiddleware, backend.SecurityHeadersMiddleware,
+                backend.RequestLoggerMiddleware],
+    }
+    cases = [('small, 1 at a time', '/small', args.requests, 1),
+             (f'small, {args.concurrency} at a time', '/small', args.requests, args.concurrency),
+             (f'stream, {args.chunks} chunks', '/stream', max(1, args.requests // 50), 1)]
+    print(f'requests per second, best of {args.repeat}')
+    print(f'{"case":<24} {"old":>10} {"new":>10}')
+    for label, path, requests, concurrency in cases:
+        rates = {}
+        for name, middleware in stacks.items():
+            app = make_app(middleware, args.chunks)
+            # The old request logger prints every request
+            with contextlib.redirect_stdout(io.StringIO()):
+                rates[name] = max(asyncio.run(throughput(app, path, requests, concurrency))
+                                  for _ in range(args.repeat))
+        print(f'{label:<24} {rates["old"]:10.0f} {rates["new"]:10.0f}  '
+              f'{rates["new"] / rates["old"]:.2f}x')
+    print()
+    compression_table(args.repeat)
+
+
+if __name__ == '__main__':
+    main()
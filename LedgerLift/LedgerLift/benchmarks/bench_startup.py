@@ -0,0 +1,70 @@
+"""Cold import cost of backend.py and of each heavy dependency, in fresh interpreters.
+
+    python benchmarks/bench_startup.py [--repeat N] [--modules a,b,...]
+
+Every import is timed in its own subprocess (best of --repeat), so costs include the
+module's own dependencies. "at import" says whether `import backend` loads the module;
+the ones it does not load are imported on first use or by the lifespan prewarm.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(HERE, '..')
+
+DEPENDENCIES = ['numpy', 'pandas', 'fastapi', 'orjson', 'pyarrow', 'pyarrow.parquet', 'openpyxl',
+                'sklearn.ensemble', 'smtplib']
+
+TIME_IMPORT = """
+import sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+try:
+    import {module}
+except ImportError:
+    print('missing')
+else:
+    print(time.perf_counter() - start)
+"""
+
+LOADED_BY_BACKEND = """
+import sys
+sys.path.insert(0, {path!r})
+import backend
+print(','.join(m for m in {modules!r} if m in sys.modules))
+"""
+
+
+def run(code):
+    done = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return done.stdout.strip()
+
+
+def import_seconds(module, repeat):
+    results = [run(TIME_IMPORT.format(path=BACKEND_DIR, module=module)) for _ in range(repeat)]
+    if 'missing' in results:
+        return None
+    return min(float(r) for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--modules', default=','.join(DEPENDENCIES))
+    args = parser.parse_args()
+    modules = [m for m in args.modules.split(',') if m]
+
+    loaded = set(run(LOADED_BY_BACKEND.format(path=BACKEND_DIR, modules=modules)).split(','))
+    print(f'best of {args.repeat} cold imports')
+    print(f'{"module":<20} {"ms":>10}  at import')
+    for module in modules + ['backend']:
+        seconds = import_seconds(module, args.repeat)
+        cost = 'missing' if seconds is None else f'{seconds * 1000:.1f}'
+        at_import = '' if module == 'backend' else ('yes' if module in loaded else 'no')
+        print(f'{module:<20} {cost:>10}  {at_import}')
+
+
+if __name__ == '__main__':
+    main()
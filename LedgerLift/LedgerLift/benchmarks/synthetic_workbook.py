@@ -0,0 +1,289 @@
+"""Synthetic CPA workbooks with the sheet layout backend.py validates, plus injected errors.
+
+    python benchmarks/synthetic_workbook.py --rows N [--seed N] [--error-rate F]
+                                            [--format xlsx|csv] [-o PATH]
+
+A workbook has a Chart of Accounts, Journal Entries (--rows rows), a Trial Balance, an
+Income Statement and a Balance Sheet. Journal lines carry equal Debit and Credit amounts,
+as the per-row balance check expects. About --error-rate of the journal lines get one
+injected error each: a missing account name, a bad date, an unbalanced line, an account
+number missing from the chart, a debit to a revenue account, a duplicated line, a
+missing amount or an outlier amount. The trial balance and the statements get one of
+each of their error kinds (abnormal balance, unknown account, out-of-balance total, a
+formula, a missing amount, key lines that do not reconcile) unless --error-rate is 0.
+Journal lines net every account to zero, so with the opt-in trial-journal rule
+(/upload?rules=...,trial-journal) expect one trial_journal_mismatch per account; the
+default rules do not run it. --format csv writes only the journal, as
+journal_entries.csv, since a CSV upload is a single sheet.
+
+The same arguments always give the same workbook.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ACCOUNTS = [
+    (1000, 'Cash', 'Asset'),
+    (1010, 'Petty Cash', 'Asset'),
+    (1100, 'Accounts Receivable', 'Asset'),
+    (1150, 'Allowance for Doubtful Accounts', 'Contra Asset'),
+    (1200, 'Inventory', 'Asset'),
+    (1300, 'Prepaid Expenses', 'Asset'),
+    (1500, 'Equipment', 'Asset'),
+    (1510, 'Accumulated Depreciation', 'Contra Asset'),
+    (2000, 'Accounts Payable', 'Liability'),
+    (2100, 'Accrued Liabilities', 'Liability'),
+    (2200, 'Payroll Taxes Payable', 'Liability'),
+    (2300, 'Deferred Revenue', 'Liability'),
+    (2500, 'Notes Payable', 'Liability'),
+    (3000, "Owner's Capital", 'Equity'),
+    (3100, 'Retained Earnings', 'Equity'),
+    (4000, 'Service Revenue', 'Revenue'),
+    (4100, 'Product Sales', 'Revenue'),
+    (4200, 'Interest Income', 'Revenue'),
+    (4900, 'Sales Returns and Allowances', 'Contra Revenue'),
+    (5000, 'Cost of Goods Sold', 'Expense'),
+    (6000, 'Salaries Expense', 'Expense'),
+    (6100, 'Rent Expense', 'Expense'),
+    (6200, 'Utilities Expense', 'Expense'),
+    (6300, 'Depreciation Expense', 'Expense'),
+    (6400, 'Insurance Expense', 'Expense'),
+    (6500, 'Office Supplies Expense', 'Expense'),
+    (6600, 'Professional Fees', 'Expense'),
+    (6700, 'Travel Expense', 'Expense'),
+    (6800, 'Bank Fees', 'Expense'),
+]
+NORMAL_DEBIT = {'Asset', 'Expense', 'Contra Revenue'}
+# Journal lines name the debited account; these are the accounts a clean line can debit
+DEBIT_TYPES = {'Asset', 'Expense', 'Contra Revenue', 'Liability'}
+DESCRIPTIONS = ['Invoice payment', 'Monthly rent', 'Payroll run', 'Supplier bill',
+                'Customer receipt', 'Utilities', 'Card settlement', 'Accrual', 'Depreciation',
+                'Loan repayment']
+JOURNAL_ERRORS = ['missing_account', 'invalid_date', 'unbalanced_entry', 'unknown_account',
+                  'revenue_debit', 'duplicate_row', 'missing_amount', 'outlier']
+SHEETS = ['Chart of Accounts', 'Journal Entries', 'Trial Balance', 'Income Statement',
+          'Balance Sheet']
+
+
+def parse_size(text):
+    """A row count: 2500, 10k or 1M."""
+    text = text.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * scale)
+
+
+def chart_of_accounts(rows):
+    """The base chart, plus a sub-account (1000-02, ...) per 2,000 journal rows."""
+    accounts = list(ACCOUNTS)
+    for i in range(rows // 2000):
+        number, name, kind = ACCOUNTS[i % len(ACCOUNTS)]
+        location = i // len(ACCOUNTS) + 2
+        accounts.append((f'{number}-{location:02d}', f'{name} - Location {location}', kind))
+    chart = pd.DataFrame(accounts, columns=['Account Number', 'Account Name', 'Type'])
+    chart['Normal Balance'] = np.where(chart['Type'].isin(NORMAL_DEBIT), 'Debit', 'Credit')
+    return chart.sort_values('Account Number', key=lambda numbers: numbers.astype(str),
+                             ignore_index=True)
+
+
+def journal_entries(chart, rows, rng, error_rate):
+    debitable = chart[chart['Type'].isin(DEBIT_TYPES)].reset_index(drop=True)
+    pick = rng.integers(0, len(debitable), rows)
+    amount = np.round(rng.lognormal(6, 1.2, rows), 2)
+    days = np.sort(rng.integers(0, 366, rows))
+    dates = pd.Timestamp('2024-01-01') + pd.to_timedelta(days, unit='D')
+    journal = pd.DataFrame({
+        'Date': dates.strftime('%Y-%m-%d').to_numpy(dtype=object),
+        'Entry': [f'JE-{i // 2 + 1:07d}' for i in range(rows)],
+        'Account Number': debitable['Account Number'].to_numpy()[pick].astype(object),
+        'Account': debitable['Account Name'].to_numpy()[pick].astype(object),
+        'Description': rng.choice(DESCRIPTIONS, rows).astype(object),
+        'Debit': amount,
+        'Credit': amount.copy(),
+    })
+    revenue = chart[chart['Type'] == 'Revenue'].iloc[0]
+    positions = []
+    if rows > 1:
+        positions = rng.choice(np.arange(1, rows), min(rows - 1, round(rows * error_rate)),
+                               replace=False)
+    for i, pos in enumerate(np.sort(positions).tolist()):
+        kind = JOURNAL_ERRORS[i % len(JOURNAL_ERRORS)]
+        if kind == 'missing_account':
+            journal.at[pos, 'Account'] = None
+        elif kind == 'invalid_date':
+            journal.at[pos, 'Date'] = rng.choice(['2024-13-45', 'n/a', ''])
+        elif kind == 'unbalanced_entry':
+            extra = round(float(rng.uniform(1, 500)), 2)
+            journal.at[pos, 'Credit'] = journal.at[pos, 'Debit'] + extra
+        elif kind == 'unknown_account':
+            journal.at[pos, 'Account Number'] = 9900 + int(rng.integers(0, 99))
+            journal.at[pos, 'Account'] = 'Suspense'
+        elif kind == 'revenue_debit':
+            journal.at[pos, 'Account Number'] = revenue['Account Number']
+            journal.at[pos, 'Account'] = revenue['Account Name']
+        elif kind == 'duplicate_row':
+            journal.iloc[pos] = journal.iloc[pos - 1]
+        elif kind == 'missing_amount':
+            journal.at[pos, 'Debit'] = np.nan
+        elif kind == 'outlier':
+            journal.loc[pos, ['Debit', 'Credit']] = journal.at[pos, 'Debit'] * 1000
+    return journal
+
+
+def trial_balance(chart, rng, error_rate):
+    balance = np.round(rng.lognormal(9, 1.5, len(chart)), 2)
+    debit_side = chart['Normal Balance'].eq('Debit').to_numpy()
+    trial = pd.DataFrame({
+        'Account Number': chart['Account Number'].to_numpy(dtype=object),
+        'Account': chart['Account Name'].to_numpy(dtype=object),
+        'Debit': np.where(debit_side, balance, 0.0),
+        'Credit': np.where(debit_side, 0.0, balance),
+    })
+    # Retained earnings takes up the difference, so a clean trial balance balances
+    retained = trial.index[trial['Account'] == 'Retained Earnings'][0]
+    diff = trial['Debit'].sum() - trial['Credit'].sum()
+    trial.at[retained, 'Credit'] = round(trial.at[retained, 'Credit'] + diff, 2)
+    if trial.at[retained, 'Credit'] < 0:
+        trial.at[retained, 'Debit'] = -trial.at[retained, 'Credit']
+        trial.at[retained, 'Credit'] = 0.0
+    if error_rate > 0:
+        cash = trial.index[trial['Account'] == 'Cash'][0]
+        # An abnormal balance, and the trial balance no longer balances
+        trial.loc[cash, ['Debit', 'Credit']] = [0.0, trial.at[cash, 'Debit']]
+        trial.loc[len(trial)] = [9999, 'Suspense', 125.0, 0.0]  # not in the chart
+    total = ['', 'Total', round(trial['Debit'].sum(), 2), round(trial['Credit'].sum(), 2)]
+    trial.loc[len(trial)] = total
+    return trial
+
+
+def statement_lines(sections):
+    """Rows of a statement: a heading, its accounts and a total per section."""
+    rows = []
+    for heading, accounts, total in sections:
+        rows.append(['', heading, None])
+        rows.extend([number, name, amount] for number, name, amount in accounts)
+        rows.append(['', total, round(sum(amount for _, _, amount in accounts), 2)])
+    return rows
+
+
+def statements(chart, trial, error_rate):
+    known = trial[trial['Account Number'].isin(chart['Account Number'])].set_index('Account Number')
+    net = (known['Debit'] - known['Credit']).astype(float)
+    by_type = {kind: [(number, name, round(abs(net[number]), 2))
+                      for number, name in group[['Account Number', 'Account Name']].itertuples(
+                          index=False)]
+               for kind, group in chart.groupby('Type')}
+    income_rows = statement_lines([
+        ('Revenue', by_type.get('Revenue', []), 'Total Revenue'),
+        ('Expenses', by_type.get('Expense', []), 'Total Expenses'),
+    ])
+    revenue = sum(amount for _, _, amount in by_type.get('Revenue', []))
+    expenses = sum(amount for _, _, amount in by_type.get('Expense', []))
+    net_income = round(revenue - expenses, 2)
+    income_rows.append(['', 'Net Income', net_income])
+    if error_rate > 0:
+        number = by_type['Revenue'][0][0]
+        income_rows.insert(2, [number, 'Other Income', '=SUM(C3:C5)'])  # a formula, not a value
+        income_rows.insert(3, [number, 'Consulting Revenue', None])  # missing amount
+    income = pd.DataFrame(income_rows, columns=['Account Number', 'Account', 'Amount'])
+
+    assets = by_type.get('Asset', [])
+    liabilities = by_type.get('Liability', [])
+    # Clean books: retained earnings carries the period's net income and owner's capital
+    # balances the sheet; with errors, retained earnings does neither
+    retained = net_income if error_rate == 0 else round(net_income + 1000, 2)
+    capital = round(sum(a for _, _, a in assets) - sum(a for _, _, a in liabilities)
+                    - net_income, 2)
+    equity = [(3000, "Owner's Capital", capital), (3100, 'Retained Earnings', retained)]
+    balance_rows = statement_lines([
+        ('Assets', assets, 'Total Assets'),
+        ('Liabilities', liabilities, 'Total Liabilities'),
+        ('Equity', equity, 'Total Equity'),
+    ])
+    liab_equity = round(sum(a for _, _, a in liabilities) + capital + retained, 2)
+    balance_rows.append(['', 'Total Liabilities and Equity', liab_equity])
+    balance = pd.DataFrame(balance_rows, columns=['Account Number', 'Account', 'Amount'])
+    return income, balance
+
+
+def workbook(rows, seed=0, error_rate=0.01):
+    """{sheet name: DataFrame} for a workbook with a rows-line journal."""
+    rng = np.random.default_rng(seed)
+    chart = chart_of_accounts(rows)
+    journal = journal_entries(chart, rows, rng, error_rate)
+    trial = trial_balance(chart, rng, error_rate)
+    income, balance = statements(chart, trial, error_rate)
+    if error_rate > 0:
+        # A missing account number
+        chart.loc[len(chart)] = [None, 'Clearing Account', 'Asset', 'Debit']
+    return dict(zip(SHEETS, [chart, journal, trial, income, balance]))
+
+
+def cell(value):
+    """A DataFrame value as openpyxl writes it: NaN and None become empty cells."""
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_xlsx(sheets, path):
+    # Write-only mode streams rows to disk; pd.ExcelWriter keeps every cell in memory
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for name, df in sheets.items():
+        ws = wb.create_sheet(name)
+        ws.append(list(df.columns))
+        for values in df.itertuples(index=False, name=None):
+            ws.append([cell(value) for value in values])
+    wb.save(path)
+
+
+def write_workbook(path, rows, seed=0, error_rate=0.01, format='xlsx'):
+    """Generate and write a workbook (or, for csv, its journal); returns the sheets."""
+    sheets = workbook(rows, seed, error_rate)
+    if format == 'csv':
+        sheets['Journal Entries'].to_csv(path, index=False)
+    else:
+        write_xlsx(sheets, path)
+    return sheets
+
+
+def cached_workbook(directory, rows, seed=0, error_rate=0.01, format='xlsx'):
+    """Path of a generated workbook in directory, writing it only if it is not there yet."""
+    os.makedirs(directory, exist_ok=True)
+    name = 'journal_entries' if format == 'csv' else 'workbook'
+    path = os.path.join(directory, f'{name}-{rows}-{seed}-{error_rate:g}.{format}')
+    if not os.path.exists(path):
+        partial = path + '.partial'
+        write_workbook(partial, rows, seed, error_rate, format)
+        os.replace(partial, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=parse_size, default=10000,
+                        help='journal lines: 2500, 10k, 1M, ...')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--format', choices=('xlsx', 'csv'), default='xlsx')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+    default = 'journal_entries.csv' if args.format == 'csv' else f'workbook-{args.rows}.xlsx'
+    path = args.output or default
+
+    start = time.perf_counter()
+    sheets = write_workbook(path, args.rows, args.seed, args.error_rate, args.format)
+    written = ['Journal Entries'] if args.format == 'csv' else list(sheets)
+    print(f'{path}: ' + ', '.join(f'{name} ({len(sheets[name])} rows)' for name in written)
+          + f' in {time.perf_counter() - start:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,6 +27,8 @@ document.addEventListener('DOMContentLoaded', () => {
   const aiError = document.getElementById('ai-error');
 
   let uploadedFile = null;
+  // Handle of the server-side workbook returned by /upload
+  let workbookId = null;
 
   if (dropZone && fileInput && nextBtn) {
     dropZone.addEventListener('click', () => fileInput.click());
@@ -78,6 +80,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!res.ok) {
           throw new Error(data.error || ('Upload failed: ' + res.statusText));
         }
+        if (data.workbook_id) workbookId = data.workbook_id;
         // Show AI summary (simulate for now)
         if (analyzing) analyzing.classList.add('hidden');
         if (aiSummary) aiSummary.classList.remove('hidden');
@@ -154,6 +157,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const formData = new FormData();
         formData.append('fixes', fixes.join(','));
         if (sheet) formData.append('sheet', sheet);
+        if (workbookId) formData.append('workbook_id', workbookId);
         const res = await fetch('/bulk-fix', {
           method: 'POST',
           body: formData
@@ -217,7 +221,7 @@ document.addEventListener('DOMContentLoaded', () => {
     fetch('/financial-report', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ sheet: null, errors: [], fixes: [], summary: [] })
+      body: JSON.stringify({ workbook_id: workbookId, sheet: null, errors: [], fixes: [], summary: [] })
     })
       .then(res => res.blob())
       .then(blob => {
@@ -238,7 +242,7 @@ document.addEventListener('DOMContentLoaded', () => {
   const downloadCsvBtn = document.getElementById('download-csv-btn');
   if (downloadCsvBtn) {
     downloadCsvBtn.addEventListener('click', () => {
-      fetch('/download-csv')
+      fetch(`/download-csv?workbook_id=${encodeURIComponent(workbookId || '')}`)
         .then(res => res.blob())
         .then(blob => {
           const url = window.URL.createObjectURL(blob);
@@ -270,13 +274,27 @@ document.addEventListener('DOMContentLoaded', () => {
       });
       const data = await res.json();
       const status = document.getElementById('email-status');
-      if (data.success) {
-        if (status) {
-          status.textContent = 'Email sent!';
-          status.classList.remove('hidden');
-        }
-      } else {
+      if (!data.success) {
         alert('Failed to send email: ' + (data.error || 'Unknown error'));
+        return;
+      }
+      if (status) {
+        status.textContent = 'Email queued...';
+        status.classList.remove('hidden');
+      }
+      // The server sends in the background; poll until it has been sent or given up on
+      for (let i = 0; i < 30; i++) {
+        await new Promise(resolve => setTimeout(resolve, 2000));
+        const message = await (await fetch(`/send-email/${data.message_id}`)).json();
+        if (message.status === 'sent') {
+          if (status) status.textContent = 'Email sent!';
+          return;
+        }
+        if (message.status === 'failed' || message.error === 'Unknown or expired message.') {
+          if (status) status.classList.add('hidden');
+          alert('Failed to send email: ' + (message.error || 'Unknown error'));
+          return;
+        }
       }
     });
   }
@@ -310,6 +328,7 @@ document.addEventListener('DOMContentLoaded', () => {
     { id: 'anomaly', label: 'Anomaly Detection (ML)', default: true },
     { id: 'cross-sheet', label: 'Cross-Sheet Reconciliation', default: true },
     { id: 'formula-audit', label: 'Formula Audit', default: true },
+    { id: 'trial-journal', label: 'Trial Balance vs Journal', default: false },
   ];
   const ruleTogglesDiv = document.getElementById('rule-toggles');
   if (ruleTogglesDiv) {
@@ -351,6 +370,7 @@ document.addEventListener('DOMContentLoaded', () => {
         let data;
         try { data = await res.json(); } catch (e) { throw new Error('Upload failed: Invalid JSON response'); }
         if (!res.ok) throw new Error(data.error || ('Upload failed: ' + res.statusText));
+        if (data.workbook_id) workbookId = data.workbook_id;
         if (analyzing) analyzing.classList.add('hidden');
         if (aiSummary) aiSummary.classList.remove('hidden');
         // Repopulate errors table
@@ -0,0 +1,100 @@
+"""Shared fixtures. backend.py reads its settings at import, so they are set here first:
+every file it writes goes to a temporary directory and validation runs on a thread pool."""
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+import pandas as pd
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix='ledgerlift_tests_')
+for var, name in (('LEDGERLIFT_AUDIT_LOG', 'audit.log'),
+                  ('LEDGERLIFT_FEEDBACK_LOG', 'feedback.log'),
+                  ('LEDGERLIFT_MAIL_STATUS_DIR', 'mail'),
+                  ('LEDGERLIFT_MODEL_DIR', 'models'),
+                  ('LEDGERLIFT_RULE_SET_DIR', 'rule_sets'),
+                  ('LEDGERLIFT_STORE_DIR', 'workbooks'),
+                  ('LEDGERLIFT_SPOOL_DIR', 'uploads'),
+                  ('LEDGERLIFT_PROFILE_DIR', 'profiles')):
+    os.environ[var] = os.path.join(WORKDIR, name)
+os.environ['LEDGERLIFT_VALIDATION_POOL'] = 'thread'
+os.environ['LEDGERLIFT_VALIDATION_WORKERS'] = '2'
+os.environ['LEDGERLIFT_PREWARM'] = '0'
+os.environ['LEDGERLIFT_STORE'] = 'memory'
+os.environ.pop('LEDGERLIFT_PROFILE_SLOW_SECONDS', None)
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+
+import backend  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    backend.audit_log.close()
+    backend.feedback_log.close()
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    yield
+
+
+@pytest.fixture
+def client():
+    with TestClient(backend.app) as client:
+        yield client
+
+
+def workbook_bytes(sheets):
+    """An .xlsx file holding {sheet name: DataFrame}."""
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def upload(client):
+    """upload(sheets, DataFrame or bytes, filename=None, **query) posts an .xlsx (or, for
+    one DataFrame, a .csv) to /upload and returns the response."""
+    def upload(data, filename=None, **params):
+        if isinstance(data, bytes):
+            body, filename = data, filename or 'workbook.xlsx'
+        elif isinstance(data, pd.DataFrame):
+            body, filename = data.to_csv(index=False).encode(), filename or 'journal.csv'
+        else:
+            body, filename = workbook_bytes(data), filename or 'workbook.xlsx'
+        return client.post('/upload', params=params, files={'file': (filename, body)})
+    return upload
+
+
+@pytest.fixture
+def small_workbook():
+    """Five sheets with a few known errors in each. Journal row 2 (1-based) has Debit 50
+    and Credit 0 and row 3 has an invalid date."""
+    journal = pd.DataFrame({
+        'Date': ['2024-01-02', '2024-01-03', 'notadate', '2024-01-05', '2024-01-06'],
+        'Account Number': [1000, 4000, 1000, 1000, 1000],
+        'Account': ['Cash', 'Sales', 'Cash', 'Cash', 'Cash'],
+        'Type': ['asset', 'revenue', 'asset', 'asset', 'asset'],
+        'Debit': [100.0, 50.0, 20.0, 10.0, 5.0],
+        'Credit': [100.0, 0.0, 20.0, 10.0, 5.0],
+    })
+    trial = pd.DataFrame({'Account': ['Cash', None, 'AR'], 'Debit': [100, 50, 2000],
+                          'Credit': [100, 0, 1]})
+    chart = pd.DataFrame({'Account Number': [1000, 1000, 4000, None],
+                          'Account Name': ['Cash', 'Cash', 'Sales', 'AR'],
+                          'Type': ['Asset', 'Asset', 'Revenue', None]})
+    income = pd.DataFrame({'Account': ['Revenue', 'Net Income'], 'Amount': [500, '=B1']})
+    balance = pd.DataFrame({'Account': ['Retained Earnings', 'Total Assets',
+                                        'Total Liabilities and Equity'],
+                            'Amount': [400, 1000, 900]})
+    return {'Journal Entries': journal, 'Trial Balance': trial, 'Chart of Accounts': chart,
+            'Income Statement': income, 'Balance Sheet': balance}
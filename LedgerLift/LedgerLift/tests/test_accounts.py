@@ -0,0 +1,79 @@
+import pandas as pd
+
+import backend
+
+CHART = pd.DataFrame({
+    'Account Number': [1000, 2000, 3000, 4000, 4000, None],
+    'Account Name': ['Cash', 'Accounts Payable', "Owner's Equity", 'Sales', 'Other', 'Petty Cash'],
+    'Type': ['Assets', 'Liability', 'Equity', 'Income', 'Expense', 'asset'],
+})
+
+
+def test_account_index_lookup():
+    index = backend.AccountIndex(CHART)
+    rows = pd.DataFrame({'Account Number': ['1000.0', None, ' 4000 ', 9999, None],
+                         'Account': ['x', 'accounts payable', 'x', 'x', 'PETTY CASH']})
+    numbers, named, shown = index.resolve(rows)
+    assert numbers.tolist()[:3] == ['1000', '2000', '4000']
+    assert pd.isna(numbers.iloc[3])
+    assert numbers.iloc[4] == 'petty cash'  # known by its name alone
+    assert named.tolist() == [True] * 5
+    assert shown.tolist() == ['1000.0', 'accounts payable', ' 4000 ', 9999, 'PETTY CASH']
+    # The first of two accounts with one number wins; types are normalised
+    assert index.column(numbers, 'type').tolist()[:3] == ['asset', 'liability', 'revenue']
+    assert index.column(numbers, 'normal_balance').tolist()[:3] == ['debit', 'credit', 'credit']
+
+
+def test_no_chart_no_index():
+    assert backend.build_account_index({'Journal Entries': pd.DataFrame()}) is None
+    assert backend.build_account_index({'Chart of Accounts': CHART[['Account Name']]}) is None
+
+
+def workbook(journal, trial):
+    return {'Chart of Accounts': CHART, 'Journal Entries': journal, 'Trial Balance': trial}
+
+
+def issues(body, sheet):
+    return [(err['row'], err['issue']) for err in body['errors'][sheet]]
+
+
+def test_unknown_accounts_and_abnormal_balances(upload):
+    journal = pd.DataFrame({
+        'Date': ['2024-01-01'] * 3, 'Account Number': [1000, 9999, 4000],
+        'Account': ['Cash', 'Mystery', 'Sales'], 'Type': ['asset', 'asset', 'asset'],
+        'Debit': [10, 10, 10], 'Credit': [10, 10, 10]})
+    trial = pd.DataFrame({'Account': ['Cash', 'Accounts Payable', 'Suspense', 'Sales'],
+                          'Debit': [500, 300, 0, 0], 'Credit': [0, 0, 0, 800]})
+    body = upload(workbook(journal, trial)).json()
+    # The chart says 4000 is revenue, whatever the journal's Type column says
+    assert issues(body, 'Journal Entries') == [
+        (2, 'Account 9999 not found in Chart of Accounts'),
+        (3, 'Revenue account has debit value (GAAP)')]
+    assert issues(body, 'Trial Balance') == [
+        (2, 'Account Accounts Payable has a debit balance; its normal balance is credit'),
+        (3, 'Account Suspense not found in Chart of Accounts')]
+
+
+def test_normal_balance_column_overrides_type(upload):
+    chart = CHART.assign(**{'Normal Balance': ['', 'debit', '', '', '', '']})
+    trial = pd.DataFrame({'Account': ['Accounts Payable'], 'Debit': [300], 'Credit': [0]})
+    body = upload({'Chart of Accounts': chart, 'Trial Balance': trial}).json()
+    assert not [issue for _, issue in issues(body, 'Trial Balance') if 'normal balance' in issue]
+
+
+def test_account_codes_rule_needs_a_chart(upload):
+    trial = pd.DataFrame({'Account': ['Suspense'], 'Debit': [1], 'Credit': [1]})
+    assert upload({'Trial Balance': trial}).json()['errors']['Trial Balance'] == []
+    body = upload({'Chart of Accounts': CHART, 'Trial Balance': trial},
+                  rules='double-entry').json()
+    assert body['errors']['Trial Balance'] == []
+
+
+def test_chart_edit_is_picked_up_on_revalidate(client, upload):
+    trial = pd.DataFrame({'Account': ['Suspense'], 'Debit': [1], 'Credit': [1]})
+    workbook_id = upload({'Chart of Accounts': CHART, 'Trial Balance': trial}).json()['workbook_id']
+    client.post('/edit-cell', json={'workbook_id': workbook_id, 'sheet': 'Chart of Accounts',
+                                    'row': 5, 'column': 'Account Name', 'value': 'Suspense'})
+    changes = client.post('/revalidate', json={'workbook_id': workbook_id}).json()['changes']
+    assert [err['issue'] for err in changes['Trial Balance']['removed']] == [
+        'Account Suspense not found in Chart of Accounts']
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+
+
+@pytest.fixture(autouse=True)
+def model_store(tmp_path, monkeypatch):
+    store = backend.AnomalyModelStore(str(tmp_path))
+    monkeypatch.setattr(backend, 'anomaly_models', store)
+    return store
+
+
+def journal(seed, outlier_row=None, rows=60):
+    rng = np.random.default_rng(seed)
+    amounts = np.round(100 + rng.normal(0, 5, rows), 2)
+    if outlier_row is not None:
+        amounts[outlier_row] = 250000.0
+    return pd.DataFrame({'Date': pd.date_range('2024-01-01', periods=rows).strftime('%Y-%m-%d'),
+                         'Account Number': 1000, 'Account': 'Cash',
+                         'Debit': amounts, 'Credit': amounts})
+
+
+def anomaly_rows(body, sheet='Journal Entries'):
+    return [err['row'] for err in body['errors'][sheet] if err['issue'] == backend.ANOMALY_ISSUE]
+
+
+def test_upload_without_client_or_chart_saves_no_model(upload, model_store):
+    body = upload({'Journal Entries': journal(0, outlier_row=7)}).json()
+    assert 8 in anomaly_rows(body)
+    assert model_store.get(backend.DEFAULT_MODEL_KEY) is None
+    assert os.listdir(model_store.directory) == []
+
+
+def test_default_scoring_does_not_depend_on_earlier_uploads(upload):
+    alone = anomaly_rows(upload({'Journal Entries': journal(2, outlier_row=30)}).json())
+    # A first upload with much larger amounts would have skewed a shared model
+    skewed = journal(1) .assign(Debit=lambda df: df['Debit'] * 1000,
+                                Credit=lambda df: df['Credit'] * 1000)
+    upload({'Journal Entries': skewed}, filename='other.xlsx')
+    again = anomaly_rows(upload({'Journal Entries': journal(2, outlier_row=30)},
+                                filename='again.xlsx').json())
+    assert again == alone == [31]
+
+
+def test_explicitly_trained_default_model_is_used(client, upload, model_store):
+    workbook_id = upload({'Journal Entries': journal(3)}).json()['workbook_id']
+    status = client.get('/anomaly-model', params={'workbook_id': workbook_id}).json()
+    assert status == {'key': backend.DEFAULT_MODEL_KEY, 'trained': False}
+    trained = client.post('/anomaly-model', json={'workbook_id': workbook_id}).json()
+    assert trained['success'] is True and trained['key'] == backend.DEFAULT_MODEL_KEY
+    status = client.get('/anomaly-model', params={'workbook_id': workbook_id}).json()
+    assert status['trained'] is True and status['rows'] == 60
+    body = upload({'Journal Entries': journal(4, outlier_row=5)}, filename='next.xlsx').json()
+    assert 6 in anomaly_rows(body)
+
+
+def test_client_model_is_trained_on_first_upload(client, upload, model_store):
+    upload({'Journal Entries': journal(5, outlier_row=3)}, client='acme')
+    status = client.get('/anomaly-model', params={'client': 'acme'}).json()
+    assert status['trained'] is True and status['key'] == 'client:acme'
+    assert model_store.get(backend.DEFAULT_MODEL_KEY) is None
+
+
+def test_anomaly_model_needs_a_journal(client, upload):
+    workbook_id = upload({'Journal Entries': journal(6, rows=5)}).json()['workbook_id']
+    response = client.post('/anomaly-model', json={'workbook_id': workbook_id})
+    assert response.status_code == 400
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import backend
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def stamp(seconds):
+    return backend.audit_timestamp(START + timedelta(seconds=seconds))
+
+
+@pytest.fixture
+def make_log(tmp_path):
+    logs = []
+
+    def make_log(**options):
+        options.setdefault('flush_seconds', 60)
+        log = backend.AuditLog(str(tmp_path / 'audit.log'), **options)
+        logs.append(log)
+        return log
+    yield make_log
+    for log in logs:
+        log.close()
+
+
+def lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_records_wait_for_a_full_batch(make_log):
+    log = make_log(flush_records=3)
+    written = threading.Event()
+    flush = log.flush
+
+    def flush_and_signal():
+        flush()
+        if log.segments():
+            written.set()
+    log.flush = flush_and_signal
+    log.write({'action': 'one'})
+    log.write({'action': 'two'})
+    assert not written.wait(0.2)
+    log.write({'action': 'three'})
+    assert written.wait(5)
+    assert [record['action'] for record in lines(log.path)] == ['one', 'two', 'three']
+
+
+def test_close_writes_what_is_queued(make_log):
+    log = make_log(flush_records=100)
+    token = backend.request_id_var.set('req-1')
+    try:
+        log.write({'action': 'upload', 'workbook_id': 'wb'})
+    finally:
+        backend.request_id_var.reset(token)
+    log.close()
+    [record] = lines(log.path)
+    assert record['request_id'] == 'req-1' and record['workbook_id'] == 'wb'
+    assert list(record)[0] == 'ts'
+
+
+def test_rotation_keeps_the_newest_records(make_log):
+    log = make_log(max_bytes=400, backups=2)
+    for i in range(40):
+        log.write({'ts': stamp(i), 'action': 'edit', 'n': i})
+        log.flush()
+    paths = log.segments()
+    assert paths == [log.path + '.2', log.path + '.1', log.path]
+    kept = [record['n'] for path in paths for record in lines(path)]
+    assert kept == list(range(40 - len(kept), 40))
+    records, truncated = log.query(limit=1000)
+    assert [record['n'] for record in records] == kept and not truncated
+
+
+def test_first_at_matches_a_scan(make_log, tmp_path):
+    log = make_log()
+    times = sorted([0, 1, 1, 1, 5, 7, 7, 30, 31, 90] * 3)
+    for i, seconds in enumerate(times):
+        log.write({'ts': stamp(seconds), 'action': 'edit', 'detail': 'x' * (i % 7)})
+    log.flush()
+    with open(log.path, 'rb') as f:
+        starts = [0]
+        for line in f:
+            starts.append(starts[-1] + len(line))
+        for seconds in range(-1, 92):
+            ts = stamp(seconds)
+            expected = next((start for start, when in zip(starts, times)
+                             if stamp(when) >= ts), starts[-1])
+            assert backend.AuditLog._first_at(f, ts) == expected
+
+
+def test_query_filters(make_log):
+    log = make_log()
+    for i in range(20):
+        log.write({'ts': stamp(i), 'action': 'upload' if i % 2 else 'edit_cell',
+                   'workbook_id': 'a' if i < 10 else 'b', 'n': i})
+
+    def numbers(**query):
+        return [record['n'] for record in log.query(**query)[0]]
+    assert numbers(since=stamp(5), until=stamp(9)) == [5, 6, 7, 8]
+    assert numbers(actions=('upload',), workbook_id='b') == [11, 13, 15, 17, 19]
+    assert numbers(actions=('upload', 'edit_cell'), since=stamp(18)) == [18, 19]
+    assert numbers(since=stamp(100)) == []
+    records, truncated = log.query(since=stamp(2), limit=3)
+    assert [record['n'] for record in records] == [2, 3, 4] and truncated
+    assert log.query(since=stamp(17), limit=3)[1] is False
+
+
+def test_query_skips_broken_lines(make_log):
+    log = make_log()
+    log.write({'ts': stamp(1), 'action': 'edit'})
+    log.flush()
+    with open(log.path, 'ab') as f:
+        f.write(b'{"ts": "2024-01-01T00:00:02\n')
+    log.write({'ts': stamp(3), 'action': 'edit'})
+    assert [record['ts'] for record in log.query(since=stamp(0))[0]] == [stamp(1), stamp(3)]
+
+
+def test_interleaved_batches_from_two_workers(make_log):
+    first, second = make_log(max_bytes=600, backups=2), make_log(max_bytes=600, backups=2)
+    for i in range(3):
+        first.write({'ts': stamp(2 * i), 'action': 'edit', 'n': 2 * i})
+        second.write({'ts': stamp(2 * i + 1), 'action': 'edit', 'n': 2 * i + 1})
+    second.flush()
+    first.flush()  # older than what the other worker just wrote
+    assert [record['n'] for record in lines(first.path)] == [1, 3, 5, 0, 2, 4]
+    assert os.path.exists(first.path + '.unsorted')
+
+    def numbers(log, **query):
+        return [record['n'] for record in log.query(**query)[0]]
+    for log in (first, second):
+        assert numbers(log, since=stamp(2), until=stamp(5)) == [2, 3, 4]
+        assert numbers(log) == [0, 1, 2, 3, 4, 5]
+        assert numbers(log, since=stamp(1), limit=2) == [1, 2]
+
+    # The marker moves with the file it describes
+    for i in range(6, 12):
+        second.write({'ts': stamp(i), 'action': 'edit', 'n': i})
+        second.flush()
+    assert os.path.exists(first.path + '.1.unsorted')
+    assert not os.path.exists(first.path + '.unsorted')
+    assert numbers(first, since=stamp(3), until=stamp(8)) == [3, 4, 5, 6, 7]
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('2024-01-01T00:00:05', stamp(5)),
+    ('2024-01-01T01:00:05+01:00', stamp(5)),
+    (str(START.timestamp() + 5), stamp(5)),
+])
+def test_audit_bound(text, expected):
+    assert backend.audit_bound(text) == expected
+
+
+def test_audit_log_endpoint(client, upload, small_workbook, make_log, monkeypatch):
+    log = make_log()
+    monkeypatch.setattr(backend, 'audit_log', log)
+    first = upload(small_workbook).json()['workbook_id']
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    second = upload(small_workbook).json()['workbook_id']
+    client.post('/upload', files={'file': ('notes.txt', b'hello')})
+
+    body = client.get('/audit-log', params={'action': 'upload', 'workbook_id': second}).json()
+    assert [record['workbook_id'] for record in body['records']] == [second]
+    assert body['truncated'] is False
+    body = client.get('/audit-log', params={'action': ['upload', 'upload_rejected']}).json()
+    assert [record['action'] for record in body['records']] == [
+        'upload', 'upload', 'upload_rejected']
+    assert body['records'][0]['workbook_id'] == first
+    body = client.get('/audit-log', params={'limit': 1}).json()
+    assert len(body['records']) == 1 and body['truncated'] is True
+    until = body['records'][0]['ts']
+    assert client.get('/audit-log', params={'until': until}).json()['records'] == []
+
+
+def test_audit_log_endpoint_rejects_bad_times(client):
+    response = client.get('/audit-log', params={'since': 'yesterday'})
+    assert response.status_code == 400
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+
+FIXES = ['remove-duplicates', 'fill-missing', 'auto-balance']
+
+
+def is_blank(value):
+    return value is None or value is pd.NA or (isinstance(value, str) and value == '')
+
+
+def reference_bulk_fix(df, applied):
+    """/bulk-fix as it was, one row at a time on a copy. The original tested blanks with
+    `value in [None, "", pd.NA]`, which raises on any other value (pd.NA compares as NA),
+    so auto-balance skipped every row; blanks are tested by identity here instead."""
+    df = df.copy()
+    if 'remove-duplicates' in applied:
+        df = df.drop_duplicates()
+    if 'fill-missing' in applied:
+        df = df.fillna(0)
+    if 'auto-balance' in applied and 'Debit' in df.columns and 'Credit' in df.columns:
+        for idx, row in df.iterrows():
+            try:
+                debit = 0 if is_blank(row['Debit']) else float(row['Debit'])
+                credit = 0 if is_blank(row['Credit']) else float(row['Credit'])
+            except (ValueError, TypeError):
+                continue
+            if pd.isnull(debit) or pd.isnull(credit):
+                continue
+            diff = debit - credit
+            if abs(diff) <= 1e-2 and diff != 0:
+                if debit > credit:
+                    df.at[idx, 'Credit'] = debit
+                else:
+                    df.at[idx, 'Debit'] = credit
+    return df
+
+
+def random_journal(seed, n=60):
+    rng = np.random.default_rng(seed)
+    debit = rng.choice([0.0, 10.0, 25.5, 100.0, np.nan], n)
+    credit = debit + rng.choice([0.0, 0.004, -0.01, 0.02, 5.0], n)
+    credit[rng.random(n) < 0.1] = np.nan
+    df = pd.DataFrame({'Account': rng.choice(['Cash', 'Sales', None], n),
+                       'Debit': debit, 'Credit': credit})
+    return pd.concat([df, df.sample(n // 5, random_state=seed)], ignore_index=True)
+
+
+def records(df):
+    return df.index.tolist(), backend.frame_records(df.astype(object))
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('applied', [FIXES, FIXES[:1], FIXES[1:2], FIXES[2:], FIXES[1:]])
+def test_plan_matches_reference(seed, applied):
+    df = random_journal(seed)
+    expected = reference_bulk_fix(df, applied)
+    fixed = backend.BulkFixPlan(df.copy(), applied).apply(df.copy())
+    assert records(fixed) == records(expected)
+
+
+def test_bulk_fix_endpoint(client, upload):
+    df = random_journal(1)
+    body = upload({'Journal Entries': df}).json()
+    workbook_id = body['workbook_id']
+    preview = client.post('/bulk-fix-preview', json={'workbook_id': workbook_id,
+                                                     'sheet': 'Journal Entries',
+                                                     'fixes': FIXES}).json()['preview']
+    plan = backend.BulkFixPlan(df, FIXES)
+    assert preview[0] == f'Would remove {plan.removed()} duplicate rows.'
+    assert preview[1] == f'Would fill {plan.filled()} missing values with 0.'
+    response = client.post('/bulk-fix', data={'fixes': ','.join(FIXES),
+                                              'workbook_id': workbook_id})
+    result = response.json()['Journal Entries']
+    assert result['summary'][:2] == [f'Removed {plan.removed()} duplicate rows.',
+                                     f'Filled {plan.filled()} missing values with 0.']
+    stored = backend.workbook_store.get(workbook_id).sheets['Journal Entries']
+    expected = reference_bulk_fix(df, FIXES)
+    assert len(stored) == len(expected)
+    assert result['fixed_entries'] == backend.frame_records(expected.head(5))
+    # The fix is one journal entry that undo reverts
+    assert client.post('/undo', json={'workbook_id': workbook_id}).json()['success']
+    restored = backend.workbook_store.get(workbook_id).sheets['Journal Entries']
+    assert records(restored) == records(df)
+
+
+def test_bulk_fix_one_sheet(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    result = client.post('/bulk-fix', data={'fixes': 'fill-missing', 'sheet': 'Trial Balance',
+                                            'workbook_id': workbook_id}).json()
+    assert list(result) == ['Trial Balance']
+    assert result['Trial Balance']['summary'] == ['Filled 1 missing values with 0.']
+    chart = backend.workbook_store.get(workbook_id).sheets['Chart of Accounts']
+    assert chart['Type'].isna().sum() == 1
+
+
+def test_bulk_fix_preview_without_changes(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    preview = client.post('/bulk-fix-preview', json={'workbook_id': workbook_id,
+                                                     'sheet': 'Balance Sheet', 'fixes': []})
+    assert preview.json() == {'preview': ['No changes would be made.']}
+
+
+def test_bulk_fix_without_workbook(client):
+    response = client.post('/bulk-fix', data={'fixes': 'fill-missing', 'workbook_id': 'f' * 32})
+    assert response.status_code == 400
+    preview = client.post('/bulk-fix-preview', json={'workbook_id': 'f' * 32, 'fixes': FIXES})
+    assert preview.json() == {'preview': ['No data loaded.']}
@@ -0,0 +1,50 @@
+import backend
+from conftest import workbook_bytes
+
+
+def stats(client):
+    return client.get('/cache-stats').json()
+
+
+def test_repeated_upload_hits_the_result_cache(client, upload, small_workbook):
+    body = workbook_bytes(small_workbook)
+    before = stats(client)
+    first = upload(body).json()
+    second = upload(body).json()
+    after = stats(client)
+    assert after['results']['hits'] == before['results']['hits'] + 1
+    assert first['workbook_id'] != second['workbook_id']
+    assert {k: v for k, v in first.items() if k != 'workbook_id'} == \
+        {k: v for k, v in second.items() if k != 'workbook_id'}
+
+
+def test_cached_upload_gets_its_own_editable_workbook(client, upload, small_workbook):
+    body = workbook_bytes(small_workbook)
+    hits = stats(client)['results']['hits']
+    first = upload(body).json()['workbook_id']
+    client.post('/edit-cell', json={'workbook_id': first, 'sheet': 'Journal Entries', 'row': 2,
+                                    'column': 'Date', 'value': '2024-01-04'})
+    second = upload(body).json()['workbook_id']
+    assert stats(client)['results']['hits'] == hits + 1
+    assert backend.get_workbook(second).sheets['Journal Entries'].at[2, 'Date'] == 'notadate'
+    errors = client.get('/errors', params={'workbook_id': second, 'type': 'invalid_date'}).json()
+    assert errors['total'] == 1
+
+
+def test_other_rules_miss_the_result_cache(client, upload, small_workbook):
+    body = workbook_bytes(small_workbook)
+    upload(body)
+    hits = stats(client)['results']['hits']
+    body = upload(body, rules='invalid-dates').json()
+    assert stats(client)['results']['hits'] == hits
+    assert {err['issue'] for errs in body['errors'].values() for err in errs} == \
+        {'Invalid or missing Date'}
+
+
+def test_content_cache_evicts_over_budget():
+    cache = backend.ContentCache(max_bytes=10)
+    cache.put('a', 1, 6)
+    cache.put('b', 2, 6)
+    cache.put('huge', 3, 11)
+    assert (cache.get('a'), cache.get('b'), cache.get('huge')) == (None, 2, None)
+    assert cache.stats()['evictions'] == 1
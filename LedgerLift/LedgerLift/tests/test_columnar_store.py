@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+
+
+def sample_sheets():
+    typed = pd.DataFrame({
+        'Account Number': [1000, 4000, 1000],
+        'Debit': [1.5, np.nan, 3.0],
+        'Account': ['Cash', None, 'Sales'],
+        'Date': pd.to_datetime(['2024-01-01', None, '2024-01-03']),
+        'Posted': [True, False, True],
+        'Memo': pd.Series([1, 'edited', None], dtype=object),  # mixed, as edits leave them
+        'Type': pd.Series(['asset', None, 'revenue'], [0, 2, 5], dtype=object),
+        'Ref': pd.Series(['JE-1', np.nan, 'JE-3'], [0, 2, 5], dtype=object),
+    }, index=[0, 2, 5])  # rows dropped by a bulk fix
+    return {
+        'Journal Entries': typed,
+        'Numbered': pd.DataFrame({0: [1, 2], 1: ['a', 'b']}),
+        'Repeated': pd.DataFrame([[1, 2]], columns=['Debit', 'Debit']),
+        'Empty': pd.DataFrame(),
+    }
+
+
+@pytest.mark.skipif(not backend.HAS_PYARROW, reason='needs pyarrow')
+def test_columnar_round_trip(tmp_path):
+    sheets = sample_sheets()
+    backend.save_columnar_sheets(str(tmp_path), sheets, 'w.xlsx')
+    files = sorted(os.listdir(tmp_path))
+    # Only the mixed column and the sheets Arrow cannot label are pickled
+    assert files == ['0.arrow', '0.pkl', '1.pkl', '2.pkl', '3.arrow', 'manifest.json']
+    loaded = backend.load_columnar_sheets(str(tmp_path))
+    assert list(loaded) == list(sheets)
+    for name, df in sheets.items():
+        pd.testing.assert_frame_equal(loaded[name], df)
+
+
+@pytest.mark.skipif(not backend.HAS_PYARROW, reason='needs pyarrow')
+def test_string_columns_read_back_from_arrow(tmp_path):
+    backend.save_columnar_sheets(str(tmp_path), sample_sheets())
+    with open(tmp_path / '0.pkl', 'rb') as f:
+        assert list(backend.pickle.load(f)['values']) == ['Memo']
+    with backend.pa.memory_map(str(tmp_path / '0.arrow')) as source:
+        table = backend.pa.ipc.open_file(source).read_all()
+    assert table.schema.field('Type').type == backend.pa.string()
+    assert table.column('Ref').to_pylist() == ['JE-1', None, 'JE-3']
+    loaded = backend.load_columnar_sheets(str(tmp_path))['Journal Entries']
+    assert loaded['Type'].tolist() == ['asset', None, 'revenue']
+    assert loaded['Ref'].isna().tolist() == [False, True, False]
+    assert isinstance(loaded['Ref'][2], float) and loaded['Type'].dtype == object
+
+
+@pytest.mark.parametrize('has_pyarrow', [True, False])
+def test_disk_store_keeps_dtypes(tmp_path, monkeypatch, has_pyarrow):
+    if has_pyarrow and not backend.HAS_PYARROW:
+        pytest.skip('needs pyarrow')
+    monkeypatch.setattr(backend, 'HAS_PYARROW', has_pyarrow)
+    store = backend.DiskWorkbookStore(str(tmp_path))
+    store.put('a' * 32, backend.Workbook(sample_sheets(), filename='w.xlsx'))
+    workbook = store.get('a' * 32)
+    assert workbook.filename == 'w.xlsx'
+    for name, df in sample_sheets().items():
+        pd.testing.assert_frame_equal(workbook.sheets[name], df)
+    sheet_dirs = [name for name in os.listdir(tmp_path) if name.endswith('.sheets')]
+    assert len(sheet_dirs) == (1 if has_pyarrow else 0)
+
+
+def test_disk_store_keeps_one_sheet_dir_per_workbook(tmp_path):
+    store = backend.DiskWorkbookStore(str(tmp_path))
+    for workbook_id in ('a' * 32, 'b' * 32):
+        for _ in range(3):
+            store.put(workbook_id, backend.Workbook(sample_sheets()))
+    names = sorted(os.listdir(tmp_path))
+    assert [name for name in names if name.endswith('.pkl')] == ['a' * 32 + '.pkl',
+                                                                 'b' * 32 + '.pkl']
+    if backend.HAS_PYARROW:
+        assert sorted(name.split('.')[0] for name in names if name.endswith('.sheets')) == \
+            ['a' * 32, 'b' * 32]
+    store.delete('a' * 32)
+    assert all(not name.startswith('a' * 32) for name in os.listdir(tmp_path))
+
+
+def test_disk_store_survives_fixes_and_undo(client, upload, tmp_path, monkeypatch,
+                                            small_workbook):
+    store = backend.DiskWorkbookStore(str(tmp_path))
+    monkeypatch.setattr(backend, 'workbook_store', store)
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    original = {name: df.copy() for name, df in store.get(workbook_id).sheets.items()}
+    client.post('/bulk-fix', data={'fixes': 'remove-duplicates,fill-missing',
+                                   'workbook_id': workbook_id})
+    client.post('/edit-cell', json={'workbook_id': workbook_id, 'sheet': 'Trial Balance',
+                                    'row': 0, 'column': 'Debit', 'value': 'n/a'})
+    fixed = store.get(workbook_id).sheets
+    assert fixed['Chart of Accounts'].index.tolist() == [0, 2, 3]
+    assert fixed['Trial Balance']['Debit'].tolist() == ['n/a', 50, 2000]
+    assert client.post('/goto-version', json={'workbook_id': workbook_id,
+                                              'version': 0}).json()['success']
+    for name, df in store.get(workbook_id).sheets.items():
+        pd.testing.assert_frame_equal(df, original[name])
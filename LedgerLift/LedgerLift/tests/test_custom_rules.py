@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+import backend
+import bench_custom_rules
+
+
+@pytest.fixture
+def rule_set_store(tmp_path, monkeypatch):
+    store = backend.RuleSetStore(str(tmp_path))
+    monkeypatch.setattr(backend, 'rule_sets', store)
+    return store
+
+
+@pytest.mark.parametrize('rows', [1, 50, 500])
+def test_compiled_rules_match_row_loop(rows):
+    df = bench_custom_rules.sheet(rows)
+    rules = bench_custom_rules.RULES + [
+        {"column": "Missing", "condition": ">", "value": "1"},
+        {"column": "Debit", "condition": ">", "value": "n/a"},
+        {"column": "Type", "condition": "==", "value": "asset"},
+        {"column": "Debit", "condition": "==", "value": "nan"},
+    ]
+    assert backend.custom_rule_errors(df, rules) == \
+        bench_custom_rules.old_custom_errors(df, rules)
+
+
+def test_rules_combine_with_all_and_any():
+    df = bench_custom_rules.sheet(300)
+    big = {"column": "Debit", "condition": ">", "value": "4000"}
+    suspense = {"column": "Account", "condition": "==", "value": "Suspense"}
+    rows = {key: {err['row'] for err in backend.custom_rule_errors(df, [rule])}
+            for key, rule in (('big', big), ('suspense', suspense))}
+    both = backend.custom_rule_errors(df, [{"all": [big, suspense]}])
+    either = backend.custom_rule_errors(df, [{"any": [big, {"all": [suspense]}]}])
+    assert {err['row'] for err in both} == rows['big'] & rows['suspense']
+    assert {err['row'] for err in either} == rows['big'] | rows['suspense']
+    assert both[0]['issue'] == 'Custom rule: (Debit > 4000 and Account == Suspense)'
+    assert [err['row'] for err in either] == sorted(err['row'] for err in either)
+
+
+def test_each_column_is_coerced_once(monkeypatch):
+    df = bench_custom_rules.sheet(100)
+    calls = []
+    amount_column = backend.amount_column
+    monkeypatch.setattr(backend, 'amount_column',
+                        lambda df, col: calls.append(col) or amount_column(df, col))
+    backend.custom_rule_errors(df, [{"column": "Debit", "condition": ">", "value": str(v)}
+                                    for v in range(10)])
+    assert calls == ['Debit']
+
+
+@pytest.mark.parametrize('rule', [
+    'Debit > 5', {"column": "Debit", "condition": "~", "value": "1"}, {"all": []},
+    {"any": {"column": "Debit"}}])
+def test_malformed_rules(rule):
+    with pytest.raises(ValueError):
+        backend.custom_rule_errors(bench_custom_rules.sheet(5), [rule])
+
+
+def test_custom_errors_endpoint(client, upload, rule_set_store, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    rule = {"column": "Debit", "condition": ">=", "value": "50"}
+    response = client.post('/custom-errors', json={'workbook_id': workbook_id,
+                                                   'sheet': 'Journal Entries', 'rules': [rule]})
+    assert response.json()['custom_errors'] == [
+        {'row': 1, 'issue': 'Custom rule: Debit >= 50'},
+        {'row': 2, 'issue': 'Custom rule: Debit >= 50'}]
+
+    saved = client.post('/rule-sets', json={'name': 'Month end', 'rules': [rule]}).json()
+    assert saved['name'] == 'Month end' and saved['rules'] == [rule]
+    assert [rule_set['name'] for rule_set in client.get('/rule-sets').json()['rule_sets']] == \
+        ['Month end']
+    extra = {"column": "Account", "condition": "!=", "value": "Cash"}
+    response = client.post('/custom-errors', json={'workbook_id': workbook_id,
+                                                   'sheet': 'Journal Entries',
+                                                   'rule_set': 'Month end', 'rules': [extra]})
+    assert [err['row'] for err in response.json()['custom_errors']] == [1, 2, 2]
+
+    assert client.delete('/rule-sets/Month end').json() == {'name': 'Month end', 'deleted': True}
+    assert client.delete('/rule-sets/Month end').status_code == 404
+    response = client.post('/custom-errors', json={'workbook_id': workbook_id,
+                                                   'rule_set': 'Month end'})
+    assert response.status_code == 404
+
+
+def test_bad_rules_are_400(client, upload, rule_set_store, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    bad = {"column": "Debit", "condition": "between", "value": "1"}
+    response = client.post('/custom-errors', json={'workbook_id': workbook_id, 'rules': [bad]})
+    assert response.status_code == 400 and 'between' in response.json()['error']
+    for rules in (['Debit > 1'], [{"any": {"column": "Debit"}}]):
+        response = client.post('/custom-errors', json={'workbook_id': workbook_id,
+                                                       'rules': rules})
+        assert response.status_code == 400
+    assert client.post('/rule-sets', json={'name': 'x', 'rules': [bad]}).status_code == 400
+    assert client.post('/rule-sets', json={'name': ' ', 'rules': []}).status_code == 400
+    assert client.post('/rule-sets', json={'name': 'x', 'rules': 'Debit > 1'}).status_code == 400
+    assert client.get('/rule-sets').json() == {'rule_sets': []}
+
+
+def test_custom_errors_without_workbook(client):
+    response = client.post('/custom-errors', json={'workbook_id': 'f' * 32, 'rules': []})
+    assert response.json() == {'custom_errors': []}
+
+
+def test_rules_on_numeric_text_columns():
+    df = bench_custom_rules.sheet(20)
+    df['Amount Text'] = np.where(np.arange(20) % 2, '3000', ' 42 ')
+    errors = backend.custom_rule_errors(df, [{"column": "Amount Text", "condition": "<",
+                                              "value": "100"}])
+    assert [err['row'] for err in errors] == list(range(1, 21, 2))
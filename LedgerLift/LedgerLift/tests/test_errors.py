@@ -0,0 +1,110 @@
+import pytest
+
+import backend
+
+
+def walk(client, workbook_id, limit, **params):
+    """Every page of /errors, following next_cursor."""
+    pages, cursor = [], None
+    while True:
+        query = {'workbook_id': workbook_id, 'limit': limit, **params}
+        if cursor:
+            query['cursor'] = cursor
+        page = client.get('/errors', params=query).json()
+        pages.append(page)
+        cursor = page['next_cursor']
+        if cursor is None:
+            return pages
+
+
+def flat(errors_by_sheet):
+    return [{'sheet': name, **err} for name, errs in errors_by_sheet.items() for err in errs]
+
+
+def strip(errs):
+    return [(err['sheet'], err['row'], err['issue']) for err in errs]
+
+
+@pytest.mark.parametrize('limit', [1, 2, 1000])
+def test_pages_cover_every_error_in_order(client, upload, small_workbook, limit):
+    body = upload(small_workbook).json()
+    pages = walk(client, body['workbook_id'], limit)
+    assert all(len(page['errors']) <= limit for page in pages)
+    found = [err for page in pages for err in page['errors']]
+    expected = flat(body['errors'])
+    sheets = list(body['errors'])
+    # Sheet-level errors (row None) sort first within their sheet
+    expected.sort(key=lambda err: (sheets.index(err['sheet']),
+                                   -1 if err['row'] is None else err['row']))
+    assert strip(found) == strip(expected)
+    assert all(err['why'] and err['type'] in pages[0]['types'] for err in found)
+    assert {page['total'] for page in pages} == {len(expected)}
+
+
+def test_filters(client, upload, small_workbook):
+    body = upload(small_workbook).json()
+    workbook_id = body['workbook_id']
+    all_errors = flat(body['errors'])
+
+    page = client.get('/errors', params={'workbook_id': workbook_id,
+                                         'sheet': ['Trial Balance', 'Chart of Accounts']}).json()
+    assert {err['sheet'] for err in page['errors']} == {'Trial Balance', 'Chart of Accounts'}
+    assert page['total'] == sum(err['sheet'] in ('Trial Balance', 'Chart of Accounts')
+                                for err in all_errors)
+
+    page = client.get('/errors', params={'workbook_id': workbook_id,
+                                         'type': 'invalid_date'}).json()
+    assert strip(page['errors']) == [('Journal Entries', 3, 'Invalid or missing Date')]
+    assert page['counts'] == {'Journal Entries': {'invalid_date': 1}}
+
+    page = client.get('/errors', params={'workbook_id': workbook_id, 'row_min': 2,
+                                         'row_max': 2}).json()
+    assert page['errors'] and all(err['row'] == 2 for err in page['errors'])
+
+    page = client.get('/errors', params={'workbook_id': workbook_id, 'type': 'no_such_type'})
+    assert page.json()['total'] == 0
+
+
+def test_cursor_survives_revalidation(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    first = client.get('/errors', params={'workbook_id': workbook_id,
+                                          'sheet': 'Journal Entries', 'limit': 1}).json()
+    assert strip(first['errors']) == [('Journal Entries', 2, 'Debit (50.0) ≠ Credit (0.0)')]
+    client.post('/edit-cell', json={'workbook_id': workbook_id, 'sheet': 'Journal Entries',
+                                    'row': 0, 'column': 'Date', 'value': 'garbage'})
+    client.post('/revalidate', json={'workbook_id': workbook_id})
+    rest = client.get('/errors', params={'workbook_id': workbook_id, 'sheet': 'Journal Entries',
+                                         'cursor': first['next_cursor']}).json()
+    # Row 1 now has an error but sorts before the cursor; the rest follow on unchanged
+    assert strip(rest['errors']) == [
+        ('Journal Entries', 2, 'Revenue account has debit value (GAAP)'),
+        ('Journal Entries', 3, 'Invalid or missing Date')]
+
+
+@pytest.mark.parametrize('cursor', ['garbage', '1.2', '1.x.3'])
+def test_invalid_cursor(client, upload, small_workbook, cursor):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    response = client.get('/errors', params={'workbook_id': workbook_id, 'cursor': cursor})
+    assert response.status_code == 400
+
+
+def test_errors_without_workbook(client):
+    assert client.get('/errors', params={'workbook_id': 'f' * 32}).status_code == 400
+
+
+def test_limit_is_capped(client, upload, monkeypatch, small_workbook):
+    monkeypatch.setattr(backend, 'ERRORS_MAX_PAGE_SIZE', 2)
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    page = client.get('/errors', params={'workbook_id': workbook_id, 'limit': 100}).json()
+    assert len(page['errors']) == 2
+    assert page['next_cursor'] is not None
+
+
+def test_error_table_compaction_keeps_cursors():
+    table = backend.ErrorTable({'Journal Entries': [{'row': row, 'issue': 'Duplicate row'}
+                                                    for row in range(1, 2001)]})
+    positions, cursor = table.page(table.select(), limit=10)
+    table.replace_rows('Journal Entries', {row: [] for row in range(1, 1500)})
+    assert len(table.alive) < 2000  # compacted
+    positions, _ = table.page(table.select(), backend.parse_error_cursor(cursor), limit=3)
+    assert [err['row'] for err in table.errors(positions)] == [1500, 1501, 1502]
@@ -0,0 +1,124 @@
+import asyncio
+import io
+import uuid
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+
+
+def stored_workbook(sheets):
+    workbook_id = uuid.uuid4().hex
+    backend.workbook_store.put(workbook_id, backend.Workbook(sheets, filename='w.xlsx'))
+    return workbook_id
+
+
+def ledger(rows):
+    return pd.DataFrame({'Account Number': np.arange(rows) % 50 + 1000,
+                         'Account': 'Cash', 'Debit': np.arange(rows, dtype=float),
+                         'Credit': np.arange(rows, dtype=float)})
+
+
+def test_edit_during_export_does_not_change_it(client):
+    df = ledger(backend.EXPORT_BATCH_ROWS * 2 + 5)
+    expected = df.to_csv(index=False).encode()
+    workbook_id = stored_workbook({'Journal Entries': df})
+    response = backend.download_csv(sheet='Journal Entries', workbook_id=workbook_id)
+
+    async def stream():
+        chunks = response.body_iterator
+        body = [await chunks.__anext__(), await chunks.__anext__()]
+        for row, column, value in ((0, 'Debit', -1.0), (len(df) - 1, 'Account', 'edited')):
+            edit = client.post('/edit-cell', json={'workbook_id': workbook_id,
+                                                   'sheet': 'Journal Entries', 'row': row,
+                                                   'column': column, 'value': value})
+            assert edit.json() == {'success': True}
+        return b''.join(body + [chunk async for chunk in chunks])
+
+    assert asyncio.run(stream()) == expected
+    assert backend.workbook_store.get(workbook_id).sheets['Journal Entries'].iat[-1, 1] == 'edited'
+
+
+def edit_cell(client, workbook_id):
+    return client.post('/edit-cell', json={'workbook_id': workbook_id, 'sheet': 'Journal Entries',
+                                           'row': 0, 'column': 'Debit', 'value': -1.0})
+
+
+# Each one writes into the stored frame's columns rather than replacing the frame
+EDITS = {
+    'edit-cell': (None, edit_cell),
+    'bulk-fix': (None, lambda client, workbook_id: client.post(
+        '/bulk-fix', data={'fixes': 'fill-missing,auto-balance', 'workbook_id': workbook_id})),
+    'undo': (edit_cell, lambda client, workbook_id: client.post(
+        '/undo', json={'workbook_id': workbook_id})),
+}
+
+
+@pytest.mark.parametrize('before, during', EDITS.values(), ids=list(EDITS))
+def test_export_snapshot_survives_edit_paths(client, before, during):
+    df = ledger(backend.EXPORT_BATCH_ROWS * 2 + 5)
+    df.loc[3, 'Debit'] = np.nan  # filled by fill-missing
+    df.loc[len(df) - 1, 'Credit'] += 0.004  # balanced by auto-balance
+    workbook_id = stored_workbook({'Journal Entries': df})
+    if before is not None:
+        assert before(client, workbook_id).status_code == 200
+    stored = backend.workbook_store.get(workbook_id).sheets['Journal Entries']
+    expected = stored.to_csv(index=False).encode()
+    response = backend.download_csv(sheet='Journal Entries', workbook_id=workbook_id)
+
+    async def stream():
+        chunks = response.body_iterator
+        first = await chunks.__anext__()
+        assert during(client, workbook_id).status_code == 200
+        return b''.join([first] + [chunk async for chunk in chunks])
+
+    assert asyncio.run(stream()) == expected
+    edited = backend.workbook_store.get(workbook_id).sheets['Journal Entries']
+    assert edited.to_csv(index=False).encode() != expected
+
+
+def test_download_csv_one_sheet(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    response = client.get('/download-csv', params={'workbook_id': workbook_id,
+                                                   'sheet': 'Trial Balance'})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/csv')
+    exported = pd.read_csv(io.BytesIO(response.content))
+    assert exported['Debit'].tolist() == [100, 50, 2000]
+
+
+def test_download_csv_zips_every_sheet(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    response = client.get('/download-csv', params={'workbook_id': workbook_id})
+    names = zipfile.ZipFile(io.BytesIO(response.content)).namelist()
+    assert names == [f"{name.replace(' ', '_')}.csv" for name in small_workbook]
+
+
+def test_download_parquet(client):
+    df = ledger(100)
+    workbook_id = stored_workbook({'Journal Entries': df})
+    response = client.get('/download-csv', params={'workbook_id': workbook_id,
+                                                   'sheet': 'Journal Entries',
+                                                   'format': 'parquet'})
+    assert response.status_code == 200
+    pd.testing.assert_frame_equal(pd.read_parquet(io.BytesIO(response.content)), df)
+
+
+def test_download_errors(client):
+    assert client.get('/download-csv', params={'workbook_id': 'missing'}).status_code == 404
+    workbook_id = stored_workbook({'Journal Entries': ledger(3)})
+    response = client.get('/download-csv', params={'workbook_id': workbook_id, 'format': 'xml'})
+    assert response.status_code == 400
+
+
+def test_download_excel(client):
+    df = ledger(30)
+    workbook_id = stored_workbook({'Journal Entries': df, 'Trial Balance': ledger(4)})
+    response = client.get('/download-excel', params={'workbook_id': workbook_id})
+    assert response.status_code == 200
+    sheets = pd.read_excel(io.BytesIO(response.content), sheet_name=None)
+    assert list(sheets) == ['Journal Entries', 'Trial Balance']
+    assert sheets['Journal Entries']['Debit'].tolist() == df['Debit'].tolist()
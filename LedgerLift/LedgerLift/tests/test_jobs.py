@@ -0,0 +1,145 @@
+import time
+
+import pytest
+
+import backend
+from conftest import workbook_bytes
+
+
+@pytest.fixture
+def submit(client):
+    def submit(sheets, **params):
+        return client.post('/jobs', params=params,
+                           files={'file': ('workbook.xlsx', workbook_bytes(sheets))})
+    return submit
+
+
+def wait(client, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        summary = client.get(f'/jobs/{job_id}').json()
+        if summary['status'] not in ('queued', 'running') or time.monotonic() > deadline:
+            return summary
+        time.sleep(0.02)
+
+
+def test_job_matches_upload(client, upload, submit, small_workbook):
+    expected = upload(small_workbook).json()
+    backend.result_cache.clear()
+    backend.parse_cache.clear()
+    response = submit(small_workbook)
+    assert response.status_code == 202
+    job_id = response.json()['job_id']
+    summary = wait(client, job_id)
+    assert summary['status'] == 'done'
+    assert summary['errors_found'] == sum(len(errs) for errs in expected['errors'].values())
+    assert summary['sheets']['Journal Entries']['rows'] == 5
+    workbook_id = summary['workbook_id']
+    assert client.get('/errors', params={'workbook_id': workbook_id}).status_code == 200
+
+    # Walk every sheet a page at a time
+    errors, params = {}, {'limit': 2}
+    while True:
+        page = client.get(f'/jobs/{job_id}/results', params=params).json()
+        assert page['workbook_id'] == workbook_id
+        errors.setdefault(page['sheet'], []).extend(page['errors'])
+        if page['next_offset'] is not None:
+            params.update(sheet=page['sheet'], offset=page['next_offset'])
+        elif page['next_sheet'] is not None:
+            params.update(sheet=page['next_sheet'], offset=0)
+        else:
+            break
+    assert errors == expected['errors']
+    assert page['sheets'] == list(expected['errors'])
+
+
+def test_job_results_before_done_and_unknown(client):
+    job = backend.ValidationJob('a' * 32, 'workbook.xlsx')
+    job.status = 'running'
+    backend.validation_jobs.add(job)
+    response = client.get(f'/jobs/{job.job_id}/results')
+    assert response.status_code == 409
+    assert response.json()['status'] == 'running'
+    assert client.get('/jobs/' + 'b' * 32).status_code == 404
+    assert client.get('/jobs/not-an-id/results').status_code == 404
+    assert client.delete('/jobs/' + 'b' * 32).status_code == 404
+
+
+def test_job_unknown_sheet(client, submit, small_workbook):
+    job_id = submit(small_workbook).json()['job_id']
+    assert wait(client, job_id)['status'] == 'done'
+    response = client.get(f'/jobs/{job_id}/results', params={'sheet': 'Nope'})
+    assert response.status_code == 404
+
+
+def test_cancel_job(client, monkeypatch, submit, small_workbook):
+    started = backend.threading.Event()
+    release = backend.threading.Event()
+    check = backend.validate_upload_sheet
+
+    def blocked(*args):
+        started.set()
+        release.wait(10)
+        return check(*args)
+
+    monkeypatch.setattr(backend, 'validate_upload_sheet', blocked)
+    admitted = backend.heavy_jobs.admitted
+    job_id = submit(small_workbook).json()['job_id']
+    assert started.wait(10)
+    response = client.delete(f'/jobs/{job_id}')
+    assert response.json()['status'] == 'cancelled'
+    release.set()
+    summary = wait(client, job_id)
+    assert summary['status'] == 'cancelled'
+    assert summary['finished'] is not None
+    assert backend.heavy_jobs.admitted == admitted
+    assert client.get(f'/jobs/{job_id}/results').status_code == 409
+
+
+def test_job_rejects_bad_input(client):
+    response = client.post('/jobs', files={'file': ('notes.txt', b'hello')})
+    assert 'Invalid file type' in response.json()['error']
+    response = client.post('/jobs', params={'mode': 'nope'},
+                           files={'file': ('workbook.xlsx', b'')})
+    assert response.status_code == 400
+
+
+def test_finished_jobs_expire(client, monkeypatch, submit, small_workbook):
+    job_id = submit(small_workbook).json()['job_id']
+    assert wait(client, job_id)['status'] == 'done'
+    now = time.time()
+    monkeypatch.setattr(backend.time, 'time', lambda: now + backend.JOB_TTL_SECONDS + 1)
+    assert client.get(f'/jobs/{job_id}').status_code == 404
+
+
+def test_job_from_another_worker(client, monkeypatch, submit, small_workbook):
+    job_id = submit(small_workbook).json()['job_id']
+    summary = wait(client, job_id)
+    assert summary['status'] == 'done'
+    first_page = client.get(f'/jobs/{job_id}/results').json()
+    # A worker that did not run the job reads its saved state
+    monkeypatch.setattr(backend, 'validation_jobs', backend.JobRegistry())
+    assert client.get(f'/jobs/{job_id}').json() == summary
+    assert client.get(f'/jobs/{job_id}/results').json() == first_page
+
+
+def test_cancel_job_from_another_worker(client, monkeypatch, submit, small_workbook):
+    started = backend.threading.Event()
+    release = backend.threading.Event()
+    check = backend.validate_upload_sheet
+
+    def blocked(*args):
+        started.set()
+        release.wait(10)
+        return check(*args)
+
+    monkeypatch.setattr(backend, 'validate_upload_sheet', blocked)
+    job_id = submit(small_workbook).json()['job_id']
+    assert started.wait(10)
+    monkeypatch.setattr(backend, 'validation_jobs', backend.JobRegistry())
+    assert client.get(f'/jobs/{job_id}').json()['status'] == 'running'
+    assert client.delete(f'/jobs/{job_id}').json()['status'] == 'cancelled'
+    release.set()
+    summary = wait(client, job_id)
+    assert summary['status'] == 'cancelled'
+    assert summary['finished'] is not None
@@ -0,0 +1,54 @@
+import datetime
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+
+CONTENT = {
+    'nan': float('nan'), 'inf': float('-inf'), 'np_nan': np.float64('nan'),
+    'np_float': np.float32(1.5), 'np_int': np.int64(5), 'np_bool': np.bool_(True),
+    'na': pd.NA, 'nat': pd.NaT, 'timestamp': pd.Timestamp('2024-01-02 03:04:05'),
+    'date': datetime.date(2024, 1, 2), 'nested': [{'row': 1, 'amount': float('nan')}],
+    'tuple': (1, float('nan')), 'int_keys': {1: 'a'}, 'text': 'Debit ≠ Credit',
+}
+EXPECTED = {
+    'nan': None, 'inf': None, 'np_nan': None, 'np_float': 1.5, 'np_int': 5, 'np_bool': True,
+    'na': None, 'nat': None, 'timestamp': '2024-01-02T03:04:05', 'date': '2024-01-02',
+    'nested': [{'row': 1, 'amount': None}], 'tuple': [1, None], 'int_keys': {'1': 'a'},
+    'text': 'Debit ≠ Credit',
+}
+
+
+@pytest.mark.parametrize('has_orjson', [True, False])
+def test_fast_json_response(monkeypatch, has_orjson):
+    monkeypatch.setattr(backend, 'HAS_ORJSON', has_orjson)
+    body = backend.FastJSONResponse(content=CONTENT).body
+    assert json.loads(body) == EXPECTED
+    assert isinstance(json.loads(body)['np_int'], int)
+
+
+def test_orjson_and_fallback_agree(monkeypatch):
+    orjson_body = backend.FastJSONResponse(content=CONTENT).body
+    monkeypatch.setattr(backend, 'HAS_ORJSON', False)
+    assert backend.FastJSONResponse(content=CONTENT).body == orjson_body
+
+
+def test_frame_records_masks_missing_values():
+    df = pd.DataFrame({'a': [1.0, np.nan], 'b': ['x', None],
+                       'c': pd.array([1, None], dtype='Int64'),
+                       'd': [pd.Timestamp('2024-01-02'), pd.NaT]})
+    records = backend.frame_records(df)
+    assert records[1] == {'a': None, 'b': None, 'c': None, 'd': None}
+    assert json.loads(backend.FastJSONResponse(content=records).body)[0] == {
+        'a': 1.0, 'b': 'x', 'c': 1, 'd': '2024-01-02T00:00:00'}
+
+
+def test_upload_preview_has_null_for_blank_cells(upload, small_workbook):
+    preview = upload(small_workbook).json()['preview']
+    trial = preview['Trial Balance']['sample']
+    assert trial[1]['Account'] is None
+    chart = preview['Chart of Accounts']['sample']
+    assert chart[3]['Account Number'] is None and chart[3]['Type'] is None
@@ -0,0 +1,152 @@
+import smtplib
+import socket
+import threading
+import time
+
+import pytest
+from bench_mail import StandInSMTPServer
+
+import backend
+
+
+@pytest.fixture
+def smtp_server():
+    """start(fail_every=0) runs a stand-in SMTP server and returns it."""
+    servers = []
+
+    def start(fail_every=0):
+        server = StandInSMTPServer(fail_every=fail_every)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def make_queue():
+    queues = []
+
+    def make_queue(port, **options):
+        options.setdefault('backoff_seconds', 0.01)
+        session = backend.SMTPSession('127.0.0.1', port, user='', starttls=False, timeout=5)
+        queue = backend.MailQueue(session, **options)
+        queues.append(queue)
+        return queue
+    yield make_queue
+    for queue in queues:
+        queue.close()
+
+
+def wait_for(queue, messages, timeout=10):
+    deadline = time.monotonic() + timeout
+    while any(queue.get(message.message_id).status in ('queued', 'sending', 'retrying')
+              for message in messages):
+        assert time.monotonic() < deadline, [message.summary() for message in messages]
+        time.sleep(0.005)
+
+
+def submit(queue, count):
+    return [queue.submit(f'client{i}@example.com', 'Report', 'Your report is ready.')
+            for i in range(count)]
+
+
+def test_messages_share_one_session(smtp_server, make_queue):
+    server = smtp_server()
+    queue = make_queue(server.server_address[1])
+    messages = submit(queue, 20)
+    wait_for(queue, messages)
+    assert {message.status for message in messages} == {'sent'}
+    assert [message.attempts for message in messages] == [1] * 20
+    assert server.sessions == 1 and server.accepted == 20
+
+
+def test_refused_recipients_are_retried(smtp_server, make_queue):
+    server = smtp_server(fail_every=3)
+    queue = make_queue(server.server_address[1])
+    messages = submit(queue, 12)
+    wait_for(queue, messages)
+    assert {message.status for message in messages} == {'sent'}
+    assert sum(message.attempts for message in messages) == server.recipients
+    assert server.recipients > 12 and server.accepted == 12
+    assert server.sessions == 1  # a refused RCPT leaves the session usable
+
+
+def test_unreachable_relay_fails_after_every_attempt(make_queue):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]  # closed again before the queue connects
+    queue = make_queue(port, attempts=3)
+    [message] = submit(queue, 1)
+    wait_for(queue, [message])
+    assert message.status == 'failed' and message.attempts == 3
+    assert message.error and message.finished is not None
+
+
+def test_idle_session_is_closed_and_reopened(smtp_server, make_queue):
+    server = smtp_server()
+    queue = make_queue(server.server_address[1], idle_seconds=0.05)
+    wait_for(queue, submit(queue, 2))
+    deadline = time.monotonic() + 5
+    while queue.session.connected():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    wait_for(queue, submit(queue, 2))
+    assert server.sessions == 2 and server.accepted == 4
+
+
+def test_mail_error():
+    refused = smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no such user')})
+    assert backend.mail_error(refused) == ('550 no such user', True)
+    busy = smtplib.SMTPResponseException(451, b'try again later')
+    assert backend.mail_error(busy) == ('451 try again later', False)
+    assert backend.mail_error(ConnectionRefusedError()) == ('ConnectionRefusedError', False)
+
+
+def test_send_email_endpoint(client, smtp_server, make_queue, monkeypatch):
+    server = smtp_server()
+    queue = make_queue(server.server_address[1])
+    monkeypatch.setattr(backend, 'mail_queue', queue)
+    response = client.post('/send-email', json={'recipient': 'cpa@example.com',
+                                                'subject': 'Report', 'body': 'Ready.'})
+    assert response.status_code == 202
+    queued = response.json()
+    assert queued['success'] is True and queued['recipient'] == 'cpa@example.com'
+    wait_for(queue, [queue.get(queued['message_id'])])
+    status = client.get(f"/send-email/{queued['message_id']}").json()
+    assert status['status'] == 'sent' and status['attempts'] == 1
+    assert server.accepted == 1
+
+
+def test_status_from_another_worker(client, smtp_server, make_queue, monkeypatch, tmp_path):
+    server = smtp_server(fail_every=2)
+    queue = make_queue(server.server_address[1], status_dir=str(tmp_path))
+    messages = submit(queue, 2)
+    wait_for(queue, messages)
+    # A worker that did not queue the messages reads the statuses they left
+    other = backend.MailQueue(backend.SMTPSession('127.0.0.1', 1), status_dir=str(tmp_path))
+    monkeypatch.setattr(backend, 'mail_queue', other)
+    for message in messages:
+        status = client.get(f'/send-email/{message.message_id}').json()
+        assert status == message.summary()
+        assert status['status'] == 'sent' and status['attempts'] == message.attempts
+    now = time.time()
+    monkeypatch.setattr(backend.time, 'time', lambda: now + backend.MAIL_TTL_SECONDS + 1)
+    assert client.get(f'/send-email/{messages[0].message_id}').status_code == 404
+    assert not (tmp_path / f'{messages[0].message_id}.json').exists()
+    other.close()
+
+
+def test_send_email_endpoint_rejects_bad_messages(client, monkeypatch):
+    queue = backend.MailQueue(backend.SMTPSession('127.0.0.1', 1))
+    monkeypatch.setattr(backend, 'mail_queue', queue)
+    assert client.post('/send-email', json={'recipient': 'cpa@example.com'}).json() == {
+        'success': False, 'error': 'Recipient and body required.'}
+    response = client.post('/send-email', json={'recipient': 'cpa@example.com', 'body': 'x',
+                                                'subject': 'Hi\nBcc: all@example.com'})
+    assert response.json()['success'] is False
+    assert client.get('/send-email/' + 'f' * 32).status_code == 404
+    assert client.get('/send-email/not-an-id').status_code == 404
+    queue.close()
@@ -0,0 +1,93 @@
+import os
+import pstats
+import uuid
+
+import pandas as pd
+
+import backend
+
+
+def sample(text, name):
+    """The value of the sample line that starts with name, 0 if there is none."""
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0
+
+
+def test_metrics_after_upload(client, upload, small_workbook):
+    upload(small_workbook)
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    text = response.text
+    assert '# TYPE ledgerlift_request_seconds histogram' in text
+    assert 'ledgerlift_stage_seconds_count{endpoint="upload",stage="validate"}' in text
+    assert 'ledgerlift_endpoint_requests_total{endpoint="upload"}' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = backend.MetricHistogram('h', 'Help.', ('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, 'parse "x"\n')
+    assert histogram.render() == [
+        '# HELP h Help.', '# TYPE h histogram',
+        'h_bucket{stage="parse \\"x\\"\\n",le="0.1"} 2',
+        'h_bucket{stage="parse \\"x\\"\\n",le="1"} 3',
+        'h_bucket{stage="parse \\"x\\"\\n",le="+Inf"} 4',
+        'h_sum{stage="parse \\"x\\"\\n"} 3.65',
+        'h_count{stage="parse \\"x\\"\\n"} 4']
+
+
+def test_request_metrics_sum_stages_and_record_once():
+    endpoint = 'test-' + uuid.uuid4().hex[:8]
+    timer = backend.RequestMetrics(endpoint)
+    timer.add('checks', 0.25, rows=10)
+    timer.add('checks', 0.5, rows=5)
+    with timer.stage('annotate') as span:
+        span.rows = 3
+    timer.bytes_in(100)
+    timer.finish()
+    timer.finish()
+    text = backend.metrics_text()
+    labels = f'{{endpoint="{endpoint}",stage="checks"}}'
+    assert sample(text, f'ledgerlift_stage_seconds_count{labels}') == 1
+    assert sample(text, f'ledgerlift_stage_seconds_sum{labels}') == 0.75
+    assert sample(text, f'ledgerlift_stage_rows_total{labels}') == 15
+    assert sample(text, f'ledgerlift_stage_rows_total{{endpoint="{endpoint}",'
+                        'stage="annotate"}') == 3
+    assert sample(text, f'ledgerlift_endpoint_requests_total{{endpoint="{endpoint}"}}') == 1
+    assert sample(text, f'ledgerlift_endpoint_bytes_total{{endpoint="{endpoint}",'
+                        'direction="in"}') == 100
+    assert f'endpoint="{endpoint}",direction="out"' not in text
+
+
+def test_streamed_download_counts_bytes_out(client):
+    workbook_id = uuid.uuid4().hex
+    df = pd.DataFrame({'Account': ['Cash'] * 100, 'Debit': range(100)})
+    backend.workbook_store.put(workbook_id, backend.Workbook({'Journal': df}))
+    name = 'ledgerlift_endpoint_bytes_total{endpoint="download_csv",direction="out"}'
+    before = sample(backend.metrics_text(), name)
+    response = client.get('/download-csv', params={'workbook_id': workbook_id, 'sheet': 'Journal'},
+                          headers={'Accept-Encoding': 'identity'})
+    assert sample(backend.metrics_text(), name) - before == len(response.content)
+
+
+def test_requests_are_counted_by_route(client):
+    name = ('ledgerlift_request_seconds_count'
+            '{method="GET",route="/send-email/{message_id}",status="404"}')
+    before = sample(backend.metrics_text(), name)
+    client.get('/send-email/' + 'a' * 32)
+    client.get('/send-email/' + 'b' * 32)
+    assert sample(backend.metrics_text(), name) - before == 2
+
+
+def test_slow_requests_are_profiled(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, 'PROFILE_SLOW_SECONDS', 1e-9)
+    monkeypatch.setattr(backend, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(backend, 'PROFILE_KEEP', 2)
+    for i in range(3):
+        client.get('/cache-stats', headers={'X-Request-ID': f'req-{i}'})
+    saved = sorted(os.listdir(tmp_path))
+    assert len(saved) == 2 and all('GET_cache_stats' in name for name in saved)
+    if saved[0].endswith('.prof'):  # cProfile, as pyinstrument is not installed
+        pstats.Stats(str(tmp_path / saved[0]))
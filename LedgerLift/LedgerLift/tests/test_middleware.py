@@ -0,0 +1,70 @@
+import gzip
+import logging
+import re
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import backend
+
+
+def test_request_id_and_security_headers(client):
+    response = client.get('/cache-stats', headers={'X-Request-ID': 'abc123'})
+    assert response.headers['x-request-id'] == 'abc123'
+    assert response.headers['x-content-type-options'] == 'nosniff'
+    assert "default-src 'self'" in response.headers['content-security-policy']
+    generated = client.get('/cache-stats').headers['x-request-id']
+    assert re.fullmatch('[0-9a-f]{32}', generated)
+
+
+def test_requests_are_logged_not_printed(client, caplog, capsys):
+    with caplog.at_level(logging.INFO, logger='request'):
+        client.get('/cache-stats')
+    assert 'Request: GET /cache-stats' in [record.getMessage() for record in caplog.records
+                                           if record.name == 'request']
+    assert 'Request:' not in capsys.readouterr().out
+
+
+def test_large_json_is_gzipped(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    raw = client.get('/errors', params={'workbook_id': workbook_id},
+                     headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in raw.headers
+    assert len(raw.content) >= backend.COMPRESS_MIN_BYTES
+    response = client.get('/errors', params={'workbook_id': workbook_id},
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['vary']
+    assert response.json() == raw.json()
+
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get('/cache-stats', headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in response.headers
+
+
+def test_streamed_csv_is_gzipped_and_zip_is_not(client):
+    rows = 5000
+    df = pd.DataFrame({'Account': 'Cash', 'Debit': np.arange(rows, dtype=float)})
+    workbook_id = uuid.uuid4().hex
+    backend.workbook_store.put(workbook_id, backend.Workbook({'Journal': df}))
+    with client.stream('GET', '/download-csv', params={'workbook_id': workbook_id,
+                                                       'sheet': 'Journal'},
+                       headers={'Accept-Encoding': 'gzip'}) as response:
+        assert response.headers['content-encoding'] == 'gzip'
+        body = b''.join(response.iter_raw())
+    assert gzip.decompress(body) == df.to_csv(index=False).encode()
+    response = client.get('/download-csv', params={'workbook_id': workbook_id},
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['content-type'] == 'application/zip'
+    assert 'content-encoding' not in response.headers
+
+
+def test_negotiate_encoder():
+    assert backend.negotiate_encoder(None) is None
+    assert backend.negotiate_encoder('gzip;q=0') is None
+    assert backend.negotiate_encoder('identity') is None
+    assert backend.negotiate_encoder('gzip, deflate') is backend.GzipEncoder
+    assert backend.negotiate_encoder('*') is backend.ENCODERS[0]
+    assert backend.negotiate_encoder('br;q=0, gzip;q=0.5') is backend.GzipEncoder
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+
+KEY_LINE_ISSUES = ('Net income from', 'Total Assets (')
+ROLLUP_RULES = ','.join(backend.DEFAULT_RULES + ('trial-journal',))
+
+
+def reference_key_values(sheets):
+    """The old /upload loop that found the key lines, one row at a time."""
+    values = {}
+    for name, df in sheets.items():
+        for _, row in df.iterrows():
+            account = str(row.get('Account', '')).strip().lower()
+            if 'income' in name.lower() and account in ('net income', 'net profit'):
+                key = 'net_income'
+            elif 'balance' in name.lower() and account == 'retained earnings':
+                key = 'retained_earnings'
+            elif 'balance' in name.lower() and account == 'total assets':
+                key = 'total_assets'
+            elif 'balance' in name.lower() and account == 'total liabilities and equity':
+                key = 'total_liab_equity'
+            else:
+                continue
+            try:
+                values[key] = float(row.get('Amount', 0))
+            except (TypeError, ValueError):
+                pass
+    return values
+
+
+def random_statements(seed):
+    rng = np.random.default_rng(seed)
+
+    def amounts(n):
+        return rng.choice(np.array([100, 250.5, 400, 'n/a', None], dtype=object), n).tolist()
+    income = pd.DataFrame({
+        'Account': rng.choice(['Revenue', 'Net Income', 'net profit ', 'Expenses'], 6),
+        'Amount': amounts(6)})
+    balance = pd.DataFrame({
+        'Account': rng.choice(['Retained Earnings', 'Total Assets', 'Cash',
+                               'Total Liabilities and Equity'], 8),
+        'Amount': amounts(8)})
+    return {'Income Statement': income, 'Balance Sheet': balance}
+
+
+def key_line_errors(body):
+    return [err['issue'] for err in body['errors'].get('Cross-Sheet', [])
+            if err['issue'].startswith(KEY_LINE_ISSUES)]
+
+
+@pytest.mark.parametrize('seed', range(15))
+def test_key_lines_match_row_loop(upload, seed):
+    body = upload(random_statements(seed)).json()
+    sheets = backend.workbook_store.get(body['workbook_id']).sheets
+    expected = backend.reconcile_key_lines(reference_key_values(sheets))
+    assert key_line_errors(body) == [err['issue'] for err in expected]
+
+
+def test_key_lines_found_across_csv_chunks(upload, monkeypatch):
+    monkeypatch.setattr(backend, 'read_csv_chunks',
+                        lambda path: pd.read_csv(path, chunksize=1))
+    balance = pd.DataFrame({'Account': ['Total Assets', 'Cash', 'Total Assets',
+                                        'Total Liabilities and Equity'],
+                            'Amount': [10, 5, 1000, 900]})
+    body = upload(balance, filename='balance_sheet.csv').json()
+    assert key_line_errors(body) == [
+        'Total Assets (1000.0) does not equal Total Liabilities and Equity (900.0) '
+        'on Balance Sheet.']
+
+
+def posted_workbook(**trial_overrides):
+    """A journal that posts one side per line, and the trial balance it adds up to."""
+    journal = pd.DataFrame({
+        'Date': ['2024-01-01'] * 4, 'Account Number': [1000, 4000, 5000, 1000],
+        'Account': ['Cash', 'Sales', 'Rent', 'Cash'], 'Type': ['asset', 'revenue', 'expense',
+                                                               'asset'],
+        'Debit': [300, 0, 120, 0], 'Credit': [0, 300, 0, 120]})
+    trial = pd.DataFrame({'Account Number': [1000, 4000, 5000],
+                          'Account': ['Cash', 'Sales', 'Rent'],
+                          'Debit': [180, 0, 120], 'Credit': [0, 300, 0]})
+    for column, values in trial_overrides.items():
+        trial[column] = values
+    return {'Journal Entries': journal, 'Trial Balance': trial}
+
+
+def test_rollups_that_agree(upload):
+    body = upload(posted_workbook(), rules=ROLLUP_RULES).json()
+    assert 'Cross-Sheet' not in body['errors']
+
+
+def test_rollup_mismatch_names_the_account(upload):
+    body = upload(posted_workbook(Debit=[200, 0, 120]), rules=ROLLUP_RULES).json()
+    assert [err['issue'] for err in body['errors']['Cross-Sheet']] == [
+        'Trial balance for 1000 (200.0) does not match its journal entries (180.0)']
+
+
+def test_rollups_resolve_names_through_the_chart(upload):
+    sheets = posted_workbook(**{'Account Number': [None, None, None]})
+    sheets['Chart of Accounts'] = pd.DataFrame({
+        'Account Number': [1000, 4000, 5000], 'Account Name': ['Cash', 'Sales', 'Rent'],
+        'Type': ['Asset', 'Revenue', 'Expense']})
+    body = upload(sheets, rules=ROLLUP_RULES).json()
+    assert 'Cross-Sheet' not in body['errors']
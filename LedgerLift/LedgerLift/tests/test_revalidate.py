@@ -0,0 +1,126 @@
+from collections import Counter
+
+import pandas as pd
+
+import backend
+
+
+def edit(client, workbook_id, sheet, row, column, value):
+    response = client.post('/edit-cell', json={'workbook_id': workbook_id, 'sheet': sheet,
+                                               'row': row, 'column': column, 'value': value})
+    assert response.json() == {'success': True}
+
+
+def test_revalidate_after_edit_cell(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    edit(client, workbook_id, 'Journal Entries', 2, 'Date', '2024-01-04')
+    response = client.post('/revalidate', json={'workbook_id': workbook_id})
+    assert response.status_code == 200
+    body = response.json()
+    assert body['rows_revalidated'] >= 1
+    removed = body['changes']['Journal Entries']['removed']
+    assert [err['row'] for err in removed] == [3]
+    assert removed[0]['issue'] == 'Invalid or missing Date'
+    # Nothing left pending
+    assert client.post('/revalidate', json={'workbook_id': workbook_id}).json()['changes'] == {}
+
+
+def test_revalidate_reports_new_errors(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    edit(client, workbook_id, 'Journal Entries', 0, 'Date', 'garbage')
+    changes = client.post('/revalidate', json={'workbook_id': workbook_id}).json()['changes']
+    added = changes['Journal Entries']['added']
+    assert [(err['row'], err['issue']) for err in added] == [(1, 'Invalid or missing Date')]
+    assert added[0]['why']
+    errors = client.get('/errors', params={'workbook_id': workbook_id,
+                                           'sheet': 'Journal Entries', 'row_max': 1}).json()
+    assert [err['issue'] for err in errors['errors']] == ['Invalid or missing Date']
+
+
+def test_revalidate_without_workbook(client):
+    response = client.post('/revalidate', json={'workbook_id': 'missing'})
+    assert response.status_code == 400
+
+
+RULES = ('double-entry,missing-values,duplicates,invalid-dates,account-codes,gaap-ifrs,'
+         'cross-sheet,formula-audit,trial-journal')
+
+
+def stored_errors(client, workbook_id):
+    found, cursor = Counter(), None
+    while True:
+        params = {'workbook_id': workbook_id, 'limit': 3, **({'cursor': cursor} if cursor else {})}
+        page = client.get('/errors', params=params).json()
+        found.update((err['sheet'], err['row'], err['issue']) for err in page['errors'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return found
+
+
+def full_validation(workbook):
+    """Every error of the workbook's current sheets, validated from scratch."""
+    plan, sheets = workbook.plan, workbook.sheets
+    accounts = backend.build_account_index(sheets)
+    found = Counter()
+    for name, df in sheets.items():
+        errors = backend.validate_sheet(name, df, plan, accounts)
+        if backend.audits_formulas(name, plan):
+            errors += backend.formula_audit_errors(df)
+        found.update((name, err['row'], err['issue']) for err in errors)
+    labels = {name: backend.key_line_labels(name, df) for name, df in sheets.items()}
+    cross = backend.reconcile_key_lines(backend.key_line_values(sheets, labels))
+    cross += backend.reconcile_rollups(*backend.sheet_rollups(sheets, accounts))
+    found.update(('Cross-Sheet', err['row'], err['issue']) for err in cross)
+    return found
+
+
+def test_incremental_revalidation_matches_full_validation(client, upload, small_workbook):
+    sheets = dict(small_workbook)
+    sheets['Journal Entries'] = pd.concat([sheets['Journal Entries']] * 2, ignore_index=True)
+    workbook_id = upload(sheets, rules=RULES).json()['workbook_id']
+    workbook = backend.get_workbook(workbook_id)
+    assert stored_errors(client, workbook_id) == full_validation(workbook)
+    steps = [
+        ('Chart of Accounts', 1, 'Account Name', 'Petty Cash'),  # no longer a duplicate
+        ('Chart of Accounts', 2, 'Account Number', 1000),  # a new duplicate number
+        ('Trial Balance', 2, 'Debit', 1),  # changes the trial totals and the AR rollup
+        ('Balance Sheet', 2, 'Amount', 1000),  # now reconciles with Total Assets
+        ('Income Statement', 1, 'Amount', 400),  # replaces a formula
+        ('Journal Entries', 2, 'Date', '2024-01-04'),
+        ('Journal Entries', 6, 'Debit', 75.0),
+    ]
+    for sheet, row, column, value in steps:
+        edit(client, workbook_id, sheet, row, column, value)
+        client.post('/revalidate', json={'workbook_id': workbook_id})
+        assert stored_errors(client, workbook_id) == full_validation(workbook), (sheet, column)
+    for fixes in ('remove-duplicates', 'fill-missing', 'auto-balance'):
+        client.post('/bulk-fix', data={'fixes': fixes, 'workbook_id': workbook_id})
+        client.post('/revalidate', json={'workbook_id': workbook_id})
+        assert stored_errors(client, workbook_id) == full_validation(workbook), fixes
+
+
+def test_revalidate_after_bulk_fix_reports_removed_rows(client, upload, small_workbook):
+    sheets = dict(small_workbook)
+    sheets['Journal Entries'] = pd.concat([sheets['Journal Entries']] * 2, ignore_index=True)
+    workbook_id = upload(sheets).json()['workbook_id']
+    client.post('/bulk-fix', data={'fixes': 'remove-duplicates', 'sheet': 'Journal Entries',
+                                   'workbook_id': workbook_id})
+    changes = client.post('/revalidate', json={'workbook_id': workbook_id}).json()['changes']
+    removed_rows = {err['row'] for err in changes['Journal Entries']['removed']}
+    assert removed_rows == {7, 8}  # the errors of the dropped copies of rows 2 and 3
+    assert not changes['Journal Entries']['added']
+
+
+def test_trial_edit_rolls_up_only_the_trial_sheet(client, upload, small_workbook, monkeypatch):
+    workbook_id = upload(small_workbook, rules=RULES).json()['workbook_id']
+    edit(client, workbook_id, 'Trial Balance', 2, 'Debit', 1)
+    client.post('/revalidate', json={'workbook_id': workbook_id})
+    rolled = []
+    add = backend.AccountRollup.add
+    monkeypatch.setattr(backend.AccountRollup, 'add',
+                        lambda self, df, accounts=None: rolled.append(len(df)) or
+                        add(self, df, accounts))
+    edit(client, workbook_id, 'Trial Balance', 2, 'Debit', 2000)
+    client.post('/revalidate', json={'workbook_id': workbook_id})
+    assert rolled == [len(small_workbook['Trial Balance'])]
+    assert stored_errors(client, workbook_id) == full_validation(backend.get_workbook(workbook_id))
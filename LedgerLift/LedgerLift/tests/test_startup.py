@@ -0,0 +1,35 @@
+import logging
+import os
+import subprocess
+import sys
+
+from fastapi.testclient import TestClient
+
+import backend
+
+LAZY_MODULES = ['sklearn', 'openpyxl', 'smtplib', 'pyarrow.parquet']
+
+
+def test_import_leaves_heavy_modules_unloaded():
+    code = ('import json, sys; import backend; '
+            f'print(json.dumps([name for name in {LAZY_MODULES!r} if name in sys.modules]))')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(backend.__file__), env=os.environ, check=True)
+    assert result.stdout.strip().splitlines()[-1] == '[]'
+
+
+def test_lifespan_prewarms_the_validation_pool(monkeypatch, caplog):
+    monkeypatch.setattr(backend, 'PREWARM', True)
+    with caplog.at_level(logging.INFO, logger='startup'):
+        with TestClient(backend.app) as client:
+            assert client.get('/metrics').status_code == 200
+            for _ in range(200):
+                if any('Validation pool warm' in record.message for record in caplog.records):
+                    break
+                backend.time.sleep(0.01)
+    assert any('Validation pool warm' in record.message for record in caplog.records)
+    assert 'openpyxl' in sys.modules
+
+
+def test_isolation_forest_is_imported_once():
+    assert backend.isolation_forest_class() is backend.isolation_forest_class()
@@ -0,0 +1,118 @@
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+
+
+def test_chunked_trial_totals_match_whole_sheet():
+    rng = np.random.default_rng(3)
+    df = pd.DataFrame({'Account Number': np.arange(500), 'Account': 'Cash',
+                       'Debit': rng.integers(0, 10 ** 7, 500) / 100,
+                       'Credit': rng.integers(0, 10 ** 7, 500) / 100})
+    validator = backend.SheetValidator('Trial Balance')
+    for start in range(0, len(df), 7):
+        validator.feed(df.iloc[start:start + 7])
+    assert validator.errors() == backend.validate_trial_sheet(df)
+    assert validator.error_count() == 1
+
+
+def journal_csv():
+    return pd.DataFrame({
+        'Date': ['2024-01-01', '2024-01-02', '2024-01-01', '2024-01-02', 'bad', '2024-01-06'],
+        'Account Number': [1000, 1000, 1000, 1000, 1000, 1000],
+        'Account': ['Cash'] * 6,
+        'Debit': [10, 20, 10, 20, 5, 7],
+        'Credit': [10, 20, 10, 20, 5, 0],
+    })
+
+
+# Chunks of two rows put a chunk boundary between each duplicate and the row it repeats,
+# and split the trial balance's totals and suspicious rows across chunks
+CHUNKED_SHEETS = {
+    'journal.csv': journal_csv(),
+    'chart_of_accounts.csv': pd.DataFrame({
+        'Account Number': [1000, 2000, 1000, 3000, 2000],
+        'Account Name': ['Cash', 'AP', 'Cash', None, 'AP'],
+        'Type': ['Asset', 'Liability', 'Asset', 'Equity', 'Liability']}),
+    'trial_balance.csv': pd.DataFrame({
+        'Account': ['Cash', 'AP', None, 'AR', 'Sales'],
+        'Debit': [100.1, 0, 5000, 0.2, 0],
+        'Credit': [0, 50, 0, 0, 4000.3]}),
+}
+
+
+def issues(body):
+    return [(name, err['row'], err['issue']) for name, errs in body['errors'].items()
+            for err in errs]
+
+
+@pytest.mark.parametrize('filename', CHUNKED_SHEETS)
+def test_csv_read_in_chunks_matches_one_chunk(upload, monkeypatch, filename):
+    df = CHUNKED_SHEETS[filename]
+    whole = upload(df, filename=filename).json()
+    assert issues(whole)
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    monkeypatch.setattr(backend, 'read_csv_chunks',
+                        functools.partial(backend.read_csv_chunks, chunk_rows=2))
+    chunked = upload(df, filename=filename).json()
+    assert issues(chunked) == issues(whole)
+    assert chunked['preview'] == whole['preview']
+
+
+def test_large_csv_is_read_back_from_the_spool_file(client, upload, monkeypatch):
+    kept = upload(journal_csv(), filename='journal.csv').json()
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    monkeypatch.setattr(backend, 'UPLOAD_KEEP_BYTES', 0)
+    body = upload(journal_csv(), filename='journal.csv').json()
+    assert issues(body) == issues(kept)
+    workbook = backend.workbook_store.get(body['workbook_id'])
+    assert not workbook.sheets_loaded()
+    assert os.path.exists(workbook.source_path)
+    response = client.get('/download-csv', params={'workbook_id': body['workbook_id'],
+                                                   'sheet': 'journal'})
+    assert response.text == backend.workbook_store.get(kept['workbook_id']).sheets[
+        'journal'].to_csv(index=False)
+
+
+def test_large_workbook_is_read_back_from_the_spool_file(client, upload, monkeypatch,
+                                                         small_workbook):
+    small_workbook['Journal Entries'].loc[4, 'Account Number'] = 9999
+    kept = upload(small_workbook).json()
+    assert kept['notices'] == []
+    assert ('Journal Entries', 5, 'Account 9999 not found in Chart of Accounts') in issues(kept)
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    monkeypatch.setattr(backend, 'UPLOAD_KEEP_BYTES', 0)
+    body = upload(small_workbook).json()
+    # The chart is still there for the account checks of the other sheets
+    assert issues(body) == issues(kept)
+    assert body['notices'] == ['Anomaly detection was skipped: files over 0MB are not kept '
+                               'in memory.']
+    workbook = backend.workbook_store.get(body['workbook_id'])
+    assert not workbook.sheets_loaded()
+    for name, df in backend.workbook_store.get(kept['workbook_id']).sheets.items():
+        pd.testing.assert_frame_equal(workbook.sheets[name], df)
+
+
+def test_upload_over_the_size_limit_is_rejected(upload, monkeypatch):
+    monkeypatch.setattr(backend, 'spool_upload',
+                        functools.partial(backend.spool_upload, max_bytes=100))
+    before = set(os.listdir(backend.UPLOAD_SPOOL_DIR))
+    body = upload(journal_csv(), filename='journal.csv').json()
+    assert body['error'].startswith('File too large')
+    assert 'workbook_id' not in body
+    assert set(os.listdir(backend.UPLOAD_SPOOL_DIR)) == before
+
+
+def test_spooled_upload_hashes_the_whole_body(upload):
+    data = journal_csv().to_csv(index=False).encode()
+    body = upload(data, filename='journal.csv').json()
+    assert backend.parse_cache.get((backend.hashlib.sha256(data).hexdigest(), '.csv', ())) \
+        is not None
+    assert body['sheets'] == ['journal']
@@ -0,0 +1,41 @@
+import pandas as pd
+
+
+def test_upload_returns_errors_per_sheet(upload, small_workbook):
+    body = upload(small_workbook).json()
+    assert body['sheets'] == list(small_workbook)
+    assert set(body['preview']) == set(small_workbook)
+    journal = body['errors']['Journal Entries']
+    assert [(err['row'], err['issue']) for err in journal] == [
+        (2, 'Debit (50.0) ≠ Credit (0.0)'), (2, 'Revenue account has debit value (GAAP)'),
+        (3, 'Invalid or missing Date')]
+    assert all(err['why'] for err in journal)
+    assert 'Missing Account' in [err['issue'] for err in body['errors']['Trial Balance']]
+
+
+def test_upload_errors_summary(upload, monkeypatch, small_workbook):
+    monkeypatch.setattr('backend.UPLOAD_SUMMARY_ERRORS', 1)
+    full = upload(small_workbook).json()
+    summary = upload(small_workbook, errors='summary')
+    assert summary.status_code == 200
+    body = summary.json()
+    assert all(len(errs) <= 1 for errs in body['errors'].values())
+    assert body['errors_truncated'] is True
+    counts = body['error_counts']
+    assert sum(sum(by_type.values()) for by_type in counts.values()) == \
+        sum(len(errs) for errs in full['errors'].values())
+    assert set(counts) == {name for name, errs in full['errors'].items() if errs}
+
+
+def test_upload_rejects_unknown_file_type(client):
+    response = client.post('/upload', files={'file': ('notes.txt', b'hello')})
+    assert 'Invalid file type' in response.json()['error']
+
+
+def test_upload_csv(upload):
+    df = pd.DataFrame({'Date': ['2024-01-01', 'bad'], 'Account Number': [1000, 1000],
+                       'Account': ['Cash', 'Cash'], 'Debit': [10, 5], 'Credit': [10, 5]})
+    body = upload(df, filename='journal.csv').json()
+    assert body['sheets'] == ['journal']
+    errors = body['errors']['journal']
+    assert [(err['row'], err['issue']) for err in errors] == [(2, 'Invalid or missing Date')]
@@ -0,0 +1,276 @@
+"""The vectorized engine against the row-by-row loops /upload ran before it.
+
+reference_sheet_errors(), reference_formula_audit() and reference_cross_sheet() are the
+old df.iterrows() branches of upload_file, kept as they were except for Debit/Credit
+parsing: the old journal loop compared cells with `in [None, '', pd.NA]`, which raises
+TypeError for any non-blank value, so reference_amount() implements the intended
+blank-as-zero reading the engine uses. Rows are read with rows() rather than iterrows():
+under pandas 3 iterrows() gives an all-text row a str dtype and turns its None cells into
+NaN, which the old loops (written against pandas 2) never saw.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend
+import synthetic_workbook
+
+KNOWN_HEADERS = ['assets', 'liabilities', 'equity', 'revenue', 'expenses', 'contra revenue',
+                 'contra asset', 'total', 'net income', 'gross profit', 'operating income']
+
+
+def rows(df):
+    """(label, {column: cell}) per row, with the cells exactly as stored."""
+    columns = list(df.columns)
+    for idx, values in zip(df.index, df.itertuples(index=False, name=None)):
+        yield idx, dict(zip(columns, values))
+
+
+def is_header_row(row):
+    acc_name = str(row.get('Account', '')).strip().lower()
+    acc_num = str(row.get('Account Number', '')).strip()
+    return (acc_name in KNOWN_HEADERS or acc_name.startswith('total')
+            or acc_num in ['', 'nan', 'none'])
+
+
+def reference_amount(value):
+    if value is None or value is pd.NA or (isinstance(value, str) and value == ''):
+        return 0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def reference_sheet_errors(name, df):
+    errors = []
+    if 'chart' in name.lower():
+        for col, issue in (('Account Number', 'Missing Account Number'),
+                           ('Account Name', 'Missing Account Name'),
+                           ('Type', 'Missing Account Type')):
+            if col in df.columns:
+                for idx in df[df[col].isnull()].index:
+                    errors.append({"row": idx + 1, "issue": issue})
+        for idx in df[df.duplicated()].index:
+            errors.append({"row": idx + 1, "issue": "Duplicate row"})
+    elif 'journal' in name.lower():
+        for idx, row in rows(df):
+            if is_header_row(row):
+                continue
+            if 'Date' in df.columns:
+                try:
+                    pd.to_datetime(row['Date'])
+                except Exception:
+                    errors.append({"row": idx + 1, "issue": "Invalid or missing Date"})
+            debit = reference_amount(row['Debit']) if 'Debit' in df.columns else 0
+            credit = reference_amount(row['Credit']) if 'Credit' in df.columns else 0
+            if abs(debit - credit) > 0.01:
+                errors.append({"row": idx + 1, "issue": f"Debit ({debit}) ≠ Credit ({credit})"})
+            if 'Account' in df.columns and (row['Account'] is None
+                                            or str(row['Account']).strip() == ''):
+                errors.append({"row": idx + 1, "issue": "Missing Account"})
+            acc_type = str(row.get('Type', '')).lower() if 'Type' in row else ''
+            acc_name = str(row.get('Account', '')).lower()
+            if acc_name == 'depreciation expense' and debit < 0:
+                errors.append({"row": idx + 1,
+                               "issue": "Depreciation expense should not be negative (GAAP)"})
+            if acc_type == 'revenue' and debit > 0:
+                errors.append({"row": idx + 1, "issue": "Revenue account has debit value (GAAP)"})
+            if acc_type == 'equity' and debit > 0:
+                errors.append({"row": idx + 1,
+                               "issue": "Equity account should not have debit balance (GAAP)"})
+            if acc_name == 'prepaid expenses' and 'income' in name.lower():
+                errors.append({"row": idx + 1,
+                               "issue": "Prepaid expenses should not appear in P&L (GAAP)"})
+    elif 'trial' in name.lower():
+        if 'Debit' in df.columns and 'Credit' in df.columns:
+            total_debit = pd.to_numeric(df['Debit'], errors='coerce').sum()
+            total_credit = pd.to_numeric(df['Credit'], errors='coerce').sum()
+            diff = total_debit - total_credit
+            if abs(diff) > 1e-2:
+                suspicious = []
+                for idx, row in rows(df):
+                    if (pd.isnull(row['Debit']) or pd.isnull(row['Credit'])
+                            or abs(reference_amount(row['Debit'])
+                                   - reference_amount(row['Credit'])) > 1000):
+                        suspicious.append(idx + 1)
+                suggestion = (f"Consider checking rows: {', '.join(map(str, suspicious[:3]))}"
+                              if suspicious else "Review all entries.")
+                errors.append({"row": None, "issue": (
+                    f"Trial balance out of balance: Debits={total_debit}, "
+                    f"Credits={total_credit}. Difference={diff}. {suggestion}")})
+        if 'Account' in df.columns:
+            for idx in df[df['Account'].isnull()].index:
+                errors.append({"row": idx + 1, "issue": "Missing Account"})
+    elif 'income' in name.lower() or 'balance' in name.lower():
+        for idx, row in rows(df):
+            if is_header_row(row):
+                continue
+            for col in df.columns:
+                if pd.isnull(row[col]):
+                    errors.append({"row": idx + 1, "issue": f"Missing value in {col}"})
+                if isinstance(row[col], str) and row[col].startswith('='):
+                    errors.append({"row": idx + 1, "issue": (
+                        f"Excel formula present in {col}: {row[col]} "
+                        "(Check for circular refs or hardcoded totals)")})
+    return errors
+
+
+def reference_formula_audit(name, df):
+    errors = []
+    if 'income' not in name.lower() and 'balance' not in name.lower():
+        return errors
+    for idx, row in rows(df):
+        for col in df.columns:
+            val = row[col]
+            if isinstance(val, str) and val.startswith('='):
+                if val[1:].replace('.', '', 1).isdigit():
+                    errors.append({"row": idx + 1,
+                                   "issue": f"Formula in {col} is hardcoded value: {val}"})
+                if '""' in val or 'BLANK' in val.upper():
+                    errors.append({"row": idx + 1,
+                                   "issue": f"Formula in {col} references empty cell: {val}"})
+                if f'{col[0]}{idx + 2}' in val:
+                    errors.append({"row": idx + 1,
+                                   "issue": f"Possible circular reference in {col}: {val}"})
+    return errors
+
+
+def reference_cross_sheet(sheets):
+    values = {}
+    for name, df in sheets.items():
+        keys = []
+        if 'income' in name.lower():
+            keys.append(('net_income', ['net income', 'net profit']))
+        if 'balance' in name.lower():
+            keys += [('retained_earnings', ['retained earnings']),
+                     ('total_assets', ['total assets']),
+                     ('total_liab_equity', ['total liabilities and equity'])]
+        for _, row in rows(df):
+            acc = str(row.get('Account', '')).strip().lower()
+            for key, accounts in keys:
+                if acc in accounts:
+                    try:
+                        values[key] = float(row.get('Amount', 0))
+                    except (TypeError, ValueError):
+                        pass
+    errors = []
+    if 'net_income' in values and 'retained_earnings' in values:
+        if abs(values['net_income'] - values['retained_earnings']) > 1e-2:
+            errors.append({"row": None, "issue": (
+                f"Net income from Income Statement ({values['net_income']}) does not match "
+                f"change in Retained Earnings on Balance Sheet ({values['retained_earnings']}).")})
+    if 'total_assets' in values and 'total_liab_equity' in values:
+        if abs(values['total_assets'] - values['total_liab_equity']) > 1e-2:
+            errors.append({"row": None, "issue": (
+                f"Total Assets ({values['total_assets']}) does not equal Total Liabilities "
+                f"and Equity ({values['total_liab_equity']}) on Balance Sheet.")})
+    return errors
+
+
+def engine_sheet_errors(name, df):
+    errors = backend.validate_sheet(name, df)
+    if backend.audits_formulas(name, backend.AUDIT_PLAN):
+        errors = errors + backend.formula_audit_errors(df)
+    return errors
+
+
+def engine_cross_sheet(sheets):
+    labels = {name: backend.key_line_labels(name, df) for name, df in sheets.items()}
+    return backend.reconcile_key_lines(backend.key_line_values(sheets, labels))
+
+
+def chunked_errors(name, df, rows):
+    validator = backend.SheetValidator(name)
+    for start in range(0, len(df), rows):
+        validator.feed(df.iloc[start:start + rows])
+    return validator.errors()
+
+
+def as_uploaded(sheets):
+    """The frames as the old upload path held them: inf and NaN replaced with None."""
+    return {name: df.replace([np.inf, -np.inf], pd.NA).pipe(lambda d: d.where(pd.notnull(d), None))
+            for name, df in sheets.items()}
+
+
+POOLS = {
+    'Date': ['2024-01-31', '01/15/2024', 'notadate', '', None, np.nan, 20240101,
+             pd.Timestamp('2024-03-01'), '2024-02-30', 'March 3, 2024'],
+    'Account Number': [1000, 4000, 3100, 6300, None, '', 'nan', '1300', np.nan],
+    'Account': ['Cash', 'Service Revenue', 'Depreciation Expense', 'Prepaid Expenses',
+                'Retained Earnings', 'Total Assets', 'Net Income', 'Revenue', '', '  ', None,
+                np.nan, 'Total liabilities and equity', 'Owner Equity'],
+    'Account Name': ['Cash', 'Sales', None, 'Cash'],
+    'Type': ['asset', 'Revenue', 'equity', 'EXPENSE', None, '', 'Asset'],
+    'Debit': [100.0, 250, -40.0, 0, None, '', '12.5', 'abc', np.nan, 5000, 100.004],
+    'Credit': [100.0, 250, 0, None, '', '99', 'xyz', np.nan, 3000, 100.0],
+    'Amount': [500, 500.0, -20, None, np.nan, 'n/a', '=B2', '=B3', '=100', '=12.50', '=""',
+               '=BLANK()', '=SUM(B1:B4)', 1000],
+}
+COLUMNS = {
+    'Chart of Accounts': ['Account Number', 'Account Name', 'Type'],
+    'Journal Entries': ['Date', 'Account Number', 'Account', 'Type', 'Debit', 'Credit'],
+    'Trial Balance': ['Account Number', 'Account', 'Debit', 'Credit'],
+    'Income Statement': ['Account Number', 'Account', 'Amount'],
+    'Balance Sheet': ['Account Number', 'Account', 'Amount'],
+}
+
+
+def random_workbook(seed, rows=40):
+    rng = np.random.default_rng(seed)
+    sheets = {}
+    for name, columns in COLUMNS.items():
+        data = {}
+        for col in columns:
+            pool = POOLS[col]
+            data[col] = pd.Series([pool[i] for i in rng.integers(len(pool), size=rows)],
+                                  dtype=object)
+        sheets[name] = pd.DataFrame(data)
+    return sheets
+
+
+def assert_parity(sheets):
+    for name, df in sheets.items():
+        expected = reference_sheet_errors(name, df) + reference_formula_audit(name, df)
+        assert engine_sheet_errors(name, df) == expected, name
+        assert chunked_errors(name, df, 7) == expected, name
+    assert engine_cross_sheet(sheets) == reference_cross_sheet(sheets)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_parity_on_generated_workbooks(seed):
+    sheets = synthetic_workbook.workbook(300, seed=seed, error_rate=0.05)
+    assert_parity(sheets)
+    assert_parity(as_uploaded(sheets))
+
+
+def test_parity_on_clean_generated_workbook():
+    assert_parity(synthetic_workbook.workbook(200, seed=7, error_rate=0))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_parity_on_randomized_frames(seed):
+    assert_parity(random_workbook(seed))
+
+
+def test_parity_on_numeric_frames():
+    sheets = random_workbook(99)
+    journal = sheets['Journal Entries']
+    numeric = journal.assign(**{col: pd.to_numeric(journal[col], errors='coerce')
+                                for col in ('Account Number', 'Debit', 'Credit')})
+    assert_parity({'Journal Entries': numeric, 'Trial Balance': numeric[['Account Number', 'Debit',
+                                                                         'Credit']]})
+
+
+def test_upload_matches_reference(upload, tmp_path):
+    # Without a chart sheet the journal's GAAP checks read its own Type column, as they used to
+    path = str(tmp_path / 'generated.xlsx')
+    synthetic_workbook.write_workbook(path, 500, seed=11, error_rate=0.05)
+    frames = pd.read_excel(path, sheet_name=None)
+    del frames['Chart of Accounts']
+    rules = 'double-entry,missing-values,duplicates,invalid-dates,gaap-ifrs,formula-audit'
+    response = upload(frames, rules=rules).json()
+    for name, df in as_uploaded(frames).items():
+        expected = reference_sheet_errors(name, df) + reference_formula_audit(name, df)
+        got = [{"row": err['row'], "issue": err['issue']} for err in response['errors'][name]]
+        assert got == expected, name
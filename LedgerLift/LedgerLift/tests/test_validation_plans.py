@@ -0,0 +1,76 @@
+import pandas as pd
+import pytest
+
+import backend
+import synthetic_workbook
+
+ROLLUP_ISSUE = 'does not match its journal entries'
+
+
+@pytest.fixture
+def clean_workbook(tmp_path):
+    path = str(tmp_path / 'clean.xlsx')
+    synthetic_workbook.write_workbook(path, 200, seed=4, error_rate=0)
+    return pd.read_excel(path, sheet_name=None)
+
+
+def test_default_plan_skips_opt_in_rules():
+    assert not backend.AUDIT_PLAN.enabled('trial_journal_mismatch')
+    assert backend.AUDIT_PLAN.enabled('net_income_mismatch', 'balance_sheet_mismatch')
+    plan = backend.validation_plan('audit', backend.parse_rules('cross-sheet,trial-journal'))
+    assert plan.enabled('trial_journal_mismatch')
+
+
+def test_clean_generated_workbook_has_no_rollup_errors(upload, clean_workbook):
+    errors = upload(clean_workbook).json()['errors']
+    assert not [err for errs in errors.values() for err in errs if ROLLUP_ISSUE in err['issue']]
+    assert 'Cross-Sheet' not in errors
+
+
+def test_trial_journal_rule_reconciles_rollups(upload, clean_workbook):
+    rules = ','.join(backend.DEFAULT_RULES + ('trial-journal',))
+    errors = upload(clean_workbook, rules=rules).json()['errors']
+    mismatches = [err for err in errors['Cross-Sheet'] if ROLLUP_ISSUE in err['issue']]
+    # The generated journal nets every account to zero
+    nonzero = clean_workbook['Trial Balance'].eval('Debit - Credit').abs() > 0.01
+    assert len(mismatches) == int(nonzero.sum())
+
+
+def test_assist_mode_and_rule_selection(upload, small_workbook):
+    errors = upload(small_workbook, mode='assist').json()['errors']
+    issues = {err['issue'] for errs in errors.values() for err in errs}
+    assert 'Missing Account' in issues
+    assert 'Invalid or missing Date' not in issues
+    errors = upload(small_workbook, rules='invalid-dates').json()['errors']
+    issues = {err['issue'] for errs in errors.values() for err in errs}
+    assert issues == {'Invalid or missing Date'}
+
+
+def test_unknown_mode_or_rule(upload, small_workbook):
+    response = upload(small_workbook, mode='strict')
+    assert response.status_code == 400 and 'Unknown mode' in response.json()['error']
+    response = upload(small_workbook, rules='double-entry,bogus')
+    assert response.status_code == 400 and 'bogus' in response.json()['error']
+
+
+def issue_type(err):
+    return backend.ISSUE_TYPES[backend.classify_issue(err['issue'])[0]][0]
+
+
+@pytest.mark.parametrize('rule', list(backend.RULES))
+def test_one_rule_reports_its_share_of_every_rule(upload, small_workbook, rule):
+    everything = upload(small_workbook, rules=','.join(backend.RULES)).json()['errors']
+    expected = [(name, err['row'], err['issue']) for name, errs in everything.items()
+                for err in errs if issue_type(err) in backend.RULES[rule]]
+    errors = upload(small_workbook, rules=rule).json()['errors']
+    assert [(name, err['row'], err['issue']) for name, errs in errors.items()
+            for err in errs] == expected
+
+
+def test_plans_are_compiled_once_per_rule_set(upload, small_workbook):
+    assert backend.parse_rules(' gaap-ifrs,duplicates,,duplicates') == \
+        ('duplicates', 'gaap-ifrs')
+    assert backend.validation_plan('audit', backend.parse_rules('duplicates,gaap-ifrs')) is \
+        backend.validation_plan('audit', backend.parse_rules('gaap-ifrs, duplicates'))
+    errors = upload(small_workbook, rules='').json()['errors']
+    assert not any(errors.values())
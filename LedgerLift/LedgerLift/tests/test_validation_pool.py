@@ -0,0 +1,78 @@
+import os
+
+import pandas as pd
+
+import backend
+from conftest import workbook_bytes
+
+
+def issues(body):
+    return [(name, err['row'], err['issue']) for name, errs in body['errors'].items()
+            for err in errs]
+
+
+def test_process_pool_matches_thread_pool(upload, monkeypatch, small_workbook):
+    data = workbook_bytes(small_workbook)
+    on_threads = upload(data).json()
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    # A real process pool pickles everything sent to a worker
+    monkeypatch.setattr(backend, 'VALIDATION_POOL_KIND', 'process')
+    monkeypatch.setattr(backend, '_validation_pool', None)
+    try:
+        on_processes = upload(data).json()
+        assert isinstance(backend._validation_pool,
+                          backend.concurrent.futures.ProcessPoolExecutor)
+    finally:
+        if backend._validation_pool is not None:
+            backend._validation_pool.shutdown()
+    assert issues(on_processes) == issues(on_threads)
+    assert on_processes['preview'] == on_threads['preview']
+
+
+def test_process_pool_workers_save_frames_and_score_sheets(upload, monkeypatch, small_workbook):
+    sheets = dict(small_workbook)
+    sheets['Journal Entries'] = pd.concat([sheets['Journal Entries']] * 4, ignore_index=True)
+    sheets['Journal Entries'].loc[12, ['Debit', 'Credit']] = 250000.0
+    data = workbook_bytes(sheets)
+    on_threads = upload(data).json()
+    on_threads_again = upload(data, mode='assist').json()
+    assert backend.ANOMALY_ISSUE in [issue for _, _, issue in issues(on_threads)]
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    monkeypatch.setattr(backend, 'VALIDATION_POOL_KIND', 'process')
+    monkeypatch.setattr(backend, '_validation_pool', None)
+    try:
+        on_processes = upload(data).json()
+        key = (backend.hashlib.sha256(data).hexdigest(), '.xlsx', ())
+        _, frame_dirs = backend.parse_cache.get(key)
+        assert sorted(frame_dirs) == sorted(sheets)
+        assert all(os.path.isdir(path) for path in frame_dirs.values())
+        # A parse cache hit hands the workers those files instead of the frames
+        jobs = []
+        in_pool = backend.in_validation_pool
+        monkeypatch.setattr(backend, 'in_validation_pool',
+                            lambda fn, *args: jobs.append(fn) or in_pool(fn, *args))
+        on_processes_again = upload(data, mode='assist').json()
+        assert set(jobs) == {backend.validate_saved_frame}
+    finally:
+        if backend._validation_pool is not None:
+            backend._validation_pool.shutdown()
+    assert issues(on_processes) == issues(on_threads)
+    assert issues(on_processes_again) == issues(on_threads_again)
+    workbook = backend.get_workbook(on_processes['workbook_id'])
+    for name, df in sheets.items():
+        assert workbook.sheets[name].shape == df.shape
+
+
+def test_upload_rejected_when_queue_is_full(upload, monkeypatch, small_workbook):
+    gate = backend.HeavyJobGate(max_running=1, max_queued=0)
+    monkeypatch.setattr(backend, 'heavy_jobs', gate)
+    assert gate.try_admit()
+    response = upload(small_workbook)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(backend.RETRY_AFTER_SECONDS)
+    gate.release()
+    response = upload(small_workbook)
+    assert response.status_code == 200
+    assert gate.admitted == 0
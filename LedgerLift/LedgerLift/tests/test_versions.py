@@ -0,0 +1,112 @@
+import pandas as pd
+
+import backend
+
+
+def edit(client, workbook_id, sheet, row, column, value):
+    response = client.post('/edit-cell', json={'workbook_id': workbook_id, 'sheet': sheet,
+                                               'row': row, 'column': column, 'value': value})
+    assert response.json() == {'success': True}
+
+
+def snapshot(workbook_id):
+    return {name: df.copy() for name, df in backend.workbook_store.get(workbook_id).sheets.items()}
+
+
+def assert_sheets_equal(workbook_id, expected):
+    sheets = backend.workbook_store.get(workbook_id).sheets
+    assert list(sheets) == list(expected)
+    for name, df in expected.items():
+        pd.testing.assert_frame_equal(sheets[name], df)
+
+
+def issues(client, workbook_id):
+    page = client.get('/errors', params={'workbook_id': workbook_id, 'limit': 1000}).json()
+    return sorted((err['sheet'], err['row'] or 0, err['issue']) for err in page['errors'])
+
+
+def test_every_version_can_be_reached(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    versions = [snapshot(workbook_id)]
+    edit(client, workbook_id, 'Journal Entries', 1, 'Credit', 50)
+    versions.append(snapshot(workbook_id))
+    edit(client, workbook_id, 'Trial Balance', 0, 'Debit', 100.5)  # int column -> float
+    versions.append(snapshot(workbook_id))
+    edit(client, workbook_id, 'Chart of Accounts', 3, 'Type', 'Asset')
+    versions.append(snapshot(workbook_id))
+    client.post('/bulk-fix', data={'fixes': 'remove-duplicates,fill-missing',
+                                   'workbook_id': workbook_id})
+    versions.append(snapshot(workbook_id))
+
+    history = client.get('/versions', params={'workbook_id': workbook_id}).json()
+    assert [entry['action'] for entry in history['versions']] == \
+        ['edit_cell'] * 3 + ['bulk_fix']
+    assert history['versions'][-1]['rows_removed'] == 1
+    assert (history['version'], history['can_undo'], history['can_redo']) == (4, True, False)
+
+    for version in [0, 4, 2, 1, 3, 0, 4]:
+        response = client.post('/goto-version', json={'workbook_id': workbook_id,
+                                                      'version': version})
+        assert response.json()['version'] == version
+        assert_sheets_equal(workbook_id, versions[version])
+    for version in [3, 2, 1, 0]:
+        assert client.post('/undo', json={'workbook_id': workbook_id}).json()['version'] == version
+        assert_sheets_equal(workbook_id, versions[version])
+    assert client.post('/redo', json={'workbook_id': workbook_id}).json()['version'] == 1
+    assert_sheets_equal(workbook_id, versions[1])
+
+
+def test_undo_then_revalidate_restores_errors(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    client.post('/revalidate', json={'workbook_id': workbook_id})
+    before = issues(client, workbook_id)
+    edit(client, workbook_id, 'Journal Entries', 2, 'Date', '2024-01-04')
+    client.post('/bulk-fix', data={'fixes': 'remove-duplicates', 'workbook_id': workbook_id})
+    client.post('/revalidate', json={'workbook_id': workbook_id})
+    assert issues(client, workbook_id) != before
+    client.post('/goto-version', json={'workbook_id': workbook_id, 'version': 0})
+    client.post('/revalidate', json={'workbook_id': workbook_id})
+    assert issues(client, workbook_id) == before
+
+
+def test_new_change_discards_redo(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    edit(client, workbook_id, 'Journal Entries', 0, 'Debit', 1)
+    edit(client, workbook_id, 'Journal Entries', 0, 'Debit', 2)
+    client.post('/undo', json={'workbook_id': workbook_id})
+    edit(client, workbook_id, 'Journal Entries', 0, 'Debit', 3)
+    state = client.get('/versions', params={'workbook_id': workbook_id}).json()
+    assert (state['version'], state['latest_version'], state['can_redo']) == (2, 2, False)
+    assert backend.workbook_store.get(workbook_id).sheets['Journal Entries'].at[0, 'Debit'] == 3
+
+
+def test_out_of_range_moves_are_409(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    response = client.post('/undo', json={'workbook_id': workbook_id})
+    assert response.status_code == 409
+    assert response.json()['success'] is False
+    assert client.post('/redo', json={'workbook_id': workbook_id}).status_code == 409
+    for version in [1, -1, '0', None]:
+        response = client.post('/goto-version', json={'workbook_id': workbook_id,
+                                                      'version': version})
+        assert response.status_code == 409
+
+
+def test_oldest_versions_are_dropped(client, upload, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    backend.workbook_store.get(workbook_id).journal = backend.ChangeJournal(max_versions=2)
+    for value in (1, 2, 3):
+        edit(client, workbook_id, 'Journal Entries', 0, 'Debit', value)
+    state = client.get('/versions', params={'workbook_id': workbook_id}).json()
+    assert [entry['version'] for entry in state['versions']] == [2, 3]
+    assert state['oldest_version'] == 1
+    assert client.post('/goto-version', json={'workbook_id': workbook_id,
+                                              'version': 0}).status_code == 409
+    response = client.post('/goto-version', json={'workbook_id': workbook_id, 'version': 1})
+    assert response.json()['can_undo'] is False
+    assert backend.workbook_store.get(workbook_id).sheets['Journal Entries'].at[0, 'Debit'] == 1
+
+
+def test_versions_without_workbook(client):
+    assert client.get('/versions', params={'workbook_id': 'f' * 32}).status_code == 400
+    assert client.post('/undo', json={'workbook_id': 'f' * 32}).status_code == 400
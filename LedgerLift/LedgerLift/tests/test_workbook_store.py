@@ -0,0 +1,88 @@
+import pytest
+
+import backend
+
+
+@pytest.fixture
+def disk_store(tmp_path, monkeypatch):
+    store = backend.DiskWorkbookStore(str(tmp_path))
+    monkeypatch.setattr(backend, 'workbook_store', store)
+    return store
+
+
+def test_upload_with_disk_store(client, upload, disk_store, small_workbook):
+    response = upload(small_workbook)
+    assert response.status_code == 200
+    workbook_id = response.json()['workbook_id']
+    workbook = disk_store.get(workbook_id)
+    assert list(workbook.sheets) == list(small_workbook)
+    assert workbook.sheets['Journal Entries']['Debit'].tolist() == [100.0, 50.0, 20.0, 10.0, 5.0]
+
+
+def test_disk_store_edit_and_revalidate(client, upload, disk_store, small_workbook):
+    workbook_id = upload(small_workbook).json()['workbook_id']
+    response = client.post('/edit-cell', json={
+        'workbook_id': workbook_id, 'sheet': 'Journal Entries', 'row': 2, 'column': 'Date',
+        'value': '2024-01-04'})
+    assert response.json() == {'success': True}
+    assert disk_store.get(workbook_id).sheets['Journal Entries'].at[2, 'Date'] == '2024-01-04'
+    changes = client.post('/revalidate', json={'workbook_id': workbook_id}).json()['changes']
+    assert changes['Journal Entries']['removed']
+
+
+def test_disk_store_evicts_over_max_bytes(tmp_path, small_workbook):
+    store = backend.DiskWorkbookStore(str(tmp_path), max_bytes=1)
+    ids = [f'{i:032x}' for i in range(3)]
+    for workbook_id in ids:
+        store.put(workbook_id, backend.Workbook(dict(small_workbook), filename='w.xlsx'))
+    # Only the workbook just written survives
+    assert [workbook_id for workbook_id in ids if store.get(workbook_id) is not None] == ids[-1:]
+
+
+def test_memory_store_round_trip(small_workbook):
+    store = backend.MemoryWorkbookStore()
+    workbook = backend.Workbook(dict(small_workbook), filename='w.xlsx')
+    store.put('a' * 32, workbook)
+    assert store.get('a' * 32) is workbook
+    store.delete('a' * 32)
+    assert store.get('a' * 32) is None
+
+
+def test_uploads_get_separate_workbooks(client, upload, small_workbook):
+    first = upload(small_workbook).json()['workbook_id']
+    second = upload(small_workbook).json()['workbook_id']
+    assert first != second
+    client.post('/edit-cell', json={'workbook_id': first, 'sheet': 'Journal Entries', 'row': 0,
+                                    'column': 'Account', 'value': 'Petty Cash'})
+    assert backend.get_workbook(first).sheets['Journal Entries'].at[0, 'Account'] == 'Petty Cash'
+    assert backend.get_workbook(second).sheets['Journal Entries'].at[0, 'Account'] == 'Cash'
+
+
+@pytest.mark.parametrize('workbook_id', [None, 'missing', '0' * 32, '../' + 'a' * 29])
+def test_unknown_workbook_id(client, workbook_id):
+    params = {} if workbook_id is None else {'workbook_id': workbook_id}
+    assert client.get('/errors', params=params).status_code == 400
+    assert client.get('/versions', params=params).status_code == 400
+    assert client.get('/download-csv', params=params).status_code == 404
+    response = client.post('/edit-cell', json={'workbook_id': workbook_id, 'row': 0,
+                                               'column': 'Debit', 'value': 1})
+    assert response.json()['success'] is False
+
+
+def test_memory_store_evicts_least_recently_used(small_workbook):
+    nbytes = backend.sheets_nbytes(small_workbook)
+    store = backend.MemoryWorkbookStore(max_bytes=nbytes * 2)
+    ids = ['a' * 32, 'b' * 32, 'c' * 32]
+    for workbook_id in ids[:2]:
+        store.put(workbook_id, backend.Workbook(dict(small_workbook)))
+    store.get(ids[0])  # b is now the least recently used
+    store.put(ids[2], backend.Workbook(dict(small_workbook)))
+    assert [store.get(workbook_id) is not None for workbook_id in ids] == [True, False, True]
+
+
+def test_memory_store_expires_idle_workbooks(small_workbook, monkeypatch):
+    store = backend.MemoryWorkbookStore(ttl=60)
+    store.put('a' * 32, backend.Workbook(dict(small_workbook)))
+    now = backend.time.time()
+    monkeypatch.setattr(backend.time, 'time', lambda: now + 61)
+    assert store.get('a' * 32) is None
@@ -0,0 +1,93 @@
+import functools
+import io
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import backend
+from conftest import workbook_bytes
+
+
+def ragged_workbook():
+    """A sheet pd.read_excel has to work at: blank rows, cells past the header, mixed
+    types, an empty sheet and one with only a header."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'Journal Entries'
+    ws.append(['Date', 'Account Number', 'Account', 'Debit', 'Credit'])
+    ws.append(['2024-01-02', 1000, 'Cash', 100, 100])
+    ws.append([])
+    ws.append(['2024-01-03', 1000, 'Cash', 2.5, None])
+    ws.append(['2024-01-04', '1000', 'Cash', 7, 7, 'note'])
+    ws.append([])
+    ws.append([None, None, 'Cash', 1, 1])
+    wb.create_sheet('Empty')
+    wb.create_sheet('Trial Balance').append(['Account', 'Debit', 'Credit'])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 2, 100])
+def test_chunks_match_read_excel(tmp_path, chunk_rows):
+    path = tmp_path / 'ragged.xlsx'
+    path.write_bytes(ragged_workbook())
+    wb = backend.open_xlsx(path)
+    try:
+        for ws in wb.worksheets:
+            expected = pd.read_excel(path, sheet_name=ws.title)
+            chunks = list(backend.iter_xlsx_chunks(ws, chunk_rows))
+            # dtypes are inferred per chunk, as pd.read_csv(chunksize=...) does
+            pd.testing.assert_frame_equal(pd.concat(chunks), expected, check_dtype=False)
+    finally:
+        wb.close()
+
+
+def issues(body):
+    return [(name, err['row'], err['issue']) for name, errs in body['errors'].items()
+            for err in errs]
+
+
+def test_xlsx_read_in_chunks_matches_one_chunk(upload, monkeypatch, small_workbook):
+    data = workbook_bytes(small_workbook)
+    whole = upload(data).json()
+    backend.parse_cache.clear()
+    backend.result_cache.clear()
+    monkeypatch.setattr(backend, 'iter_xlsx_chunks',
+                        functools.partial(backend.iter_xlsx_chunks, chunk_rows=2))
+    chunked = upload(data).json()
+    assert issues(chunked) == issues(whole)
+    assert chunked['preview'] == whole['preview']
+
+
+def test_upload_selected_sheets(client, upload, small_workbook):
+    data = workbook_bytes(small_workbook)
+    whole = upload(data).json()
+    body = upload(data, sheet=['Trial Balance', 'Journal Entries']).json()
+    assert body['sheets'] == ['Journal Entries', 'Trial Balance']
+    assert set(body['errors']) == {'Journal Entries', 'Trial Balance'}
+    for name in body['errors']:
+        assert body['errors'][name] == whole['errors'][name]
+    versions = client.get('/versions', params={'workbook_id': body['workbook_id']})
+    assert versions.status_code == 200
+    workbook = backend.workbook_store.get(body['workbook_id'])
+    assert list(workbook.sheets) == ['Journal Entries', 'Trial Balance']
+
+
+def test_analyze_excel_sheets(client):
+    response = client.post('/analyze-excel-sheets',
+                           files={'file': ('ragged.xlsx', ragged_workbook())})
+    sheets = {info['name']: info for info in response.json()['sheets']}
+    assert response.json()['total_sheets'] == 3
+    assert sheets['Journal Entries']['rows'] == 6
+    assert sheets['Journal Entries']['columns'] == 6
+    assert sheets['Journal Entries']['column_names'] == [
+        'Date', 'Account Number', 'Account', 'Debit', 'Credit']
+    assert sheets['Empty']['rows'] == 0
+    assert sheets['Trial Balance']['column_names'] == ['Account', 'Debit', 'Credit']
+
+
+def test_analyze_excel_sheets_rejects_csv(client):
+    response = client.post('/analyze-excel-sheets', files={'file': ('journal.csv', b'a,b\n')})
+    assert 'only works with Excel' in response.json()['error']